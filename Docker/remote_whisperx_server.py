@@ -1,25 +1,1341 @@
 import os
 import subprocess
-from flask import Flask, request, jsonify, send_file
+from flask import Flask, Response, request, jsonify, send_file, stream_with_context
 from datetime import datetime
+from collections import OrderedDict
+from contextlib import contextmanager
+import bisect
+import hashlib
+import json
+import math
+import queue
+import shutil
+import sqlite3
 import threading
+import time
+import urllib.request
 import uuid
+import zlib
+try:
+    import zstandard
+except ImportError:
+    zstandard = None
 app = Flask(__name__)
 
-app.config['MAX_CONTENT_LENGTH'] = 2 * 1024 * 1024 * 1024  
+app.config['MAX_CONTENT_LENGTH'] = 2 * 1024 * 1024 * 1024
 
 WHISPERX_MODEL = os.environ.get("WHISPERX_MODEL", "large-v3")
 HF_TOKEN = os.environ.get("HF_TOKEN", "")
+PORT = int(os.environ.get("PORT", "8000"))
 FILES_DIR = os.environ.get("FILES_DIR", "/tmp/files")
 os.makedirs(FILES_DIR, exist_ok=True)
+UPLOADS_DIR = os.path.join(FILES_DIR, "uploads")
+os.makedirs(UPLOADS_DIR, exist_ok=True)
+UPLOAD_BUFFER_SIZE = 1024 * 1024
+# Chunked uploads never finalized, and records of finalized ones, are removed once untouched
+# for this long; checked at startup and every CLEANUP_INTERVAL seconds.
+UPLOAD_TTL_HOURS = float(os.environ.get("UPLOAD_TTL_HOURS", "24"))
+CLEANUP_INTERVAL = 600
+CACHE_DIR = os.path.join(FILES_DIR, "cache")
+CACHE_MAX_BYTES = int(os.environ.get("CACHE_MAX_BYTES", str(1024 * 1024 * 1024)))
+CACHE_MAX_AGE_DAYS = float(os.environ.get("CACHE_MAX_AGE_DAYS", "30"))
+JOBS_DB = os.path.join(FILES_DIR, "jobs.db")
+# Finished jobs older than this are dropped from memory and the job store, at startup
+# and every CLEANUP_INTERVAL seconds.
+JOB_RETENTION_DAYS = float(os.environ.get("JOB_RETENTION_DAYS", "7"))
+EVENTS_KEEPALIVE_SECONDS = 15
+# Transcripts are stored as JSON Lines and rendered into these formats by /get_transcript,
+# compressed with zstd (if the zstandard package is installed) or gzip when the client
+# accepts it and the body is large enough to benefit.
+TRANSCRIPT_MIMETYPES = {"txt": "text/plain", "jsonl": "application/x-ndjson", "srt": "application/x-subrip", "vtt": "text/vtt"}
+TRANSCRIPT_COMPRESS_MIN_BYTES = 1024
+TRANSCRIPT_COMPRESS_LEVEL = 6
+# Transcripts are streamed from disk, rendered and compressed in pieces of about this size.
+TRANSCRIPT_STREAM_CHUNK = 64 * 1024
+CALLBACK_ATTEMPTS = 5
+
+# "python" keeps models loaded in-process, "cli" shells out to whisperx per job,
+# "stub" is a CPU-only fake backend for local testing.
+WHISPERX_BACKEND = os.environ.get("WHISPERX_BACKEND", "python")
+WHISPERX_DEVICES = os.environ.get("WHISPERX_DEVICES", "")
+WHISPERX_COMPUTE_TYPE = os.environ.get("WHISPERX_COMPUTE_TYPE", "float32")
+WHISPERX_BATCH_SIZE = int(os.environ.get("WHISPERX_BATCH_SIZE", "64"))
+# Execution profiles a job can run with. memory_mb is a rough estimate of the device memory
+# the profile needs with alignment and diarization, used to pass over profiles that do not
+# fit; language_models replaces the model for languages it covers better or faster.
+# WHISPERX_PROFILES (JSON) overrides fields or adds profiles by name.
+PROFILES = {
+    "fast": {"model": "large-v3-turbo", "compute_type": "int8", "batch_size": 16, "memory_mb": 3000, "language_models": {"en": "distil-large-v3"}},
+    "balanced": {"model": "large-v3-turbo", "compute_type": "float16", "batch_size": 32, "memory_mb": 5000},
+    "accurate": {"model": WHISPERX_MODEL, "compute_type": WHISPERX_COMPUTE_TYPE, "batch_size": WHISPERX_BATCH_SIZE, "memory_mb": 10000},
+}
+for _name, _fields in json.loads(os.environ.get("WHISPERX_PROFILES", "{}")).items():
+    PROFILES[_name] = dict(PROFILES.get(_name, PROFILES["accurate"]), **_fields)
+# Jobs that do not ask for a profile run with WHISPERX_PROFILE, or with PROFILE_LONG once
+# their audio is longer than PROFILE_LONG_SECONDS (0 disables).
+WHISPERX_PROFILE = os.environ.get("WHISPERX_PROFILE", "accurate")
+PROFILE_LONG = os.environ.get("PROFILE_LONG", "balanced")
+PROFILE_LONG_SECONDS = float(os.environ.get("PROFILE_LONG_SECONDS", "3600"))
+ASR_CACHE_SIZE = int(os.environ.get("ASR_CACHE_SIZE", "2"))
+ALIGN_CACHE_SIZE = int(os.environ.get("ALIGN_CACHE_SIZE", "4"))
+PRELOAD_ALIGN_LANGUAGES = [l.strip() for l in os.environ.get("PRELOAD_ALIGN_LANGUAGES", "").split(",") if l.strip()]
+STUB_LOAD_SECONDS = float(os.environ.get("STUB_LOAD_SECONDS", "0"))
+STUB_SECONDS_PER_AUDIO_SECOND = float(os.environ.get("STUB_SECONDS_PER_AUDIO_SECOND", "0"))
+STUB_SECONDS_PER_BATCH = float(os.environ.get("STUB_SECONDS_PER_BATCH", "0"))
+# Batch sizes above this fail like a GPU running out of memory. 0 disables.
+STUB_MAX_BATCH_SIZE = int(os.environ.get("STUB_MAX_BATCH_SIZE", "0"))
+SAMPLE_RATE = 16000
+# Audio is transcribed in windows of about this length, cut at silence, so finished
+# segments can be streamed to clients before alignment and diarization. 0 disables.
+STREAM_WINDOW_SECONDS = float(os.environ.get("STREAM_WINDOW_SECONDS", "300"))
+SILENCE_SEARCH_SECONDS = float(os.environ.get("SILENCE_SEARCH_SECONDS", "10"))
+# Audio longer than this is split at silence into shards that run in parallel on every
+# idle device, with speakers matched across shards by embedding. 0 disables.
+SHARD_SECONDS = float(os.environ.get("SHARD_SECONDS", "1200"))
+SPEAKER_MATCH_THRESHOLD = float(os.environ.get("SPEAKER_MATCH_THRESHOLD", "0.5"))
+# Workers default to one per device for in-process backends and to one for the CLI,
+# since several CLI runs on one GPU just fight over its memory.
+WHISPERX_WORKERS = int(os.environ.get("WHISPERX_WORKERS", "0"))
+MAX_QUEUE_SIZE = int(os.environ.get("MAX_QUEUE_SIZE", "16"))
+# "fifo", "shortest" (shortest audio first, with aging) or "fair" (per-user fair share).
+SCHEDULER_POLICY = os.environ.get("SCHEDULER_POLICY", "shortest")
+# Audio seconds a queued job is credited per second of waiting under "shortest".
+SCHEDULER_AGING = float(os.environ.get("SCHEDULER_AGING", "1.0"))
+# Jobs with at most this much audio and the same model and language are transcribed
+# together in one pass, so their segments share ASR batches. 0 disables batching.
+BATCH_MAX_SECONDS = float(os.environ.get("BATCH_MAX_SECONDS", "60"))
+BATCH_MAX_JOBS = int(os.environ.get("BATCH_MAX_JOBS", "8"))
+# A worker holding a short job waits up to BATCH_WINDOW_MS after the latest compatible
+# arrival for another one, but never longer than BATCH_MAX_WAIT_MS after the first job
+# was submitted. Jobs that already queued that long go at once with whatever is queued.
+BATCH_WINDOW_MS = float(os.environ.get("BATCH_WINDOW_MS", "300"))
+BATCH_MAX_WAIT_MS = float(os.environ.get("BATCH_MAX_WAIT_MS", "1000"))
+# Silence between batched jobs. whisperx merges VAD segments into chunks of at most 30 s,
+# so a longer gap keeps every chunk within one job.
+BATCH_GAP_SECONDS = 31
 
 jobs = {}
+# Notified whenever an event is appended to any job; /job_events waits on it.
+job_events_cond = threading.Condition()
 def log(msg):
     timestamp = datetime.now().strftime('%Y-%m-%d %H:%M:%S')
     print(f"[{timestamp}] {msg}", flush=True)
+
+class Metrics:
+    """
+    Minimal Prometheus-style registry served on /metrics: counters and histograms updated
+    in place, plus values read from a function at scrape time.
+    """
+    BUCKETS = (0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30, 60, 120, 300, 600, 1800, 3600)
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.types = {}
+        self.help = {}
+        self.values = {}
+        self.functions = {}
+    def _register(self, name, kind, help_text, fn=None):
+        self.types[name] = kind
+        self.help[name] = help_text
+        self.values[name] = {}
+        if fn is not None:
+            self.functions[name] = fn
+    def counter(self, name, help_text, fn=None):
+        self._register(name, "counter", help_text, fn)
+    def gauge(self, name, help_text, fn):
+        self._register(name, "gauge", help_text, fn)
+    def histogram(self, name, help_text):
+        self._register(name, "histogram", help_text)
+    def inc(self, name, value=1, **labels):
+        key = tuple(sorted(labels.items()))
+        with self.lock:
+            series = self.values[name]
+            series[key] = series.get(key, 0) + value
+    def observe(self, name, value, **labels):
+        key = tuple(sorted(labels.items()))
+        with self.lock:
+            # One count per bucket plus +Inf, then the sum and the total count.
+            h = self.values[name].setdefault(key, [0] * (len(self.BUCKETS) + 1) + [0.0, 0])
+            h[bisect.bisect_left(self.BUCKETS, value)] += 1
+            h[-2] += value
+            h[-1] += 1
+    @staticmethod
+    def _labels(key, extra=()):
+        pairs = list(key) + list(extra)
+        return "{" + ",".join(f'{k}="{v}"' for k, v in pairs) + "}" if pairs else ""
+    def render(self):
+        lines = []
+        for name, kind in self.types.items():
+            lines.append(f"# HELP {name} {self.help[name]}")
+            lines.append(f"# TYPE {name} {kind}")
+            if name in self.functions:
+                lines.append(f"{name} {self.functions[name]()}")
+                continue
+            with self.lock:
+                series = {key: list(value) if kind == "histogram" else value for key, value in self.values[name].items()}
+            for key, value in series.items():
+                if kind != "histogram":
+                    lines.append(f"{name}{self._labels(key)} {value}")
+                    continue
+                cumulative = 0
+                for bound, count in zip(self.BUCKETS + ("+Inf",), value):
+                    cumulative += count
+                    lines.append(f"{name}_bucket{self._labels(key, [('le', bound)])} {cumulative}")
+                lines.append(f"{name}_sum{self._labels(key)} {value[-2]}")
+                lines.append(f"{name}_count{self._labels(key)} {value[-1]}")
+        return "\n".join(lines) + "\n"
+
+metrics = Metrics()
+metrics.counter("whisperx_jobs_submitted_total", "Jobs accepted into the queue.")
+metrics.counter("whisperx_jobs_finished_total", "Jobs finished, by status.")
+metrics.counter("whisperx_jobs_rejected_total", "Submissions rejected because the queue was full.")
+metrics.counter("whisperx_upload_bytes_total", "Audio bytes received.")
+metrics.counter("whisperx_transcript_bytes_total", "Transcript bytes sent.")
+metrics.counter("whisperx_device_busy_seconds_total", "Seconds each device spent running jobs.")
+metrics.histogram("whisperx_stage_seconds", "Seconds spent in each job stage, by execution profile.")
+metrics.counter("whisperx_audio_seconds_total", "Seconds of audio transcribed, by execution profile.")
+metrics.counter("whisperx_oom_retries_total", "Transcriptions retried with a smaller batch after running out of memory.")
+metrics.histogram("whisperx_job_seconds", "Seconds from submission to completion.")
+metrics.gauge("whisperx_queue_depth", "Jobs waiting for a worker.", lambda: scheduler.stats()["queued"])
+metrics.gauge("whisperx_running_jobs", "Jobs being processed.", lambda: scheduler.stats()["running"])
+metrics.gauge("whisperx_models_loaded", "Devices with their models loaded.", lambda: len(model_pool.slots))
+metrics.counter("whisperx_cache_hits_total", "Transcript cache hits.", lambda: transcript_cache.hits)
+metrics.counter("whisperx_cache_misses_total", "Transcript cache misses.", lambda: transcript_cache.misses)
+
+# Stages reported in a job's timings, traced in the log and observed in whisperx_stage_seconds.
+TRACE_STAGES = ("queue", "decode", "load", "transcribe", "align", "diarize", "write")
+
+def record_timings(job_id, timings):
+    job = jobs[job_id]
+    job["timings"] = timings
+    profile = job["profile"]["name"]
+    for stage in TRACE_STAGES:
+        if stage in timings:
+            metrics.observe("whisperx_stage_seconds", timings[stage], stage=stage, profile=profile)
+    metrics.inc("whisperx_audio_seconds_total", job["duration"], profile=profile)
+    spans = " ".join(f"{stage}={timings[stage]:.2f}s" for stage in TRACE_STAGES if stage in timings)
+    log(f"[trace {job.get('trace_id')}] Job {job_id} profile={describe_profile(job['profile'])} {spans}")
+
+def publish_event(job_id, event_type, **data):
+    with job_events_cond:
+        job = jobs.get(job_id)
+        if job is None:
+            return
+        job.setdefault("events", []).append({"type": event_type, "data": data})
+        job_events_cond.notify_all()
+
+def report_progress(job_id, stage, progress):
+    jobs[job_id]["stage"] = stage
+    jobs[job_id]["progress"] = progress
+    publish_event(job_id, "progress", stage=stage, progress=progress)
+
+def publish_segments(job_id, segments):
+    """Stream finished but not yet aligned or diarized segments to /job_events listeners."""
+    segments = [{"start": round(s["start"], 2), "end": round(s["end"], 2), "text": s["text"].strip()} for s in segments]
+    if segments:
+        publish_event(job_id, "segments", segments=segments)
+
+def post_callback(job_id, url, payload):
+    body = json.dumps(payload).encode()
+    for attempt in range(CALLBACK_ATTEMPTS):
+        try:
+            req = urllib.request.Request(url, data=body, headers={"Content-Type": "application/json"}, method="POST")
+            with urllib.request.urlopen(req, timeout=10) as resp:
+                log(f"[Job {job_id}] Callback to {url} returned {resp.status}")
+                return
+        except Exception as e:
+            log(f"[Job {job_id}] Callback to {url} failed: {e} (attempt {attempt + 1})")
+            time.sleep(2 ** attempt)
+
+def finish_job(job_id, status, error=None, **fields):
+    """Record the final status, wake /job_events listeners and fire the completion callback."""
+    job = jobs[job_id]
+    job.update(fields)
+    job["status"] = status
+    job["error"] = error
+    job["finished_at"] = time.time()
+    job_store.save(job_id)
+    metrics.inc("whisperx_jobs_finished_total", status=status)
+    if job.get("submitted_at"):
+        metrics.observe("whisperx_job_seconds", job["finished_at"] - job["submitted_at"])
+    publish_event(job_id, status, error=error, timings=job.get("timings"), profile=job.get("profile"))
+    with job_events_cond:
+        # Progress and partial segments are of no use once the job is over; only the final
+        # event is kept, under its original id, for clients that connect later.
+        events = job["events"]
+        job["events_base"] = job.get("events_base", 0) + len(events) - 1
+        job["events"] = events[-1:]
+    if job.get("callback_url"):
+        payload = {"job_id": job_id, "status": status, "error": error}
+        threading.Thread(target=post_callback, args=(job_id, job["callback_url"], payload), daemon=True).start()
+
+def detect_devices():
+    if WHISPERX_DEVICES:
+        return [d.strip() for d in WHISPERX_DEVICES.split(",") if d.strip()]
+    if WHISPERX_BACKEND == "stub":
+        return ["cpu"]
+    try:
+        import torch
+        if torch.cuda.is_available():
+            return [f"cuda:{i}" for i in range(torch.cuda.device_count())]
+    except Exception as e:
+        log(f"Could not query CUDA devices: {e}")
+    return ["cpu"]
+
+class WhisperXRuntime:
+    """Thin wrapper over the whisperx Python API."""
+    def __init__(self):
+        import whisperx
+        self.whisperx = whisperx
+    def load_asr(self, device, model_name, compute_type):
+        device_type, _, index = device.partition(":")
+        return self.whisperx.load_model(model_name, device_type, device_index=int(index or 0), compute_type=compute_type)
+    def load_align(self, language, device):
+        return self.whisperx.load_align_model(language_code=language, device=device)
+    def load_diarize(self, device, hf_token):
+        pipeline_cls = getattr(self.whisperx, "DiarizationPipeline", None)
+        if pipeline_cls is None:
+            from whisperx.diarize import DiarizationPipeline as pipeline_cls
+        return pipeline_cls(use_auth_token=hf_token, device=device)
+    def load_audio(self, path):
+        return self.whisperx.load_audio(path)
+    def free_memory_mb(self, device):
+        """Free memory of a CUDA device in MiB, or None for other devices."""
+        if not device.startswith("cuda"):
+            return None
+        import torch
+        _, _, index = device.partition(":")
+        free, _ = torch.cuda.mem_get_info(int(index or 0))
+        return free / 2**20
+    def release_memory(self):
+        import gc
+        import torch
+        gc.collect()
+        if torch.cuda.is_available():
+            torch.cuda.empty_cache()
+    def transcribe(self, model, audio, language, batch_size):
+        return model.transcribe(audio, batch_size=batch_size, language=language)
+    def align(self, align_model, segments, audio, device):
+        model_a, metadata = align_model
+        return self.whisperx.align(segments, model_a, metadata, audio, device, return_char_alignments=False)
+    def diarize(self, pipeline, audio, min_speakers, max_speakers, result):
+        """
+        Assign speakers to result. Also returns {speaker: embedding}, or None when this
+        whisperx version cannot return speaker embeddings.
+        """
+        embeddings = None
+        try:
+            diarize_segments, embeddings = pipeline(audio, min_speakers=min_speakers, max_speakers=max_speakers, return_embeddings=True)
+        except TypeError:
+            diarize_segments = pipeline(audio, min_speakers=min_speakers, max_speakers=max_speakers)
+        return self.whisperx.assign_word_speakers(diarize_segments, result), embeddings
+
+class StubRuntime:
+    """
+    CPU-only stand-in for WhisperXRuntime. Audio files are read as raw 16 kHz s16le PCM.
+    Every stretch of non-silent audio (up to 30 s) becomes one segment, and speakers are
+    told apart by loudness: segments with the same level get the same speaker and
+    embedding. Synthetic audio with one level per speaker thus has a known ground truth.
+    Like a real diarizer held to min_speakers, it splits the speaker with the most
+    segments, giving every other one a new label with the same embedding, until there
+    are that many speakers.
+    Transcription takes STUB_SECONDS_PER_AUDIO_SECOND per second of speech plus
+    STUB_SECONDS_PER_BATCH per batch of up to batch_size segments, however full, and
+    runs out of memory with batches larger than STUB_MAX_BATCH_SIZE.
+    """
+    SILENCE_LEVEL = 0.01
+    def load_asr(self, device, model_name, compute_type):
+        time.sleep(STUB_LOAD_SECONDS)
+        return {"model": model_name, "device": device, "compute_type": compute_type}
+    def load_align(self, language, device):
+        time.sleep(STUB_LOAD_SECONDS)
+        return ({"language": language}, {"language": language})
+    def load_diarize(self, device, hf_token):
+        time.sleep(STUB_LOAD_SECONDS)
+        return {"device": device}
+    def load_audio(self, path):
+        import numpy as np
+        with open(path, "rb") as f:
+            data = f.read()
+        data = data[:len(data) // 2 * 2]
+        return np.frombuffer(data, dtype=np.int16).astype(np.float32) / 32768.0
+    def free_memory_mb(self, device):
+        return None
+    def release_memory(self):
+        pass
+    def transcribe(self, model, audio, language, batch_size):
+        import numpy as np
+        if STUB_MAX_BATCH_SIZE and batch_size > STUB_MAX_BATCH_SIZE:
+            raise RuntimeError(f"CUDA out of memory (stub: batch size {batch_size} > {STUB_MAX_BATCH_SIZE})")
+        frame = SAMPLE_RATE // 10
+        count = len(audio) // frame
+        voiced = np.abs(np.asarray(audio[:count * frame])).reshape(count, frame).mean(axis=1) > self.SILENCE_LEVEL
+        segments = []
+        start = None
+        for i in range(count + 1):
+            if i < count and voiced[i] and (start is None or i - start < 300):
+                if start is None:
+                    start = i
+                continue
+            if start is not None:
+                segments.append({"start": start / 10, "end": i / 10, "text": f" segment {len(segments)}"})
+                start = i if i < count and voiced[i] else None
+        batches = math.ceil(len(segments) / max(batch_size, 1))
+        time.sleep(int(voiced.sum()) / 10 * STUB_SECONDS_PER_AUDIO_SECOND + batches * STUB_SECONDS_PER_BATCH)
+        return {"segments": segments, "language": language}
+    def align(self, align_model, segments, audio, device):
+        return {"segments": [dict(s, words=[{"word": s["text"].strip(), "start": s["start"], "end": s["end"]}]) for s in segments]}
+    def diarize(self, pipeline, audio, min_speakers, max_speakers, result):
+        import numpy as np
+        labels = {}
+        embeddings = {}
+        for segment in result["segments"]:
+            samples = np.asarray(audio[int(segment["start"] * SAMPLE_RATE):int(segment["end"] * SAMPLE_RATE)])
+            level = min(int(round(float(np.abs(samples).mean()) * 20)), 19) if len(samples) else 0
+            if level not in labels:
+                labels[level] = f"SPEAKER_{len(labels):02d}"
+                embeddings[labels[level]] = [1.0 if i == level else 0.0 for i in range(20)]
+            segment["speaker"] = labels[level]
+        while embeddings and len(embeddings) < min_speakers:
+            counts = {label: sum(s["speaker"] == label for s in result["segments"]) for label in embeddings}
+            source = max(counts, key=counts.get)
+            if counts[source] < 2:
+                break
+            label = f"SPEAKER_{len(embeddings):02d}"
+            embeddings[label] = list(embeddings[source])
+            for segment in [s for s in result["segments"] if s["speaker"] == source][1::2]:
+                segment["speaker"] = label
+        for segment in result["segments"]:
+            for word in segment.get("words", []):
+                word["speaker"] = segment["speaker"]
+        return result, embeddings
+
+def find_split_points(audio, window_seconds, search_seconds=SILENCE_SEARCH_SECONDS):
+    """
+    Sample offsets cutting audio into pieces of about window_seconds. Each cut is moved
+    to the quietest 100 ms frame within search_seconds of its nominal position.
+    """
+    import numpy as np
+    window = int(window_seconds * SAMPLE_RATE)
+    search = int(search_seconds * SAMPLE_RATE)
+    frame = SAMPLE_RATE // 10
+    points = []
+    start = 0
+    while window > 0 and len(audio) - start > window + search:
+        target = start + window
+        lo = max(target - search, start + frame)
+        count = (min(target + search, len(audio) - frame) - lo) // frame
+        frames = np.asarray(audio[lo:lo + count * frame], dtype=np.float32).reshape(count, frame)
+        energy = np.mean(frames * frames, axis=1)
+        start = lo + int(np.argmin(energy)) * frame + frame // 2
+        points.append(start)
+    return points
+
+def shift_segments(segments, offset):
+    shifted = []
+    for segment in segments:
+        segment = dict(segment, start=segment["start"] + offset, end=segment["end"] + offset)
+        if "words" in segment:
+            segment["words"] = [dict(w, start=w["start"] + offset, end=w["end"] + offset) if "start" in w else dict(w) for w in segment["words"]]
+        shifted.append(segment)
+    return shifted
+
+def reconcile_speakers(shard_embeddings, max_speakers, threshold=SPEAKER_MATCH_THRESHOLD):
+    """
+    Map each shard's local speaker labels onto global ones. Local speakers are matched
+    to the running centroid of a global speaker by cosine similarity, one-to-one within
+    a shard; unmatched speakers become new global speakers until max_speakers is reached.
+    Returns one {local label: global label} dict per shard.
+    """
+    import numpy as np
+    centroids = []
+    mappings = []
+    def similarity(vector, centroid):
+        norm = np.linalg.norm(centroid)
+        return float(vector @ centroid / norm) if norm else 0.0
+    for embeddings in shard_embeddings:
+        vectors = {}
+        for label, embedding in embeddings.items():
+            vector = np.asarray(embedding, dtype=np.float64)
+            norm = np.linalg.norm(vector)
+            vectors[label] = vector / norm if norm else vector
+        pairs = sorted(
+            ((similarity(v, c), label, g) for label, v in vectors.items() for g, c in enumerate(centroids)),
+            key=lambda pair: pair[0], reverse=True,
+        )
+        mapping = {}
+        for score, label, g in pairs:
+            if score >= threshold and label not in mapping and g not in mapping.values():
+                mapping[label] = g
+        for label, vector in vectors.items():
+            if label in mapping:
+                continue
+            if len(centroids) < max(max_speakers, 1):
+                centroids.append(np.zeros_like(vector))
+                mapping[label] = len(centroids) - 1
+            else:
+                mapping[label] = max(range(len(centroids)), key=lambda g: similarity(vector, centroids[g]))
+        for label, g in mapping.items():
+            centroids[g] = centroids[g] + vectors[label]
+        mappings.append({label: f"SPEAKER_{g:02d}" for label, g in mapping.items()})
+    return mappings
+
+def make_runtime():
+    if WHISPERX_BACKEND == "stub":
+        return StubRuntime()
+    return WhisperXRuntime()
+
+def is_out_of_memory(error):
+    # torch raises OutOfMemoryError("CUDA out of memory. ..."), CTranslate2 a RuntimeError
+    # ending in "out of memory"; neither has a type both share.
+    return "out of memory" in str(error).lower()
+
+class ModelSlot:
+    """
+    Models resident on one device. ASR models are cached per model and compute type,
+    alignment models per language, and both are evicted least-recently-used once
+    ASR_CACHE_SIZE or ALIGN_CACHE_SIZE is exceeded.
+    """
+    def __init__(self, runtime, device):
+        self.runtime = runtime
+        self.device = device
+        self.asr_models = OrderedDict()
+        self.diarize_model = None
+        self.align_models = OrderedDict()
+        # Largest batch size that fit in memory so far, per (model, compute type).
+        self.batch_limits = {}
+        self.acquired_at = None
+    def _timed_load(self, timings, loader, *args):
+        started = time.monotonic()
+        model = loader(*args)
+        timings["load"] = timings.get("load", 0.0) + time.monotonic() - started
+        return model
+    def load(self, hf_token=HF_TOKEN, timings=None, profile=None):
+        """Load the ASR model of profile (the default profile if None) and the diarization model it needs."""
+        timings = {} if timings is None else timings
+        profile = profile or choose_profile(0, 2, None)
+        key = (profile["model"], profile["compute_type"])
+        if key in self.asr_models:
+            self.asr_models.move_to_end(key)
+        else:
+            self.asr_models[key] = self._timed_load(timings, self.runtime.load_asr, self.device, *key)
+            while len(self.asr_models) > ASR_CACHE_SIZE:
+                evicted, model = self.asr_models.popitem(last=False)
+                # Dropped before releasing memory, or the model would still be referenced.
+                del model
+                self.runtime.release_memory()
+                log(f"[ModelPool] Evicted ASR model '{'/'.join(evicted)}' on {self.device}")
+        if self.diarize_model is None and hf_token and profile["diarize"]:
+            self.diarize_model = self._timed_load(timings, self.runtime.load_diarize, self.device, hf_token)
+        return timings
+    def get_align_model(self, language, timings):
+        model = self.align_models.get(language)
+        if model is not None:
+            self.align_models.move_to_end(language)
+            return model
+        model = self._timed_load(timings, self.runtime.load_align, language, self.device)
+        self.align_models[language] = model
+        while len(self.align_models) > ALIGN_CACHE_SIZE:
+            evicted, evicted_model = self.align_models.popitem(last=False)
+            del evicted_model
+            self.runtime.release_memory()
+            log(f"[ModelPool] Evicted alignment model '{evicted}' on {self.device}")
+        return model
+    def transcribe(self, profile, audio, language):
+        """
+        Transcribe with the ASR model of profile, loaded beforehand by load(). On running
+        out of memory the batch size is halved and the audio transcribed again; the size
+        that fit is kept for later jobs on this device and recorded in profile.
+        """
+        key = (profile["model"], profile["compute_type"])
+        batch_size = min(profile["batch_size"], self.batch_limits.get(key, profile["batch_size"]))
+        while True:
+            try:
+                result = self.runtime.transcribe(self.asr_models[key], audio, language, batch_size)
+                break
+            except Exception as e:
+                if batch_size <= 1 or not is_out_of_memory(e):
+                    raise
+                self.runtime.release_memory()
+                batch_size //= 2
+                self.batch_limits[key] = batch_size
+                metrics.inc("whisperx_oom_retries_total", device=self.device)
+                log(f"[ModelPool] Out of memory on {self.device} with {'/'.join(key)}, retrying with batch size {batch_size}")
+        profile["batch_size"] = batch_size
+        return result
+    def transcribe_windows(self, profile, audio, language, on_progress, on_segments):
+        bounds = [0] + find_split_points(audio, STREAM_WINDOW_SECONDS) + [len(audio)]
+        segments = []
+        for start, end in zip(bounds, bounds[1:]):
+            piece = self.transcribe(profile, audio[start:end], language)
+            language = language or piece.get("language")
+            offset = start / SAMPLE_RATE
+            shifted = [dict(segment, start=segment["start"] + offset, end=segment["end"] + offset) for segment in piece["segments"]]
+            segments.extend(shifted)
+            on_segments(shifted)
+            on_progress("transcribing", 0.05 + 0.55 * end / max(len(audio), 1))
+        return {"segments": segments, "language": language}
+    def run(self, profile, audio, min_speakers, max_speakers, language, hf_token,
+            on_progress=lambda stage, progress: None, on_segments=lambda segments: None):
+        """Transcribe, align and diarize audio. Returns the result, timings and speaker embeddings."""
+        timings = {"load": 0.0, "inference": 0.0, "transcribe": 0.0, "align": 0.0, "diarize": 0.0}
+        on_progress("loading", 0.0)
+        self.load(hf_token, timings, profile)
+        started = time.monotonic()
+        on_progress("transcribing", 0.05)
+        result = self.transcribe_windows(profile, audio, language, on_progress, on_segments)
+        language = result.get("language") or language
+        timings["transcribe"] = time.monotonic() - started
+        result, embeddings = self.align_and_diarize(profile, audio, result["segments"], language, min_speakers, max_speakers, timings, on_progress)
+        return result, timings, embeddings
+    def align_and_diarize(self, profile, audio, segments, language, min_speakers, max_speakers, timings, on_progress=lambda stage, progress: None):
+        """Align transcribed segments and assign speakers, if profile diarizes. Returns the result and speaker embeddings."""
+        embeddings = None
+        on_progress("aligning", 0.6)
+        align_model = self.get_align_model(language, timings)
+        started = time.monotonic()
+        result = self.runtime.align(align_model, segments, audio, self.device)
+        timings["align"] = time.monotonic() - started
+        if profile["diarize"] and self.diarize_model is not None:
+            on_progress("diarizing", 0.75)
+            started = time.monotonic()
+            result, embeddings = self.runtime.diarize(self.diarize_model, audio, int(min_speakers), int(max_speakers), result)
+            timings["diarize"] = time.monotonic() - started
+        timings["inference"] = timings["transcribe"] + timings["align"] + timings["diarize"]
+        return result, embeddings
+
+class ModelPool:
+    def __init__(self, devices):
+        self.runtime = None
+        self.devices = devices
+        self.slots = []
+        self.free = queue.Queue()
+        self.ready = False
+        self.load_error = None
+        # Free memory of the smallest device before any model was loaded, if known.
+        self.memory_mb = None
+    def load(self):
+        self.runtime = make_runtime()
+        free = [m for m in (self.runtime.free_memory_mb(device) for device in self.devices) if m is not None]
+        self.memory_mb = min(free) if free else None
+        for device in self.devices:
+            slot = ModelSlot(self.runtime, device)
+            timings = slot.load()
+            for language in PRELOAD_ALIGN_LANGUAGES:
+                slot.get_align_model(language, timings)
+            log(f"[ModelPool] Loaded models on {device} in {timings.get('load', 0.0):.2f}s")
+            self.slots.append(slot)
+            self.free.put(slot)
+        self.ready = True
+    def load_in_background(self):
+        """Load models without blocking startup; /healthz reports ready once done."""
+        def target():
+            try:
+                self.load()
+            except Exception as e:
+                self.load_error = str(e)
+                log(f"[ModelPool] Loading failed: {e}")
+        threading.Thread(target=target, name="model-loader", daemon=True).start()
+    @contextmanager
+    def acquire(self):
+        slot = self.free.get()
+        started = time.monotonic()
+        try:
+            yield slot
+        finally:
+            metrics.inc("whisperx_device_busy_seconds_total", time.monotonic() - started, device=slot.device)
+            self.free.put(slot)
+    def acquire_idle(self, limit):
+        """Take up to limit slots that are free right now, without waiting."""
+        slots = []
+        while len(slots) < limit:
+            try:
+                slot = self.free.get_nowait()
+            except queue.Empty:
+                break
+            slot.acquired_at = time.monotonic()
+            slots.append(slot)
+        return slots
+    def release(self, slots):
+        for slot in slots:
+            metrics.inc("whisperx_device_busy_seconds_total", time.monotonic() - slot.acquired_at, device=slot.device)
+            self.free.put(slot)
+
+model_pool = ModelPool(detect_devices())
+
+def client_duration(form):
+    """Duration the client measured while preparing the upload, if it sent one."""
+    try:
+        return float(form.get("duration") or 0) or None
+    except ValueError:
+        return None
+
+def probe_duration(file_path):
+    """Audio duration in seconds, via ffprobe, falling back to a size-based guess."""
+    if WHISPERX_BACKEND == "stub":
+        return os.path.getsize(file_path) / (SAMPLE_RATE * 2)
+    try:
+        out = subprocess.run(
+            ["ffprobe", "-v", "error", "-show_entries", "format=duration", "-of", "default=noprint_wrappers=1:nokey=1", file_path],
+            capture_output=True, text=True, timeout=30,
+        )
+        return float(out.stdout.strip())
+    except Exception as e:
+        log(f"ffprobe failed for {file_path}: {e}")
+        # Roughly 128 kbit/s compressed audio.
+        return os.path.getsize(file_path) / 16000
+
+def choose_profile(duration, max_speakers, language, preference=None):
+    """
+    Execution profile of a job: the profile named by preference, or WHISPERX_PROFILE
+    (PROFILE_LONG for long audio). Profiles needing more memory than the smallest device
+    had free give way to the next cheaper one, and diarization is skipped when at most
+    one speaker is expected. Returns the resolved settings, recorded with the job.
+    """
+    name = preference if preference in PROFILES else WHISPERX_PROFILE
+    if preference and preference not in PROFILES:
+        log(f"Unknown profile '{preference}', using {name}.")
+    if not preference and PROFILE_LONG_SECONDS > 0 and duration > PROFILE_LONG_SECONDS and PROFILE_LONG in PROFILES:
+        name = PROFILE_LONG
+    if model_pool.memory_mb is not None:
+        cheaper = sorted(PROFILES, key=lambda n: PROFILES[n]["memory_mb"], reverse=True)
+        fitting = [n for n in cheaper[cheaper.index(name):] if PROFILES[n]["memory_mb"] <= model_pool.memory_mb]
+        name = fitting[0] if fitting else cheaper[-1]
+    profile = PROFILES[name]
+    return {
+        "name": name,
+        "model": profile.get("language_models", {}).get(language, profile["model"]),
+        "compute_type": profile["compute_type"],
+        "batch_size": profile["batch_size"],
+        "diarize": int(max_speakers) > 1,
+    }
+
+def describe_profile(profile):
+    diarize = "" if profile["diarize"] else " no-diarize"
+    return f"{profile['name']}({profile['model']}/{profile['compute_type']}/batch {profile['batch_size']}{diarize})"
+
+class QueueFull(Exception):
+    def __init__(self, retry_after):
+        super().__init__("Job queue is full")
+        self.retry_after = retry_after
+
+def batch_key(job):
+    """
+    Jobs with equal keys can share one transcription pass; None for jobs that run alone.
+    The batch loads its models with one HuggingFace token, so only jobs sent with the
+    same token share one.
+    """
+    language = job["args"][4]
+    if BATCH_MAX_SECONDS <= 0 or WHISPERX_BACKEND == "cli" or not language or job["duration"] > BATCH_MAX_SECONDS:
+        return None
+    return (job["profile"]["model"], job["profile"]["compute_type"], language, job["args"][5])
+
+class JobScheduler:
+    """
+    Bounded job queue served by a fixed number of worker threads. The next job is
+    picked according to SCHEDULER_POLICY each time a worker frees up, together with
+    short jobs it can be batched with.
+    """
+    def __init__(self, workers, max_queue, policy):
+        self.workers = workers
+        self.max_queue = max_queue
+        self.policy = policy
+        self.queued = []
+        self.running = {}
+        self.user_running = {}
+        self.user_served = {}
+        # Moving average of processing seconds per second of audio, used for ETAs.
+        self.seconds_per_audio_second = 0.2
+        self.cond = threading.Condition()
+        self.threads = []
+    def start(self):
+        for i in range(self.workers):
+            t = threading.Thread(target=self._worker, name=f"whisperx-worker-{i}", daemon=True)
+            t.start()
+            self.threads.append(t)
+        log(f"[Scheduler] {self.workers} worker(s), queue size {self.max_queue}, policy {self.policy}")
+    def _key(self, job_id, now):
+        job = jobs[job_id]
+        if self.policy == "shortest":
+            return (job["duration"] - (now - job["submitted_at"]) * SCHEDULER_AGING, job["submitted_at"])
+        if self.policy == "fair":
+            user = job["user_id"]
+            return (self.user_running.get(user, 0), self.user_served.get(user, 0.0), job["submitted_at"])
+        return (job["submitted_at"],)
+    def _ordered(self):
+        now = time.time()
+        return sorted(self.queued, key=lambda job_id: self._key(job_id, now))
+    def stats(self):
+        with self.cond:
+            return {"queued": len(self.queued), "running": len(self.running), "workers": self.workers, "max_queue": self.max_queue}
+    def is_full(self):
+        with self.cond:
+            return len(self.queued) >= self.max_queue
+    def submit(self, job_id, force=False):
+        with self.cond:
+            if not force and len(self.queued) >= self.max_queue:
+                raise QueueFull(self.retry_after())
+            self.queued.append(job_id)
+            # A worker collecting a batch waits on the same condition as idle ones.
+            self.cond.notify_all()
+    def _next_batch(self):
+        """
+        The jobs a worker runs next, called with the lock held: the first job by policy
+        and, if it is short, up to BATCH_MAX_JOBS - 1 compatible jobs queued behind it.
+        """
+        while True:
+            while not self.queued:
+                self.cond.wait()
+            head = self._ordered()[0]
+            key = batch_key(jobs[head])
+            if key is None:
+                return [head]
+            while head in self.queued:
+                batch = [job_id for job_id in self._ordered() if batch_key(jobs[job_id]) == key][:BATCH_MAX_JOBS]
+                latest = max(jobs[job_id]["submitted_at"] for job_id in batch)
+                deadline = min(latest + BATCH_WINDOW_MS / 1000, jobs[head]["submitted_at"] + BATCH_MAX_WAIT_MS / 1000)
+                now = time.time()
+                if len(batch) >= BATCH_MAX_JOBS or now >= deadline:
+                    return batch
+                self.cond.wait(deadline - now)
+            # Another worker took the job while this one waited for companions.
+    def _worker(self):
+        while True:
+            with self.cond:
+                batch = self._next_batch()
+                for job_id in batch:
+                    self.queued.remove(job_id)
+                    job = jobs[job_id]
+                    job["started_at"] = time.time()
+                    self.running[job_id] = job["started_at"]
+                    self.user_running[job["user_id"]] = self.user_running.get(job["user_id"], 0) + 1
+            try:
+                if len(batch) > 1:
+                    run_whisperx_batch(batch)
+                else:
+                    run_whisperx_job(batch[0], *jobs[batch[0]]["args"])
+            finally:
+                with self.cond:
+                    audio_seconds = 0.0
+                    for job_id in batch:
+                        elapsed = time.time() - self.running.pop(job_id)
+                        job = jobs[job_id]
+                        user = job["user_id"]
+                        self.user_running[user] -= 1
+                        if not self.user_running[user]:
+                            del self.user_running[user]
+                        self.user_served[user] = self.user_served.get(user, 0.0) + job["duration"]
+                        if job["status"] == "done":
+                            audio_seconds += job["duration"]
+                    if audio_seconds > 0:
+                        rate = elapsed / audio_seconds
+                        self.seconds_per_audio_second = 0.8 * self.seconds_per_audio_second + 0.2 * rate
+    def _estimated_runtime(self, job_id):
+        return jobs[job_id]["duration"] * self.seconds_per_audio_second
+    def _worker_free_times(self, now):
+        free = [max(started + self._estimated_runtime(job_id) - now, 0.0) for job_id, started in self.running.items()]
+        free += [0.0] * max(self.workers - len(free), 0)
+        return sorted(free)
+    def retry_after(self):
+        free = self._worker_free_times(time.time())
+        return max(5, int(math.ceil(free[0] if free else 5)))
+    def queue_info(self, job_id):
+        """1-based queue position and estimated seconds until the job starts, or None if not queued."""
+        with self.cond:
+            if job_id not in self.queued:
+                return None
+            now = time.time()
+            free = self._worker_free_times(now)
+            for position, queued_id in enumerate(self._ordered(), 1):
+                start = free.pop(0)
+                if queued_id == job_id:
+                    return position, start
+                free.append(start + self._estimated_runtime(queued_id))
+                free.sort()
+
+def default_worker_count():
+    if WHISPERX_WORKERS > 0:
+        return WHISPERX_WORKERS
+    if WHISPERX_BACKEND == "cli":
+        return 1
+    return len(model_pool.devices)
+
+scheduler = JobScheduler(default_worker_count(), MAX_QUEUE_SIZE, SCHEDULER_POLICY)
+
+class JobStore:
+    """
+    Durable copy of the jobs dict in SQLite (WAL mode), so queued, running and finished
+    jobs survive a restart. The dict stays the live view; a job's row is rewritten
+    whenever it is submitted, started or finished. Progress and events are not stored,
+    and neither is the HuggingFace token in args; recover_jobs puts back the server's.
+    """
+    COLUMNS = ("status", "user_id", "duration", "submitted_at", "started_at", "finished_at", "transcript_path", "error", "timings", "cached", "cache_key", "callback_url", "trace_id", "profile", "args")
+    JSON_COLUMNS = ("timings", "profile", "args")
+    def __init__(self, path):
+        self.lock = threading.Lock()
+        self.conn = sqlite3.connect(path, check_same_thread=False, isolation_level=None)
+        self.conn.execute("PRAGMA journal_mode=WAL")
+        self.conn.execute("PRAGMA synchronous=NORMAL")
+        self.conn.execute(
+            "CREATE TABLE IF NOT EXISTS jobs (job_id TEXT PRIMARY KEY, status TEXT NOT NULL, user_id TEXT, duration REAL,"
+            " submitted_at REAL, started_at REAL, finished_at REAL, transcript_path TEXT, error TEXT, timings TEXT,"
+            " cached INTEGER, cache_key TEXT, callback_url TEXT, trace_id TEXT, profile TEXT, args TEXT)"
+        )
+        columns = {row[1] for row in self.conn.execute("PRAGMA table_info(jobs)")}
+        for column in ("trace_id", "profile"):
+            if column not in columns:
+                self.conn.execute(f"ALTER TABLE jobs ADD COLUMN {column} TEXT")
+        self.conn.execute("CREATE INDEX IF NOT EXISTS jobs_status ON jobs (status)")
+        self.conn.execute("CREATE INDEX IF NOT EXISTS jobs_user ON jobs (user_id)")
+        # Rows written before tokens were left out still hold one.
+        self.conn.execute("UPDATE jobs SET args = json_set(args, '$[5]', NULL) WHERE json_extract(args, '$[5]') IS NOT NULL")
+    @staticmethod
+    def encode(column, value):
+        if column == "args" and value:
+            value = list(value[:5]) + [None]
+        return json.dumps(value)
+    def save(self, job_id):
+        with self.lock:
+            job = jobs.get(job_id)
+            if job is None:
+                return
+            values = [self.encode(c, job.get(c)) if c in self.JSON_COLUMNS else job.get(c) for c in self.COLUMNS]
+            self.conn.execute(
+                f"INSERT OR REPLACE INTO jobs (job_id, {', '.join(self.COLUMNS)}) VALUES ({', '.join('?' * (len(self.COLUMNS) + 1))})",
+                [job_id] + values,
+            )
+    def delete(self, job_id):
+        with self.lock:
+            self.conn.execute("DELETE FROM jobs WHERE job_id = ?", (job_id,))
+    def load(self, max_age):
+        """Drop finished jobs older than max_age and return the rest as {job_id: job}."""
+        with self.lock:
+            self.conn.execute("DELETE FROM jobs WHERE status IN ('done', 'error') AND finished_at < ?", (time.time() - max_age,))
+            rows = self.conn.execute(f"SELECT job_id, {', '.join(self.COLUMNS)} FROM jobs ORDER BY submitted_at").fetchall()
+        loaded = {}
+        for job_id, *values in rows:
+            job = dict(zip(self.COLUMNS, values))
+            for c in self.JSON_COLUMNS:
+                job[c] = json.loads(job[c]) if job[c] else None
+            job["cached"] = bool(job["cached"])
+            job["events"] = []
+            loaded[job_id] = job
+        return loaded
+
+job_store = JobStore(JOBS_DB)
+
+class TranscriptCache:
+    """
+    Finished transcripts keyed by audio hash and job parameters. Entries live in their
+    own directory with a JSON index; entries older than max_age are dropped and the
+    least recently used ones are evicted once the total size exceeds max_bytes.
+    """
+    def __init__(self, directory, max_bytes, max_age):
+        self.directory = directory
+        self.max_bytes = max_bytes
+        self.max_age = max_age
+        self.index_path = os.path.join(directory, "index.json")
+        self.lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+        os.makedirs(directory, exist_ok=True)
+        try:
+            with open(self.index_path) as f:
+                self.index = json.load(f)
+        except (OSError, ValueError):
+            self.index = {}
+    @staticmethod
+    def make_key(audio_sha256, model, language, min_speakers, max_speakers):
+        params = f"{audio_sha256}|{model}|{language}|{min_speakers}|{max_speakers}"
+        return hashlib.sha256(params.encode()).hexdigest()
+    def _save_index(self):
+        tmp_path = self.index_path + ".tmp"
+        with open(tmp_path, "w") as f:
+            json.dump(self.index, f)
+        os.replace(tmp_path, self.index_path)
+    def _remove(self, key):
+        entry = self.index.pop(key)
+        for name in entry["files"].values():
+            try:
+                os.remove(os.path.join(self.directory, name))
+            except FileNotFoundError:
+                pass
+    def get(self, key):
+        """Return {kind: path} for a cached entry, or None."""
+        with self.lock:
+            entry = self.index.get(key)
+            if entry is None or time.time() - entry["created"] > self.max_age:
+                self.misses += 1
+                return None
+            entry["last_used"] = time.time()
+            self._save_index()
+            self.hits += 1
+            return {kind: os.path.join(self.directory, name) for kind, name in entry["files"].items()}
+    def put(self, key, paths):
+        with self.lock:
+            if key in self.index:
+                self._remove(key)
+            files = {}
+            size = 0
+            for kind, path in paths.items():
+                name = f"{key}.{kind}"
+                shutil.copyfile(path, os.path.join(self.directory, name))
+                files[kind] = name
+                size += os.path.getsize(path)
+            now = time.time()
+            self.index[key] = {"files": files, "size": size, "created": now, "last_used": now}
+            self._evict()
+            self._save_index()
+    def _evict(self):
+        now = time.time()
+        for key in [k for k, e in self.index.items() if now - e["created"] > self.max_age]:
+            self._remove(key)
+        total = sum(e["size"] for e in self.index.values())
+        for key in sorted(self.index, key=lambda k: self.index[k]["last_used"]):
+            if total <= self.max_bytes:
+                break
+            total -= self.index[key]["size"]
+            self._remove(key)
+    def stats(self):
+        with self.lock:
+            return {
+                "entries": len(self.index),
+                "bytes": sum(e["size"] for e in self.index.values()),
+                "hits": self.hits,
+                "misses": self.misses,
+            }
+
+transcript_cache = TranscriptCache(CACHE_DIR, CACHE_MAX_BYTES, CACHE_MAX_AGE_DAYS * 86400)
+
+def run_sharded(job_id, slots, profile, audio, points, min_speakers, max_speakers, language, hf_token):
+    """
+    Process audio cut at points as independent shards, one per slot at a time, then merge
+    them with shifted timestamps and speakers reconciled across shards.
+    """
+    bounds = [0] + points + [len(audio)]
+    shards = queue.Queue()
+    for index, (start, end) in enumerate(zip(bounds, bounds[1:])):
+        shards.put((index, start, end))
+    results = [None] * (len(bounds) - 1)
+    errors = []
+    def work(slot):
+        while not errors:
+            try:
+                index, start, end = shards.get_nowait()
+            except queue.Empty:
+                return
+            offset = start / SAMPLE_RATE
+            try:
+                # A speaker may be silent for a whole shard, so the job's min_speakers would
+                # force phantom clusters that reconciliation then maps onto real speakers.
+                result, timings, embeddings = slot.run(profile, audio[start:end], 1, max_speakers, language, hf_token,
+                                                       on_segments=lambda segments: publish_segments(job_id, shift_segments(segments, offset)))
+            except Exception as e:
+                errors.append(e)
+                return
+            results[index] = (offset, result, timings, embeddings)
+            report_progress(job_id, "transcribing", 0.05 + 0.85 * sum(r is not None for r in results) / len(results))
+            log(f"[Job {job_id}] Shard {index + 1}/{len(results)} done on {slot.device}")
+    threads = [threading.Thread(target=work, args=(slot,)) for slot in slots[1:]]
+    for t in threads:
+        t.start()
+    work(slots[0])
+    for t in threads:
+        t.join()
+    if errors:
+        raise errors[0]
+    # Stage times are summed over shards, i.e. device time rather than wall time.
+    timings = {"load": 0.0, "inference": 0.0, "transcribe": 0.0, "align": 0.0, "diarize": 0.0, "shards": len(results)}
+    for _, _, shard_timings, _ in results:
+        for stage in ("load", "inference", "transcribe", "align", "diarize"):
+            timings[stage] += shard_timings[stage]
+    segments = []
+    if all(embeddings is not None for _, _, _, embeddings in results):
+        mappings = reconcile_speakers([embeddings for _, _, _, embeddings in results], int(max_speakers))
+        for (offset, result, _, _), mapping in zip(results, mappings):
+            for segment in shift_segments(result["segments"], offset):
+                if "speaker" in segment:
+                    segment["speaker"] = mapping.get(segment["speaker"], segment["speaker"])
+                for word in segment.get("words", []):
+                    if "speaker" in word:
+                        word["speaker"] = mapping.get(word["speaker"], word["speaker"])
+                segments.append(segment)
+        return {"segments": segments}, timings
+    # Without embeddings, labels from different shards cannot be matched: diarize the
+    # whole recording once instead.
+    for offset, result, _, _ in results:
+        segments.extend(shift_segments(result["segments"], offset))
+    if not profile["diarize"] or slots[0].diarize_model is None:
+        return {"segments": segments}, timings
+    report_progress(job_id, "diarizing", 0.9)
+    slot = slots[0]
+    started = time.monotonic()
+    result, _ = slot.runtime.diarize(slot.diarize_model, audio, int(min_speakers), int(max_speakers), {"segments": segments})
+    timings["diarize"] += time.monotonic() - started
+    timings["inference"] += time.monotonic() - started
+    return result, timings
+
+def run_on_pool(job_id, slot, profile, file_path, min_speakers, max_speakers, language, hf_token):
+    """
+    Run a job on slot. Long recordings are sharded across slot and any other idle slots.
+    """
+    # The only decode of the upload: every stage and shard below works on this array.
+    started = time.monotonic()
+    audio = slot.runtime.load_audio(file_path)
+    decode = time.monotonic() - started
+    log(f"[Job {job_id}] Decoded {os.path.getsize(file_path)} bytes into {len(audio) / SAMPLE_RATE:.0f}s of audio in {decode:.2f}s")
+    points = find_split_points(audio, SHARD_SECONDS) if SHARD_SECONDS > 0 else []
+    extra = model_pool.acquire_idle(len(points)) if points else []
+    try:
+        if extra:
+            log(f"[Job {job_id}] Sharding {len(audio) / SAMPLE_RATE:.0f}s of audio into {len(points) + 1} shards on {len(extra) + 1} devices")
+            result, timings = run_sharded(job_id, [slot] + extra, profile, audio, points, min_speakers, max_speakers, language, hf_token)
+        else:
+            result, timings, _ = slot.run(profile, audio, min_speakers, max_speakers, language, hf_token,
+                                          lambda stage, progress: report_progress(job_id, stage, progress),
+                                          lambda segments: publish_segments(job_id, segments))
+        timings["decode"] = decode
+        return result, timings
+    finally:
+        model_pool.release(extra)
+
+def compact_segment(segment):
+    """
+    One transcript line: times in seconds rounded to milliseconds, the speaker if known,
+    and words as [word, start, end, score] lists, with the word's speaker appended
+    when it differs from the segment's. Unaligned words have no times.
+    """
+    speaker = segment.get("speaker")
+    line = {"start": round(segment["start"], 3), "end": round(segment["end"], 3), "text": segment["text"].strip()}
+    if speaker is not None:
+        line["speaker"] = speaker
+    words = []
+    for word in segment.get("words", []):
+        entry = [word.get("word", "").strip(), round(word["start"], 3) if "start" in word else None,
+                 round(word["end"], 3) if "end" in word else None, round(word["score"], 3) if word.get("score") is not None else None]
+        if word.get("speaker", speaker) != speaker:
+            entry.append(word["speaker"])
+        words.append(entry)
+    if words:
+        line["words"] = words
+    return line
+
+def write_transcript_jsonl(result, transcript_path):
+    """Write the transcript as JSON Lines, one compact segment per line; every format is rendered from it."""
+    with open(transcript_path, "w") as f:
+        for segment in result["segments"]:
+            f.write(json.dumps(compact_segment(segment), ensure_ascii=False, separators=(",", ":")) + "\n")
+
+def iter_transcript_jsonl(transcript_path):
+    with open(transcript_path) as f:
+        for line in f:
+            if line.strip():
+                yield json.loads(line)
+
+def format_timestamp(seconds, separator):
+    milliseconds = int(round(seconds * 1000))
+    hours, milliseconds = divmod(milliseconds, 3600000)
+    minutes, milliseconds = divmod(milliseconds, 60000)
+    seconds, milliseconds = divmod(milliseconds, 1000)
+    return f"{hours:02d}:{minutes:02d}:{seconds:02d}{separator}{milliseconds:03d}"
+
+def render_transcript(segments, fmt):
+    """
+    Render JSON Lines segments as "txt" ([speaker]: text per segment), "srt" or "vtt".
+    Yields the text one entry at a time, so segments can be a generator over the file.
+    """
+    if fmt == "vtt":
+        yield "WEBVTT\n\n"
+    for index, segment in enumerate(segments, 1):
+        speaker = segment.get("speaker")
+        if fmt == "txt":
+            yield (f"[{speaker}]: {segment['text']}" if speaker is not None else segment["text"]) + "\n"
+            continue
+        separator = "," if fmt == "srt" else "."
+        cue = f"{format_timestamp(segment['start'], separator)} --> {format_timestamp(segment['end'], separator)}"
+        if fmt == "srt":
+            text = f"[{speaker}]: {segment['text']}" if speaker is not None else segment["text"]
+            yield f"{index}\n{cue}\n{text}\n\n"
+        else:
+            text = f"<v {speaker}>{segment['text']}" if speaker is not None else segment["text"]
+            yield f"{cue}\n{text}\n\n"
+
+def iter_transcript_body(transcript_path, fmt):
+    """Bytes of the transcript in fmt, read from its JSON Lines file in TRANSCRIPT_STREAM_CHUNK pieces."""
+    if fmt == "jsonl":
+        with open(transcript_path, "rb") as f:
+            yield from iter(lambda: f.read(TRANSCRIPT_STREAM_CHUNK), b"")
+        return
+    buffer = []
+    size = 0
+    for text in render_transcript(iter_transcript_jsonl(transcript_path), fmt):
+        buffer.append(text)
+        size += len(text)
+        if size >= TRANSCRIPT_STREAM_CHUNK:
+            yield "".join(buffer).encode()
+            buffer, size = [], 0
+    if buffer:
+        yield "".join(buffer).encode()
+
+def compress_stream(chunks, encoding):
+    """Compress chunks incrementally with "zstd" or "gzip", counting the bytes sent."""
+    if encoding == "zstd":
+        compressor = zstandard.ZstdCompressor(level=TRANSCRIPT_COMPRESS_LEVEL).compressobj()
+    elif encoding == "gzip":
+        compressor = zlib.compressobj(TRANSCRIPT_COMPRESS_LEVEL, zlib.DEFLATED, 16 + zlib.MAX_WBITS)
+    else:
+        compressor = None
+    for chunk in chunks:
+        if compressor is not None:
+            chunk = compressor.compress(chunk)
+        if chunk:
+            metrics.inc("whisperx_transcript_bytes_total", len(chunk))
+            yield chunk
+    if compressor is not None:
+        chunk = compressor.flush()
+        metrics.inc("whisperx_transcript_bytes_total", len(chunk))
+        yield chunk
+
+def run_whisperx_cli(job_id, profile, file_path, min_speakers, max_speakers, language, hf_token):
+    """Run the whisperx command, again with half the batch size whenever it runs out of memory."""
+    while True:
+        returncode, out_of_memory = run_whisperx_cli_once(job_id, profile, file_path, min_speakers, max_speakers, language, hf_token)
+        if returncode == 0 or not out_of_memory or profile["batch_size"] <= 1:
+            return
+        profile["batch_size"] //= 2
+        metrics.inc("whisperx_oom_retries_total", device="cli")
+        log(f"[Job {job_id}] WhisperX ran out of memory, retrying with batch size {profile['batch_size']}")
+
+def run_whisperx_cli_once(job_id, profile, file_path, min_speakers, max_speakers, language, hf_token):
+    os.environ["TORCH_DYNAMO_DISABLE"] = "1"
+    os.environ["NVIDIA_TF32_OVERRIDE"] = "1"
+    cmd = [
+        "whisperx",
+        file_path,
+        "--hf_token", hf_token,
+        "--model", profile["model"],
+    ]
+    if profile["diarize"]:
+        cmd += ["--diarize"]
+    cmd += [
+        "--min_speakers", str(min_speakers),
+        "--max_speakers", str(max_speakers),
+        "--compute_type", profile["compute_type"],
+        "--batch_size", str(profile["batch_size"]),
+        "--language", language
+    ]
+    log(f"[Job {job_id}] Running command: {' '.join(cmd)}")
+    process = subprocess.Popen(cmd, stdout=subprocess.PIPE, stderr=subprocess.PIPE, text=True, cwd=FILES_DIR, bufsize=1)
+    out_of_memory = []
+    def stream_output(stream, label):
+        for line in iter(stream.readline, ''):
+            log(f"[Job {job_id}][{label}]: {line.rstrip()}")
+            if is_out_of_memory(line):
+                out_of_memory.append(line)
+        stream.close()
+    t_stdout = threading.Thread(target=stream_output, args=(process.stdout, 'stdout'))
+    t_stderr = threading.Thread(target=stream_output, args=(process.stderr, 'stderr'))
+    t_stdout.start()
+    t_stderr.start()
+    t_stdout.join()
+    t_stderr.join()
+    process.wait()
+    log(f"[Job {job_id}] WhisperX process exited with code {process.returncode}")
+    return process.returncode, bool(out_of_memory)
+
+def start_job(job_id):
+    """Mark a job running. Returns the seconds it spent queued."""
+    job = jobs[job_id]
+    job["status"] = "running"
+    job_store.save(job_id)
+    publish_event(job_id, "running")
+    return (job.get("started_at") or time.time()) - (job.get("submitted_at") or time.time())
+
+def write_result(job_id, result, timings, transcript_path):
+    started = time.monotonic()
+    write_transcript_jsonl(result, transcript_path)
+    timings["write"] = time.monotonic() - started
+    record_timings(job_id, timings)
+    log(f"[Job {job_id}] Timings: load={timings['load']:.2f}s inference={timings['inference']:.2f}s")
+
+def deliver_transcript(job_id, transcript_path):
+    if os.path.exists(transcript_path):
+        log(f"[Job {job_id}] Transcript found: {transcript_path}")
+        try:
+            transcript_cache.put(jobs[job_id]["cache_key"], {"jsonl": transcript_path})
+        except OSError as e:
+            log(f"[Job {job_id}] Could not cache transcript: {e}")
+        finish_job(job_id, "done", transcript_path=transcript_path)
+    else:
+        log(f"[Job {job_id}] Transcript not found.")
+        finish_job(job_id, "error", "Transcript not found")
+
+def run_whisperx_batch(job_ids):
+    """
+    Run short jobs that share a model and language with one transcription pass. Their
+    audio is joined with BATCH_GAP_SECONDS of silence, so the VAD segments of all jobs
+    fill the same ASR batches without any segment spanning two jobs, and the segments
+    are split back by offset. Alignment, diarization and transcripts stay per job.
+    """
+    import numpy as np
+    log(f"[Batch] Transcribing {len(job_ids)} jobs together: {', '.join(job_ids)}")
+    queued = {job_id: start_job(job_id) for job_id in job_ids}
+    # batch_key keeps jobs with different tokens apart, so the first job's is everyone's.
+    language, hf_token = jobs[job_ids[0]]["args"][4], jobs[job_ids[0]]["args"][5]
+    # Batched jobs share a model and compute type; diarization stays each job's own choice.
+    profile = jobs[job_ids[0]]["profile"]
+    try:
+        with model_pool.acquire() as slot:
+            load = slot.load(hf_token, {}, dict(profile, diarize=any(jobs[j]["profile"]["diarize"] for j in job_ids))).get("load", 0.0)
+            audios = {}
+            decode = {}
+            for job_id in job_ids:
+                started = time.monotonic()
+                audios[job_id] = slot.runtime.load_audio(jobs[job_id]["args"][0])
+                decode[job_id] = time.monotonic() - started
+                report_progress(job_id, "transcribing", 0.05)
+            gap = np.zeros(int(BATCH_GAP_SECONDS * SAMPLE_RATE), dtype=np.float32)
+            offsets = []
+            position = 0
+            for job_id in job_ids:
+                offsets.append(position / SAMPLE_RATE)
+                position += len(audios[job_id]) + len(gap)
+            started = time.monotonic()
+            combined = np.concatenate([part for job_id in job_ids for part in (audios[job_id], gap)])
+            segments = {job_id: [] for job_id in job_ids}
+            for segment in slot.transcribe(profile, combined, language)["segments"]:
+                index = max(bisect.bisect_right(offsets, segment["start"]) - 1, 0)
+                segments[job_ids[index]].append(segment)
+            transcribe = time.monotonic() - started
+            del combined
+            for index, job_id in enumerate(job_ids):
+                try:
+                    job_segments = shift_segments(segments[job_id], -offsets[index])
+                    publish_segments(job_id, job_segments)
+                    # Every job waited for the whole shared pass; loading is charged to the first.
+                    timings = {"load": load if index == 0 else 0.0, "decode": decode[job_id], "transcribe": transcribe,
+                               "align": 0.0, "diarize": 0.0, "queue": queued[job_id], "batch": len(job_ids)}
+                    args = jobs[job_id]["args"]
+                    jobs[job_id]["profile"]["batch_size"] = profile["batch_size"]
+                    result, _ = slot.align_and_diarize(jobs[job_id]["profile"], audios.pop(job_id), job_segments, language, args[2], args[3], timings,
+                                                       lambda stage, progress, job_id=job_id: report_progress(job_id, stage, progress))
+                    write_result(job_id, result, timings, args[1])
+                    deliver_transcript(job_id, args[1])
+                except Exception as e:
+                    import traceback
+                    log(f"[Job {job_id}] Exception: {''.join(traceback.format_exception(type(e), e, e.__traceback__))}")
+                    finish_job(job_id, "error", str(e))
+    except Exception as e:
+        import traceback
+        log(f"[Batch] Exception: {''.join(traceback.format_exception(type(e), e, e.__traceback__))}")
+        for job_id in job_ids:
+            if jobs[job_id]["status"] == "running":
+                finish_job(job_id, "error", str(e))
+    finally:
+        log(f"[Batch] Finished {len(job_ids)} jobs.")
+
 def run_whisperx_job(job_id, file_path, transcript_path, min_speakers, max_speakers, language, hf_token):
     log(f"[Job {job_id}] Thread started.")
-    
+
     try:
         import torch
         log(f"[Job {job_id}] torch.cuda.is_available(): {torch.cuda.is_available()}")
@@ -30,84 +1346,351 @@ def run_whisperx_job(job_id, file_path, transcript_path, min_speakers, max_speak
             log(f"[Job {job_id}] torch.cuda.get_device_name(): {torch.cuda.get_device_name(torch.cuda.current_device())}")
     except Exception as e:
         log(f"[Job {job_id}] Could not import torch or get CUDA info: {e}")
-    jobs[job_id]["status"] = "running"
+    queued = start_job(job_id)
+    profile = jobs[job_id]["profile"]
+    log(f"[Job {job_id}] Profile {describe_profile(profile)}")
     try:
-        os.environ["TORCH_DYNAMO_DISABLE"] = "1"
-        os.environ["NVIDIA_TF32_OVERRIDE"] = "1"
-        cmd = [
-            "whisperx",
-            file_path,
-            "--hf_token", hf_token,
-            "--model", WHISPERX_MODEL,
-            "--diarize",
-            "--min_speakers", str(min_speakers),
-            "--max_speakers", str(max_speakers),
-            "--compute_type", "float32",
-            "--batch_size", "64",
-            "--language", language
-        ]
-        log(f"[Job {job_id}] Running command: {' '.join(cmd)}")
-        process = subprocess.Popen(cmd, stdout=subprocess.PIPE, stderr=subprocess.PIPE, text=True, cwd=FILES_DIR, bufsize=1)
-        def stream_output(stream, label):
-            for line in iter(stream.readline, ''):
-                log(f"[Job {job_id}][{label}]: {line.rstrip()}")
-            stream.close()
-        t_stdout = threading.Thread(target=stream_output, args=(process.stdout, 'stdout'))
-        t_stderr = threading.Thread(target=stream_output, args=(process.stderr, 'stderr'))
-        t_stdout.start()
-        t_stderr.start()
-        t_stdout.join()
-        t_stderr.join()
-        process.wait()
-        log(f"[Job {job_id}] WhisperX process exited with code {process.returncode}")
-        if os.path.exists(transcript_path):
-            log(f"[Job {job_id}] Transcript found: {transcript_path}")
-            jobs[job_id]["status"] = "done"
-            jobs[job_id]["transcript_path"] = transcript_path
+        if WHISPERX_BACKEND == "cli":
+            report_progress(job_id, "transcribing", 0.0)
+            started = time.monotonic()
+            run_whisperx_cli(job_id, profile, file_path, min_speakers, max_speakers, language, hf_token)
+            # The CLI writes <name>.json next to the upload, among other formats.
+            cli_json = file_path.rsplit(".audio", 1)[0] + ".json"
+            if os.path.exists(cli_json):
+                with open(cli_json) as f:
+                    write_transcript_jsonl(json.load(f), transcript_path)
+            # The CLI does everything in one process, so its whole run counts as transcription.
+            record_timings(job_id, {"queue": queued, "transcribe": time.monotonic() - started})
         else:
-            log(f"[Job {job_id}] Transcript not found.")
-            jobs[job_id]["status"] = "error"
-            jobs[job_id]["error"] = "Transcript not found"
+            with model_pool.acquire() as slot:
+                log(f"[Job {job_id}] Running on {slot.device}")
+                result, timings = run_on_pool(job_id, slot, profile, file_path, min_speakers, max_speakers, language, hf_token)
+            timings["queue"] = queued
+            write_result(job_id, result, timings, transcript_path)
+        deliver_transcript(job_id, transcript_path)
     except Exception as e:
         import traceback
         err_str = ''.join(traceback.format_exception(type(e), e, e.__traceback__))
         log(f"[Job {job_id}] Exception: {err_str}")
-        jobs[job_id]["status"] = "error"
-        jobs[job_id]["error"] = str(e)
+        finish_job(job_id, "error", str(e))
     finally:
         log(f"[Job {job_id}] Thread finished.")
 log("WhisperX remote server starting up...")
+def queue_full_response(retry_after):
+    log(f"Job queue full, asking client to retry after {retry_after}s.")
+    metrics.inc("whisperx_jobs_rejected_total")
+    return jsonify({"error": "Job queue is full", "retry_after": retry_after}), 429, {"Retry-After": str(retry_after)}
+
+def submit_job(file_path, form, audio_sha256):
+    """
+    Queue a job for an audio file already on disk, or complete it at once from the
+    transcript cache. Raises QueueFull, leaving the file in place.
+    """
+    min_speakers = form.get("min_speakers", "1")
+    max_speakers = form.get("max_speakers", min_speakers)
+    language = form.get("language", "en")
+    hf_token = form.get("HF_TOKEN", HF_TOKEN)
+    user_id = form.get("user_id", request.remote_addr)
+    callback_url = form.get("callback_url")
+    trace_id = form.get("trace_id") or uuid.uuid4().hex[:16]
+    log(f"[trace {trace_id}] Received request: min_speakers={min_speakers}, max_speakers={max_speakers}, language={language}, profile={form.get('profile') or 'auto'}, file={file_path}")
+    transcript_path = file_path.rsplit(".audio", 1)[0] + ".jsonl"
+    job_id = str(uuid.uuid4())
+    duration = client_duration(form) or probe_duration(file_path)
+    profile = choose_profile(duration, max_speakers, language, form.get("profile"))
+    cache_key = TranscriptCache.make_key(audio_sha256, f"{profile['model']}/{profile['compute_type']}", language, min_speakers, max_speakers)
+    cached = transcript_cache.get(cache_key)
+    # Entries from before structured transcripts only have a .txt and are recomputed.
+    if cached and "jsonl" in cached:
+        shutil.copyfile(cached["jsonl"], transcript_path)
+        jobs[job_id] = {"status": "pending", "transcript_path": None, "error": None, "timings": None, "cached": True, "user_id": user_id, "submitted_at": time.time(), "callback_url": callback_url, "trace_id": trace_id, "profile": profile, "events": []}
+        finish_job(job_id, "done", transcript_path=transcript_path)
+        log(f"Job {job_id} served from cache {cache_key[:12]} ({transcript_cache.stats()}).")
+        return job_id
+    jobs[job_id] = {
+        "status": "pending",
+        "transcript_path": None,
+        "error": None,
+        "timings": None,
+        "user_id": user_id,
+        "duration": duration,
+        "submitted_at": time.time(),
+        "started_at": None,
+        "cache_key": cache_key,
+        "callback_url": callback_url,
+        "trace_id": trace_id,
+        "profile": profile,
+        "events": [],
+        "args": (file_path, transcript_path, min_speakers, max_speakers, language, hf_token),
+    }
+    job_store.save(job_id)
+    try:
+        scheduler.submit(job_id)
+    except QueueFull:
+        del jobs[job_id]
+        job_store.delete(job_id)
+        raise
+    metrics.inc("whisperx_jobs_submitted_total")
+    log(f"[trace {trace_id}] Job {job_id} queued (duration={duration:.1f}s, user={user_id}, profile={describe_profile(profile)}).")
+    return job_id
+
+def audio_file_path(filename):
+    return os.path.join(FILES_DIR, f"{datetime.now().strftime('%Y%m%d%H%M%S')}_{os.path.basename(filename)}")
+
+@app.route("/healthz", methods=["GET"])
+def healthz():
+    ready = WHISPERX_BACKEND == "cli" or model_pool.ready
+    body = {
+        "ready": ready,
+        "backend": WHISPERX_BACKEND,
+        "models_loaded": len(model_pool.slots),
+        "devices": model_pool.devices,
+        "error": model_pool.load_error,
+    }
+    body.update(scheduler.stats())
+    return jsonify(body), 200 if ready else 503
+
+@app.route("/metrics", methods=["GET"])
+def metrics_endpoint():
+    return Response(metrics.render(), mimetype="text/plain; version=0.0.4")
+
 @app.route("/run_whisperx", methods=["POST"])
 def run_whisperx():
     log("/run_whisperx endpoint called.")
-    
+    if scheduler.is_full():
+        return queue_full_response(scheduler.retry_after())
+
     audio = request.files.get("audio")
-    speakers = request.form.get("speakers", "1")
-    min_speakers = request.form.get("min_speakers", "1")
-    max_speakers = request.form.get("max_speakers", min_speakers)
-    language = request.form.get("language", "en")
-    hf_token = request.form.get("HF_TOKEN", HF_TOKEN)
-    log(f"Received request: min_speakers={min_speakers}, max_speakers={max_speakers}, language={language}, file={audio.filename if audio else None}")
     if not audio:
         log("No audio file uploaded.")
         return jsonify({"error": "No audio file uploaded"}), 400
-    fname = f"{datetime.now().strftime('%Y%m%d%H%M%S')}_{audio.filename}"
-    file_path = os.path.join(FILES_DIR, fname)
+    file_path = audio_file_path(audio.filename)
     audio.save(file_path)
+    metrics.inc("whisperx_upload_bytes_total", os.path.getsize(file_path))
     log(f"Audio saved to {file_path}")
-    transcript_path = file_path.rsplit(".audio", 1)[0] + ".txt"
-    job_id = str(uuid.uuid4())
-    jobs[job_id] = {"status": "pending", "transcript_path": None, "error": None}
-    t = threading.Thread(target=run_whisperx_job, args=(job_id, file_path, transcript_path, min_speakers, max_speakers, language, hf_token))
-    t.start()
-    log(f"Job {job_id} started in background.")
+    try:
+        job_id = submit_job(file_path, request.form, file_sha256(file_path))
+    except QueueFull as e:
+        os.remove(file_path)
+        return queue_full_response(e.retry_after)
     return jsonify({"job_id": job_id}), 202
+
+def upload_paths(upload_id):
+    try:
+        upload_id = str(uuid.UUID(upload_id))
+    except ValueError:
+        return None, None
+    return os.path.join(UPLOADS_DIR, f"{upload_id}.part"), os.path.join(UPLOADS_DIR, f"{upload_id}.json")
+
+upload_locks = {}
+upload_locks_guard = threading.Lock()
+
+def upload_lock(upload_id):
+    """Serializes finalizing and removing one upload, so a retried finalize cannot race the first."""
+    with upload_locks_guard:
+        return upload_locks.setdefault(upload_id, threading.Lock())
+
+def cleanup_uploads(max_age):
+    """Remove upload files not written to for max_age seconds: abandoned uploads and finalize records."""
+    cutoff = time.time() - max_age
+    removed = 0
+    for entry in os.scandir(UPLOADS_DIR):
+        upload_id = entry.name.rsplit(".", 1)[0]
+        with upload_lock(upload_id):
+            try:
+                if entry.stat().st_mtime < cutoff:
+                    os.remove(entry.path)
+                    removed += 1
+            except FileNotFoundError:
+                pass
+            stale = not os.path.exists(os.path.join(UPLOADS_DIR, f"{upload_id}.part")) and not os.path.exists(os.path.join(UPLOADS_DIR, f"{upload_id}.json"))
+        if stale:
+            with upload_locks_guard:
+                upload_locks.pop(upload_id, None)
+    if removed:
+        log(f"Removed {removed} upload files older than {max_age / 3600:.1f}h.")
+
+def prune_jobs(max_age):
+    """Forget jobs that finished more than max_age seconds ago, in memory and in the job store."""
+    cutoff = time.time() - max_age
+    with job_events_cond:
+        expired = [job_id for job_id, job in list(jobs.items()) if job["status"] in ("done", "error") and (job.get("finished_at") or 0) < cutoff]
+        for job_id in expired:
+            del jobs[job_id]
+    for job_id in expired:
+        job_store.delete(job_id)
+    if expired:
+        log(f"Dropped {len(expired)} jobs finished more than {max_age / 86400:.1f} days ago.")
+
+def cleanup_loop():
+    while True:
+        try:
+            cleanup_uploads(UPLOAD_TTL_HOURS * 3600)
+        except OSError as e:
+            log(f"Upload cleanup failed: {e}")
+        prune_jobs(JOB_RETENTION_DAYS * 86400)
+        time.sleep(CLEANUP_INTERVAL)
+
+@app.route("/uploads", methods=["POST"])
+def create_upload():
+    """
+    Start a chunked upload. Chunks are sent with PUT /uploads/<id>?offset=N and the
+    upload is turned into a job by POST /uploads/<id>/finalize. Uploads are kept on
+    disk, so a client can ask GET /uploads/<id> for the offset and resume.
+    """
+    if scheduler.is_full():
+        return queue_full_response(scheduler.retry_after())
+    params = request.get_json(silent=True) or {}
+    upload_id = str(uuid.uuid4())
+    part_path, meta_path = upload_paths(upload_id)
+    meta = {"filename": params.get("filename", f"{upload_id}.audio"), "size": params.get("size")}
+    with open(meta_path, "w") as f:
+        json.dump(meta, f)
+    open(part_path, "wb").close()
+    log(f"Upload {upload_id} created for {meta['filename']} ({meta['size']} bytes).")
+    return jsonify({"upload_id": upload_id, "offset": 0}), 201
+
+@app.route("/uploads/<upload_id>", methods=["GET"])
+def upload_status(upload_id):
+    part_path, meta_path = upload_paths(upload_id)
+    if not part_path or not os.path.exists(part_path):
+        return jsonify({"error": "Upload not found"}), 404
+    with open(meta_path) as f:
+        meta = json.load(f)
+    return jsonify({"upload_id": upload_id, "offset": os.path.getsize(part_path), "size": meta.get("size")})
+
+@app.route("/uploads/<upload_id>", methods=["PUT"])
+def upload_chunk(upload_id):
+    part_path, _ = upload_paths(upload_id)
+    if not part_path or not os.path.exists(part_path):
+        return jsonify({"error": "Upload not found"}), 404
+    current = os.path.getsize(part_path)
+    offset = request.args.get("offset", type=int)
+    if offset != current:
+        return jsonify({"error": "Offset mismatch", "offset": current}), 409
+    with open(part_path, "ab") as f:
+        while True:
+            chunk = request.stream.read(UPLOAD_BUFFER_SIZE)
+            if not chunk:
+                break
+            f.write(chunk)
+            metrics.inc("whisperx_upload_bytes_total", len(chunk))
+    return jsonify({"upload_id": upload_id, "offset": os.path.getsize(part_path)})
+
+def file_sha256(path):
+    digest = hashlib.sha256()
+    with open(path, "rb") as f:
+        for chunk in iter(lambda: f.read(UPLOAD_BUFFER_SIZE), b""):
+            digest.update(chunk)
+    return digest.hexdigest()
+
+@app.route("/uploads/<upload_id>/finalize", methods=["POST"])
+def finalize_upload(upload_id):
+    """
+    Turn a complete upload into a job. The job id is kept with the upload, so finalizing
+    again, e.g. a retry after a lost response, returns the same job instead of failing.
+    """
+    part_path, meta_path = upload_paths(upload_id)
+    if not part_path:
+        return jsonify({"error": "Upload not found"}), 404
+    with upload_lock(upload_id):
+        return finalize_locked(upload_id, part_path, meta_path)
+
+def finalize_locked(upload_id, part_path, meta_path):
+    try:
+        with open(meta_path) as f:
+            meta = json.load(f)
+    except FileNotFoundError:
+        return jsonify({"error": "Upload not found"}), 404
+    if meta.get("job_id"):
+        log(f"Upload {upload_id} finalized again, returning its job {meta['job_id']}.")
+        return jsonify({"job_id": meta["job_id"]}), 202
+    if not os.path.exists(part_path):
+        return jsonify({"error": "Upload not found"}), 404
+    expected = request.form.get("sha256")
+    actual = file_sha256(part_path)
+    if expected and expected.lower() != actual:
+        log(f"Upload {upload_id} checksum mismatch: expected {expected}, got {actual}.")
+        return jsonify({"error": "Checksum mismatch", "sha256": actual, "offset": os.path.getsize(part_path)}), 422
+    file_path = audio_file_path(meta["filename"])
+    os.replace(part_path, file_path)
+    try:
+        job_id = submit_job(file_path, request.form, actual)
+    except QueueFull as e:
+        os.replace(file_path, part_path)
+        return queue_full_response(e.retry_after)
+    meta["job_id"] = job_id
+    with open(meta_path, "w") as f:
+        json.dump(meta, f)
+    log(f"Upload {upload_id} finalized to {file_path} ({os.path.getsize(file_path)} bytes).")
+    return jsonify({"job_id": job_id}), 202
+
 @app.route("/job_status/<job_id>", methods=["GET"])
 def job_status(job_id):
     job = jobs.get(job_id)
     if not job:
         return jsonify({"error": "Job not found"}), 404
-    return jsonify({"status": job["status"], "error": job["error"]})
+    status = {
+        "status": job["status"],
+        "error": job["error"],
+        "timings": job.get("timings"),
+        "cached": job.get("cached", False),
+        "stage": job.get("stage"),
+        "progress": job.get("progress"),
+        "trace_id": job.get("trace_id"),
+        "profile": job.get("profile"),
+    }
+    info = scheduler.queue_info(job_id)
+    if info:
+        position, start_in = info
+        status["queue_position"] = position
+        status["estimated_start_in"] = round(start_in, 1)
+        status["estimated_start"] = datetime.fromtimestamp(time.time() + start_in).isoformat(timespec="seconds")
+    return jsonify(status)
+@app.route("/job_events/<job_id>", methods=["GET"])
+def job_events(job_id):
+    """
+    Server-Sent Events stream of a job: "queued" (position changes), "running",
+    "progress" (stage and fraction done), "segments" (partial transcript before
+    alignment and diarization), and a final "done" or "error". Reconnecting
+    clients resume after the id in Last-Event-ID.
+    """
+    if job_id not in jobs:
+        return jsonify({"error": "Job not found"}), 404
+    start = request.headers.get("Last-Event-ID", type=int)
+    start = 0 if start is None else start + 1
+    def stream():
+        index = start
+        last_position = None
+        last_sent = time.monotonic()
+        while True:
+            with job_events_cond:
+                job = jobs.get(job_id)
+                if job is not None and index >= job.get("events_base", 0) + len(job["events"]):
+                    job_events_cond.wait(EVENTS_KEEPALIVE_SECONDS)
+                    job = jobs.get(job_id)
+                if job is None:
+                    return
+                # Events before events_base were dropped when the job finished.
+                base = job.get("events_base", 0)
+                index = max(index, base)
+                pending = job["events"][index - base:]
+            if pending:
+                last_sent = time.monotonic()
+            for event in pending:
+                yield f"id: {index}\nevent: {event['type']}\ndata: {json.dumps(event['data'])}\n\n"
+                index += 1
+                if event["type"] in ("done", "error"):
+                    return
+            info = scheduler.queue_info(job_id)
+            if info and info[0] != last_position:
+                last_position = info[0]
+                last_sent = time.monotonic()
+                yield f"event: queued\ndata: {json.dumps({'queue_position': info[0], 'estimated_start_in': round(info[1], 1)})}\n\n"
+            elif time.monotonic() - last_sent >= EVENTS_KEEPALIVE_SECONDS:
+                last_sent = time.monotonic()
+                yield ": keepalive\n\n"
+    return Response(stream_with_context(stream()), mimetype="text/event-stream", headers={"Cache-Control": "no-cache", "X-Accel-Buffering": "no"})
 @app.route("/get_transcript/<job_id>", methods=["GET"])
 def get_transcript(job_id):
     job = jobs.get(job_id)
@@ -115,8 +1698,70 @@ def get_transcript(job_id):
         return jsonify({"error": "Job not found"}), 404
     if job["status"] != "done" or not job["transcript_path"] or not os.path.exists(job["transcript_path"]):
         return jsonify({"error": "Transcript not ready"}), 400
-    
-    return send_file(job["transcript_path"], as_attachment=True, conditional=True)
+
+    fmt = request.args.get("format", "txt")
+    if fmt not in TRANSCRIPT_MIMETYPES:
+        return jsonify({"error": f"Unknown format '{fmt}'", "formats": list(TRANSCRIPT_MIMETYPES)}), 400
+    if not job["transcript_path"].endswith(".jsonl"):
+        # Finished before structured transcripts existed: only the plain text is there.
+        if fmt != "txt":
+            return jsonify({"error": "Only txt is available for this job", "formats": ["txt"]}), 404
+        metrics.inc("whisperx_transcript_bytes_total", os.path.getsize(job["transcript_path"]))
+        return send_file(job["transcript_path"], as_attachment=True, conditional=True)
+    # The body is streamed, so the size of the JSON Lines file, which rendered formats are
+    # about the size of or smaller, decides whether compressing is worth it.
+    encodings = ["zstd", "gzip"] if zstandard is not None else ["gzip"]
+    small = os.path.getsize(job["transcript_path"]) < TRANSCRIPT_COMPRESS_MIN_BYTES
+    encoding = None if small else request.accept_encodings.best_match(encodings)
+    body = compress_stream(iter_transcript_body(job["transcript_path"], fmt), encoding)
+    name = os.path.basename(job["transcript_path"]).rsplit(".", 1)[0] + f".{fmt}"
+    headers = {"Content-Disposition": f'attachment; filename="{name}"', "Vary": "Accept-Encoding"}
+    if encoding:
+        headers["Content-Encoding"] = encoding
+    return Response(body, mimetype=TRANSCRIPT_MIMETYPES[fmt], headers=headers)
+def recover_jobs():
+    """
+    Reload the job store after a restart. Finished jobs are served as before. Jobs cut
+    off mid-run are completed from the transcript cache when their work already made it
+    there, and queued again otherwise, ahead of the queue size limit.
+    """
+    counts = {"finished": 0, "cached": 0, "requeued": 0, "lost": 0}
+    for job_id, job in job_store.load(JOB_RETENTION_DAYS * 86400).items():
+        jobs[job_id] = job
+        if job["status"] in ("done", "error"):
+            job["events"].append({"type": job["status"], "data": {"error": job["error"]}})
+            counts["finished"] += 1
+            continue
+        # Jobs stored before execution profiles and structured transcripts existed get the
+        # profile they would get now and a .jsonl transcript.
+        job["profile"] = job.get("profile") or choose_profile(job["duration"] or 0, job["args"][3], job["args"][4])
+        if job["args"][1].endswith(".txt"):
+            job["args"] = [job["args"][0], job["args"][1][:-len(".txt")] + ".jsonl"] + list(job["args"][2:])
+        # The token the client sent is not stored; the server's own stands in for it.
+        job["args"] = list(job["args"][:5]) + [HF_TOKEN]
+        file_path, transcript_path = job["args"][:2]
+        cached = transcript_cache.get(job["cache_key"]) if job.get("cache_key") else None
+        if cached and "jsonl" in cached:
+            shutil.copyfile(cached["jsonl"], transcript_path)
+            finish_job(job_id, "done", transcript_path=transcript_path)
+            counts["cached"] += 1
+        elif not os.path.exists(file_path):
+            finish_job(job_id, "error", "Audio file was lost in a server restart")
+            counts["lost"] += 1
+        else:
+            job["status"] = "pending"
+            job["started_at"] = None
+            job_store.save(job_id)
+            scheduler.submit(job_id, force=True)
+            counts["requeued"] += 1
+    log(f"[JobStore] Recovered jobs: {counts}")
+
 if __name__ == "__main__":
-    log("Flask app running on 0.0.0.0:8000")
-    app.run(host="0.0.0.0", port=8000)
+    recover_jobs()
+    if WHISPERX_BACKEND != "cli":
+        log(f"Loading {WHISPERX_BACKEND} backend on devices: {', '.join(model_pool.devices)}")
+        model_pool.load_in_background()
+    scheduler.start()
+    threading.Thread(target=cleanup_loop, name="cleanup", daemon=True).start()
+    log(f"Flask app running on 0.0.0.0:{PORT}")
+    app.run(host="0.0.0.0", port=PORT, threaded=True)
@@ -0,0 +1,5 @@
+"""
+Load-test harness for wb.py and the WhisperX server. Telegram and RunPod are replaced by
+local fakes and the server runs its stub backend, so a run needs no network or GPU.
+Run with `python -m bench --help` from the repository root.
+"""
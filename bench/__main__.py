@@ -0,0 +1,267 @@
+"""
+End-to-end load test: scripted users talk to wb.py's real handler through a fake
+Telegram client, the bot starts fake RunPod pods that each boot a WhisperX server with
+its stub backend, and the run reports throughput, latency percentiles, event-loop lag
+and peak memory. Results can be saved as a baseline and later runs compared against it.
+
+    python -m bench --users 50 --audio-seconds 60 --save-baseline
+    python -m bench --users 50 --audio-seconds 60
+    python -m bench --users 20 --pods 3 --gpu-shortage 1 --crash-after 20
+"""
+import argparse
+import asyncio
+import json
+import os
+import resource
+import shutil
+import socket
+import sys
+import tempfile
+import time
+import types
+
+REPO_ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+DEFAULT_BASELINE = os.path.join(REPO_ROOT, "bench", "baseline.json")
+PASSWORD = "bench"
+# Metric, and whether a larger value is better.
+COMPARED_METRICS = [
+    ("throughput_jobs_per_min", True),
+    ("latency_p50", False),
+    ("latency_p95", False),
+    ("latency_p99", False),
+    ("loop_lag_p99_ms", False),
+    ("bot_peak_rss_mb", False),
+    ("server_peak_rss_mb", False),
+]
+PARAMETERS = ("users", "audio_seconds", "ramp", "cold_start", "model_load", "stub_rate", "stub_batch", "stub_max_batch", "profile", "devices", "max_queue", "pods",
+              "telegram_mbps", "relay", "no_stage")
+
+def free_port():
+    with socket.socket() as s:
+        s.bind(("127.0.0.1", 0))
+        return s.getsockname()[1]
+
+def percentile(values, q):
+    if not values:
+        return None
+    values = sorted(values)
+    position = (len(values) - 1) * q
+    lower = int(position)
+    upper = min(lower + 1, len(values) - 1)
+    return values[lower] + (values[upper] - values[lower]) * (position - lower)
+
+class LoopLagMonitor:
+    """Samples how late the event loop wakes a task sleeping for a fixed interval."""
+    def __init__(self, interval=0.05):
+        self.interval = interval
+        self.samples = []
+    async def run(self):
+        loop = asyncio.get_running_loop()
+        while True:
+            start = loop.time()
+            await asyncio.sleep(self.interval)
+            self.samples.append(loop.time() - start - self.interval)
+
+def make_config(args, endpoints, rest_url):
+    config = types.ModuleType("config")
+    config.API_ID = 0
+    config.API_HASH = "bench"
+    config.SESSION_NAME = "bench"
+    config.HF_TOKEN = "bench"
+    config.RUNPOD_API_KEY = "bench"
+    config.WHISPERX_ENDPOINTS = endpoints
+    config.RUNPOD_REST_URL = rest_url
+    config.BOT_PASSWORD = PASSWORD
+    config.POD_IDLE_GRACE = args.idle_grace
+    config.METRICS_PORT = 0
+    # The stub backend reads raw PCM, so the audio is uploaded as generated.
+    config.AUDIO_PREPROCESS = None
+    config.RELAY_UPLOAD = args.relay
+    config.RELAY_STAGE_TO_DISK = not args.no_stage
+    return config
+
+async def run_bench(args, workdir):
+    bot_dir = os.path.join(workdir, "bot")
+    os.makedirs(bot_dir)
+    # wb.py keeps its state under ./files and reads settings from a config module.
+    os.chdir(bot_dir)
+    server_ports = [free_port() for _ in range(args.pods)]
+    runpod_port = free_port()
+    endpoints = [{"url": f"http://127.0.0.1:{port}/", "pod_id": f"bench-pod-{i}"} for i, port in enumerate(server_ports)]
+    sys.modules["config"] = make_config(args, endpoints, f"http://127.0.0.1:{runpod_port}/v1")
+    sys.path.insert(0, REPO_ROOT)
+    import wb
+    from bench.runpod import FakePod, FakeRunPod
+    from bench.telegram import Conversation, FakeTelegramClient, default_script
+
+    if not args.verbose:
+        wb.log = lambda msg: None
+    client = FakeTelegramClient(download_rate=args.telegram_mbps * 1e6 / 8 if args.telegram_mbps else None)
+    wb.TelegramClient = lambda *a, **kw: client
+    pods = []
+    for i, port in enumerate(server_ports):
+        server_env = dict(
+            os.environ,
+            WHISPERX_BACKEND="stub",
+            WHISPERX_DEVICES=",".join(["cpu"] * args.devices),
+            FILES_DIR=os.path.join(workdir, f"server-{i}"),
+            PORT=str(port),
+            HF_TOKEN="bench",
+            MAX_QUEUE_SIZE=str(args.max_queue),
+            STUB_LOAD_SECONDS=str(args.model_load),
+            STUB_SECONDS_PER_AUDIO_SECOND=str(args.stub_rate),
+            STUB_SECONDS_PER_BATCH=str(args.stub_batch),
+            STUB_MAX_BATCH_SIZE=str(args.stub_max_batch),
+        )
+        # Only the first pod misbehaves, so the others show whether the bot fails over.
+        pods.append(FakePod(f"bench-pod-{i}", server_env, os.path.join(workdir, f"server-{i}.log"), args.cold_start,
+                            args.gpu_shortage if i == 0 else 0, args.crash_after if i == 0 else None))
+    runpod = FakeRunPod(pods)
+    await runpod.serve(runpod_port)
+    if args.script:
+        with open(args.script) as f:
+            script = json.load(f)
+    else:
+        script = default_script(PASSWORD, args.language, args.audio_seconds, profile=args.profile)
+
+    monitor = LoopLagMonitor()
+    monitor_task = asyncio.create_task(monitor.run())
+    bot_task = asyncio.create_task(wb.main())
+    while not client.handlers:
+        await asyncio.sleep(0.01)
+
+    async def user(index):
+        await asyncio.sleep(args.ramp * index / max(args.users - 1, 1))
+        return await Conversation(client, 1000 + index, script, timeout=args.timeout).run()
+
+    started = time.monotonic()
+    results = await asyncio.gather(*(user(i) for i in range(args.users)))
+    wall = time.monotonic() - started
+    # Handlers of users that timed out may still be running; their cleanup schedules the pod pause.
+    for task in list(client.tasks):
+        task.cancel()
+    await asyncio.gather(*client.tasks, return_exceptions=True)
+    client.disconnect()
+    await bot_task
+    monitor_task.cancel()
+    await runpod.close()
+
+    completed = [r for r in results if r["ok"]]
+    latencies = [r["latency"] for r in completed if r["latency"] is not None]
+    drafts = [r["first_draft"] for r in completed if r["first_draft"] is not None]
+    lags = monitor.samples
+    metrics = {
+        "completed": len(completed),
+        "failed": len(results) - len(completed),
+        "wall_seconds": wall,
+        "throughput_jobs_per_min": len(completed) / wall * 60,
+        "audio_seconds_per_second": sum(r["audio_seconds"] for r in completed) / wall,
+        "latency_p50": percentile(latencies, 0.50),
+        "latency_p95": percentile(latencies, 0.95),
+        "latency_p99": percentile(latencies, 0.99),
+        "latency_max": max(latencies, default=None),
+        "first_draft_p50": percentile(drafts, 0.50),
+        "loop_lag_p99_ms": percentile(lags, 0.99) * 1000 if lags else None,
+        "loop_lag_max_ms": max(lags) * 1000 if lags else None,
+        # ru_maxrss is in kilobytes on Linux.
+        "bot_peak_rss_mb": resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024,
+        "server_peak_rss_mb": runpod.server_peak_rss,
+        "pod_starts": runpod.starts,
+        "failovers": sum(wb.metrics.values["whisper_bot_failovers_total"].values()),
+        "telegram_replies": client.replies,
+        "telegram_edits": client.edits,
+    }
+    errors = {}
+    for r in results:
+        if r["error"]:
+            errors[r["error"]] = errors.get(r["error"], 0) + 1
+    return metrics, errors
+
+def compare(metrics, baseline, tolerance):
+    """Return a line per compared metric and whether any regressed beyond tolerance."""
+    lines = []
+    regressed = False
+    for name, higher_is_better in COMPARED_METRICS:
+        old, new = baseline["metrics"].get(name), metrics.get(name)
+        if not old or new is None:
+            continue
+        change = (new - old) / old
+        worse = -change if higher_is_better else change
+        flag = ""
+        if worse > tolerance:
+            flag = "  REGRESSION"
+            regressed = True
+        lines.append(f"  {name:<26} {old:>10.2f} -> {new:>10.2f} ({change:+.0%}){flag}")
+    return lines, regressed
+
+def main():
+    parser = argparse.ArgumentParser(prog="python -m bench", description=__doc__.split("\n\n")[0])
+    parser.add_argument("--users", type=int, default=50, help="concurrent scripted users (default: 50)")
+    parser.add_argument("--audio-seconds", type=float, default=60, help="length of each uploaded file (default: 60)")
+    parser.add_argument("--language", default="en", help="language sent with 'add'; empty for auto-detection, which needs the whisper model (default: en)")
+    parser.add_argument("--profile", help="execution profile sent with 'add', e.g. fast (default: none, the server picks)")
+    parser.add_argument("--script", help="JSON list of [step, argument] pairs replacing the default conversation")
+    parser.add_argument("--ramp", type=float, default=0.0, help="seconds over which users start (default: 0, all at once)")
+    parser.add_argument("--cold-start", type=float, default=10.0, help="seconds from pod start until the server process boots (default: 10)")
+    parser.add_argument("--pods", type=int, default=1, help="fake pods, each with its own server, in the bot's endpoint pool (default: 1)")
+    parser.add_argument("--gpu-shortage", type=int, default=0, help="start calls for the first pod answered with 'not enough free GPUs' (default: 0)")
+    parser.add_argument("--crash-after", type=float, help="kill the first pod's server this many seconds after it boots, to exercise failover")
+    parser.add_argument("--telegram-mbps", type=float, default=0, help="Telegram download speed per file in Mbit/s (default: 0, unthrottled)")
+    parser.add_argument("--relay", action="store_true", help="bot RELAY_UPLOAD: relay downloads straight into uploads")
+    parser.add_argument("--no-stage", action="store_true", help="with --relay, keep no copy of the audio on disk")
+    parser.add_argument("--model-load", type=float, default=1.0, help="stub backend seconds per model load (default: 1)")
+    parser.add_argument("--stub-rate", type=float, default=0.05, help="stub backend seconds per audio second (default: 0.05)")
+    parser.add_argument("--stub-batch", type=float, default=0.0, help="stub backend seconds per ASR batch, however full (default: 0)")
+    parser.add_argument("--stub-max-batch", type=int, default=0, help="stub backend runs out of memory above this ASR batch size (default: 0, never)")
+    parser.add_argument("--devices", type=int, default=1, help="stub devices, i.e. concurrent server jobs (default: 1)")
+    parser.add_argument("--max-queue", type=int, default=16, help="server MAX_QUEUE_SIZE (default: 16)")
+    parser.add_argument("--idle-grace", type=float, default=5.0, help="bot POD_IDLE_GRACE (default: 5)")
+    parser.add_argument("--timeout", type=float, default=1800, help="seconds a user waits for each expected reply (default: 1800)")
+    parser.add_argument("--baseline", default=DEFAULT_BASELINE, help="baseline file to compare against or save to")
+    parser.add_argument("--save-baseline", action="store_true", help="save this run as the baseline")
+    parser.add_argument("--tolerance", type=float, default=0.2, help="relative change counted as a regression (default: 0.2)")
+    parser.add_argument("--output", help="also write this run's results as JSON here")
+    parser.add_argument("--keep", action="store_true", help="keep the temporary working directory")
+    parser.add_argument("--verbose", action="store_true", help="show the bot's log")
+    args = parser.parse_args()
+
+    workdir = tempfile.mkdtemp(prefix="whisper-tg-bench-")
+    try:
+        metrics, errors = asyncio.run(run_bench(args, workdir))
+    finally:
+        os.chdir(REPO_ROOT)
+        if args.keep:
+            print(f"Working directory kept at {workdir}")
+        else:
+            shutil.rmtree(workdir, ignore_errors=True)
+
+    parameters = {name: getattr(args, name) for name in PARAMETERS}
+    print(f"Parameters: {json.dumps(parameters)}")
+    for name, value in metrics.items():
+        print(f"  {name:<26} {value:>10.2f}" if isinstance(value, float) else f"  {name:<26} {value!s:>10}")
+    for error, count in errors.items():
+        print(f"  error x{count}: {error}")
+    run = {"parameters": parameters, "metrics": metrics}
+    if args.output:
+        with open(args.output, "w") as f:
+            json.dump(run, f, indent=2)
+
+    regressed = False
+    if args.save_baseline:
+        with open(args.baseline, "w") as f:
+            json.dump(run, f, indent=2)
+        print(f"Baseline saved to {args.baseline}")
+    elif os.path.exists(args.baseline):
+        with open(args.baseline) as f:
+            baseline = json.load(f)
+        if baseline["parameters"] != parameters:
+            print(f"Not comparing: the baseline was recorded with {json.dumps(baseline['parameters'])}")
+        else:
+            lines, regressed = compare(metrics, baseline, args.tolerance)
+            print(f"Compared to baseline ({args.tolerance:.0%} tolerance):")
+            print("\n".join(lines))
+    if regressed or metrics["failed"]:
+        sys.exit(1)
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,113 @@
+"""
+Fake RunPod REST API. Starting a pod boots the real WhisperX server, with the stub
+backend, after a configurable cold-start delay; stopping it kills the server.
+"""
+import asyncio
+import os
+import subprocess
+import sys
+
+from aiohttp import web
+
+SERVER_SCRIPT = os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))), "Docker", "remote_whisperx_server.py")
+
+def peak_rss_mb(pid):
+    """Peak resident memory of a running process (Linux only), or 0."""
+    try:
+        with open(f"/proc/{pid}/status") as f:
+            for line in f:
+                if line.startswith("VmHWM:"):
+                    return int(line.split()[1]) / 1024
+    except OSError:
+        pass
+    return 0.0
+
+class FakePod:
+    def __init__(self, pod_id, server_env, server_log, cold_start=10.0, gpu_shortage=0, crash_after=None):
+        self.pod_id = pod_id
+        self.server_env = server_env
+        self.server_log = server_log
+        self.cold_start = cold_start
+        # Number of start calls answered with RunPod's "not enough free GPUs" error.
+        self.gpu_shortage = gpu_shortage
+        # Seconds after the first boot at which the server is killed while the pod keeps running.
+        self.crash_after = crash_after
+        self.status = "EXITED"
+        self.process = None
+        self.boot_task = None
+        self.starts = 0
+        self.stops = 0
+        self.server_peak_rss = 0.0
+    def start(self):
+        if self.gpu_shortage > 0:
+            self.gpu_shortage -= 1
+            return False
+        if self.status != "RUNNING":
+            self.status = "RUNNING"
+            self.starts += 1
+            self.boot_task = asyncio.create_task(self.boot())
+        return True
+    def stop(self):
+        if self.boot_task is not None:
+            self.boot_task.cancel()
+            self.boot_task = None
+        self.stop_server()
+        if self.status != "EXITED":
+            self.status = "EXITED"
+            self.stops += 1
+    async def boot(self):
+        await asyncio.sleep(self.cold_start)
+        with open(self.server_log, "a") as log_file:
+            self.process = subprocess.Popen([sys.executable, SERVER_SCRIPT], env=self.server_env, stdout=log_file, stderr=subprocess.STDOUT)
+        if self.crash_after is not None:
+            await asyncio.sleep(self.crash_after)
+            self.crash_after = None
+            self.stop_server()
+    def stop_server(self):
+        if self.process is None:
+            return
+        self.server_peak_rss = max(self.server_peak_rss, peak_rss_mb(self.process.pid))
+        self.process.terminate()
+        self.process.wait()
+        self.process = None
+
+class FakeRunPod:
+    def __init__(self, pods):
+        self.pods = {pod.pod_id: pod for pod in pods}
+        self.runner = None
+    @property
+    def starts(self):
+        return sum(pod.starts for pod in self.pods.values())
+    @property
+    def server_peak_rss(self):
+        return max((pod.server_peak_rss for pod in self.pods.values()), default=0.0)
+    async def serve(self, port):
+        app = web.Application()
+        app.router.add_get("/v1/pods/{pod_id}", self.get_pod)
+        app.router.add_post("/v1/pods/{pod_id}/start", self.start_pod)
+        app.router.add_post("/v1/pods/{pod_id}/stop", self.stop_pod)
+        self.runner = web.AppRunner(app)
+        await self.runner.setup()
+        await web.TCPSite(self.runner, "127.0.0.1", port).start()
+    async def close(self):
+        for pod in self.pods.values():
+            pod.stop()
+        if self.runner is not None:
+            await self.runner.cleanup()
+    def pod(self, request):
+        pod = self.pods.get(request.match_info["pod_id"])
+        if pod is None:
+            raise web.HTTPNotFound(text="pod not found")
+        return pod
+    async def get_pod(self, request):
+        pod = self.pod(request)
+        return web.json_response({"id": pod.pod_id, "desiredStatus": pod.status})
+    async def start_pod(self, request):
+        pod = self.pod(request)
+        if not pod.start():
+            return web.json_response({"error": "There are not enough free GPUs on the host machine to start this pod."}, status=500)
+        return web.json_response({"id": pod.pod_id, "status": pod.status})
+    async def stop_pod(self, request):
+        pod = self.pod(request)
+        pod.stop()
+        return web.json_response({"id": pod.pod_id, "status": pod.status})
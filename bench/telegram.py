@@ -0,0 +1,185 @@
+"""
+Fake Telethon client and scripted users for driving wb.py's handler without Telegram.
+"""
+import asyncio
+import itertools
+import time
+
+import numpy as np
+
+SAMPLE_RATE = 16000
+# Telethon's largest download request.
+DOWNLOAD_CHUNK_SIZE = 512 * 1024
+
+def audio_bytes(seconds, speakers=2, seed=0):
+    """
+    Raw 16 kHz s16le PCM in the shape the server's stub backend understands: turns of
+    3-8 s at one loudness level per speaker, separated by short silences.
+    """
+    rng = np.random.default_rng(seed)
+    total = int(seconds * SAMPLE_RATE)
+    gap = np.zeros(int(0.8 * SAMPLE_RATE), dtype=np.int16)
+    parts = []
+    size = 0
+    while size < total:
+        speaker = int(rng.integers(speakers))
+        amplitude = int((2 + 3 * speaker) / 20 * 32767)
+        turn = int(rng.uniform(3, 8) * SAMPLE_RATE)
+        parts.append(np.where(np.arange(turn) % 2 == 0, amplitude, -amplitude).astype(np.int16))
+        parts.append(gap)
+        size += turn + len(gap)
+    return np.concatenate(parts)[:total].tobytes()
+
+def make_audio(path, seconds, speakers=2, seed=0):
+    with open(path, "wb") as f:
+        f.write(audio_bytes(seconds, speakers, seed))
+
+class FakeDocument:
+    def __init__(self, document_id):
+        self.id = document_id
+
+class FakeFile:
+    def __init__(self, size):
+        self.size = size
+
+class FakeMedia:
+    def __init__(self, document_id, seconds, speakers, seed):
+        self.document = FakeDocument(document_id)
+        self.seconds = seconds
+        self.speakers = speakers
+        self.seed = seed
+
+class FakeMessage:
+    """A message as the bot sees it: either sent by a user or one of the bot's replies."""
+    ids = itertools.count(1)
+    def __init__(self, client, chat_id, sender_id, text="", media=None):
+        self.client = client
+        self.id = next(self.ids)
+        self.chat_id = chat_id
+        self.sender_id = sender_id
+        self.text = text
+        self.media = media
+        self.file = FakeFile(int(media.seconds * SAMPLE_RATE) * 2) if media else None
+    async def reply(self, text=None, file=None, message=None):
+        reply = FakeMessage(self.client, self.chat_id, None, text or message or "")
+        self.client.deliver(reply)
+        return reply
+    async def edit(self, text):
+        self.text = text
+        self.client.edits += 1
+        return self
+    async def download_media(self, path):
+        with open(path, "wb") as f:
+            async for chunk in self.client.iter_download(self.media):
+                f.write(chunk)
+        return path
+
+class FakeTelegramClient:
+    """
+    Stands in for telethon.TelegramClient. Every message a user sends goes to each
+    handler registered with on(), as its own task like Telethon's dispatch; the bot routes
+    replies to waiting sessions itself. Bot replies land in the sending user's inbox.
+    Downloads are throttled to download_rate bytes per second, if set.
+    """
+    def __init__(self, *args, download_rate=None, **kwargs):
+        self.download_rate = download_rate
+        self.handlers = []
+        self.inboxes = {}
+        self.messages = {}
+        self.tasks = set()
+        self.replies = 0
+        self.edits = 0
+        self.disconnected = asyncio.Event()
+    def on(self, builder):
+        def decorator(handler):
+            self.handlers.append(handler)
+            return handler
+        return decorator
+    async def start(self):
+        return self
+    async def run_until_disconnected(self):
+        await self.disconnected.wait()
+    def disconnect(self):
+        self.disconnected.set()
+    async def iter_download(self, media, request_size=DOWNLOAD_CHUNK_SIZE):
+        data = await asyncio.to_thread(audio_bytes, media.seconds, media.speakers, media.seed)
+        for offset in range(0, len(data), request_size):
+            chunk = data[offset:offset + request_size]
+            if self.download_rate:
+                await asyncio.sleep(len(chunk) / self.download_rate)
+            yield chunk
+    async def get_messages(self, chat_id, ids=None):
+        return self.messages.get(ids)
+    def send(self, user_id, text="", media=None):
+        message = FakeMessage(self, user_id, user_id, text, media)
+        self.messages[message.id] = message
+        for handler in self.handlers:
+            task = asyncio.create_task(handler(message))
+            self.tasks.add(task)
+            task.add_done_callback(self.tasks.discard)
+        return message
+    def deliver(self, message):
+        self.replies += 1
+        inbox = self.inboxes.get(message.chat_id)
+        if inbox is not None:
+            inbox.put_nowait(message)
+
+def default_script(password, language="en", seconds=60, speakers=2, profile=None):
+    """Authenticate, `add <speakers> <language> <profile>`, upload, wait for the transcript."""
+    steps = [
+        ["send", password],
+        ["expect", "Password accepted"],
+        ["send", " ".join(part for part in ("add", str(speakers), language, profile) if part)],
+        ["expect", "Now upload"],
+        ["media", seconds],
+    ]
+    if not language:
+        # Auto-detection may ask for confirmation; "yes" is harmless if it did not.
+        steps += [["expect", "Detected language"], ["send", "yes"]]
+    steps.append(["expect", "Transcript sent"])
+    return steps
+
+class Conversation:
+    """
+    One scripted user. Steps are ["send", text], ["media", seconds] or ["expect", text];
+    an expect step waits for a bot reply containing text, and a reply starting with ❌
+    fails the conversation. Latency runs from the media upload to the last expected reply.
+    """
+    def __init__(self, client, user_id, steps, speakers=2, timeout=600):
+        self.client = client
+        self.user_id = user_id
+        self.steps = steps
+        self.speakers = speakers
+        self.timeout = timeout
+    async def run(self):
+        inbox = self.client.inboxes.setdefault(self.user_id, asyncio.Queue())
+        result = {"user_id": self.user_id, "ok": False, "error": None, "latency": None, "first_draft": None, "audio_seconds": 0}
+        media_sent = None
+        for kind, arg in self.steps:
+            if kind == "send":
+                self.client.send(self.user_id, arg)
+            elif kind == "media":
+                media_sent = time.monotonic()
+                result["audio_seconds"] += arg
+                self.client.send(self.user_id, media=FakeMedia(self.user_id * 1000 + len(self.client.messages), arg, self.speakers, self.user_id))
+            elif kind == "expect":
+                deadline = time.monotonic() + self.timeout
+                while True:
+                    try:
+                        message = await asyncio.wait_for(inbox.get(), max(deadline - time.monotonic(), 0))
+                    except asyncio.TimeoutError:
+                        result["error"] = f"timed out waiting for {arg!r}"
+                        return result
+                    if message.text.startswith("❌"):
+                        result["error"] = message.text
+                        return result
+                    if media_sent is not None and result["first_draft"] is None and message.text.startswith("✍️"):
+                        result["first_draft"] = time.monotonic() - media_sent
+                    if arg in message.text:
+                        break
+            else:
+                raise ValueError(f"Unknown script step {kind!r}")
+        if media_sent is not None:
+            result["latency"] = time.monotonic() - media_sent
+        result["ok"] = True
+        return result
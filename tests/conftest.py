@@ -0,0 +1,60 @@
+import importlib.util
+import os
+import sys
+import types
+
+import pytest
+
+REPO_ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+SERVER_SCRIPT = os.path.join(REPO_ROOT, "Docker", "remote_whisperx_server.py")
+# Three stub devices and 60 s shards, so a few minutes of audio runs sharded.
+SERVER_ENV = {"WHISPERX_BACKEND": "stub", "WHISPERX_DEVICES": "cpu:0,cpu:1,cpu:2", "SHARD_SECONDS": "60"}
+
+@pytest.fixture(scope="session")
+def wb(tmp_path_factory):
+    """Import wb.py with a test config; it keeps its state under ./files, so import it from a temporary directory."""
+    config = types.ModuleType("config")
+    config.API_ID = 0
+    config.API_HASH = "test"
+    config.SESSION_NAME = "test"
+    config.HF_TOKEN = "test"
+    config.RUNPOD_API_KEY = "test"
+    config.BOT_PASSWORD = "test"
+    config.WHISPERX_ENDPOINTS = [{"url": "http://127.0.0.1:9/", "pod_id": None}]
+    config.METRICS_PORT = 0
+    previous = sys.modules.get("config")
+    sys.modules["config"] = config
+    sys.path.insert(0, REPO_ROOT)
+    cwd = os.getcwd()
+    os.chdir(tmp_path_factory.mktemp("bot"))
+    try:
+        import wb
+    finally:
+        os.chdir(cwd)
+        sys.path.remove(REPO_ROOT)
+        if previous is None:
+            sys.modules.pop("config", None)
+        else:
+            sys.modules["config"] = previous
+    wb.log = lambda msg: None
+    return wb
+
+@pytest.fixture(scope="session")
+def server(tmp_path_factory):
+    """Import the server with the stub backend and its models loaded on every device."""
+    env = dict(SERVER_ENV, FILES_DIR=str(tmp_path_factory.mktemp("server")))
+    previous = {name: os.environ.get(name) for name in env}
+    os.environ.update(env)
+    try:
+        spec = importlib.util.spec_from_file_location("remote_whisperx_server", SERVER_SCRIPT)
+        server = importlib.util.module_from_spec(spec)
+        spec.loader.exec_module(server)
+    finally:
+        for name, value in previous.items():
+            if value is None:
+                os.environ.pop(name, None)
+            else:
+                os.environ[name] = value
+    server.log = lambda msg: None
+    server.model_pool.load()
+    return server
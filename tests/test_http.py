@@ -0,0 +1,327 @@
+"""
+HTTP client tests against local aiohttp servers standing in for the RunPod REST API and
+the WhisperX server. Run from the repository root with the bot's dependencies installed:
+
+    python -m pytest -q tests
+"""
+import asyncio
+import gzip
+import json
+import os
+import socket
+import time
+
+import pytest
+from aiohttp import web
+from aiohttp.test_utils import TestServer
+
+NO_GPUS_ERROR = {"error": "There are not enough free GPUs on the host machine to start this pod."}
+
+def serve(wb, routes, test):
+    """Serve routes on a local port and run test(base_url) with a fresh, fast-retrying wb.http."""
+    async def main():
+        app = web.Application()
+        app.add_routes(routes)
+        server = TestServer(app, host="127.0.0.1")
+        await server.start_server()
+        wb.http = wb.HttpClient(retries=3, backoff=0.001, max_backoff=0.01)
+        try:
+            return await test(f"http://127.0.0.1:{server.port}")
+        finally:
+            await wb.http.close()
+            await server.close()
+    return asyncio.run(main())
+
+def drop_connection(request):
+    request.transport.close()
+    return web.Response()
+
+@pytest.mark.parametrize("status", [502, 503, 504])
+def test_request_retries_gateway_errors(wb, status):
+    calls = []
+    async def handler(request):
+        calls.append(request.method)
+        if len(calls) < 3:
+            return web.Response(status=status)
+        return web.json_response({"ok": True})
+    async def test(base_url):
+        return await wb.http.request("GET", f"{base_url}/healthz")
+    response = serve(wb, [web.get("/healthz", handler)], test)
+    assert response.status == 200
+    assert response.json() == {"ok": True}
+    assert len(calls) == 3
+
+def test_request_returns_last_gateway_error_after_retry_limit(wb):
+    calls = []
+    async def handler(request):
+        calls.append(request.method)
+        return web.Response(status=503)
+    async def test(base_url):
+        return await wb.http.request("GET", f"{base_url}/healthz", retries=2)
+    assert serve(wb, [web.get("/healthz", handler)], test).status == 503
+    assert len(calls) == 3
+
+def test_request_does_not_retry_other_errors(wb):
+    calls = []
+    async def handler(request):
+        calls.append(request.method)
+        return web.Response(status=404)
+    async def test(base_url):
+        return await wb.http.request("GET", f"{base_url}/missing")
+    assert serve(wb, [web.get("/missing", handler)], test).status == 404
+    assert len(calls) == 1
+
+def test_request_retries_dropped_connection(wb):
+    calls = []
+    async def handler(request):
+        calls.append(request.method)
+        if len(calls) == 1:
+            return drop_connection(request)
+        return web.json_response({"ok": True})
+    async def test(base_url):
+        return await wb.http.request("GET", f"{base_url}/healthz")
+    assert serve(wb, [web.get("/healthz", handler)], test).status == 200
+    assert len(calls) == 2
+
+def test_request_raises_once_retries_are_spent(wb):
+    async def handler(request):
+        return drop_connection(request)
+    async def test(base_url):
+        return await wb.http.request("GET", f"{base_url}/healthz", retries=1)
+    with pytest.raises(wb.aiohttp.ClientError):
+        serve(wb, [web.get("/healthz", handler)], test)
+
+def test_backoff_delay_grows_and_is_capped(wb):
+    client = wb.HttpClient(backoff=1.0, max_backoff=8.0)
+    for attempt, full in enumerate([1, 2, 4, 8, 8, 8]):
+        for _ in range(20):
+            assert full * 0.5 <= client.backoff_delay(attempt) <= full
+
+def runpod_routes(calls, shortage):
+    """Fake RunPod REST API whose first shortage start calls find no free GPUs."""
+    async def start(request):
+        calls.append(request.match_info["pod_id"])
+        assert request.headers["Authorization"] == "Bearer key"
+        if len(calls) <= shortage:
+            return web.json_response(NO_GPUS_ERROR, status=500)
+        return web.json_response({"id": request.match_info["pod_id"], "status": "RUNNING"})
+    async def status(request):
+        return web.json_response({"id": request.match_info["pod_id"], "desiredStatus": "RUNNING"})
+    return [web.post("/v1/pods/{pod_id}/start", start), web.get("/v1/pods/{pod_id}", status)]
+
+def test_start_pod_gives_up_after_its_attempts_without_free_gpus(wb):
+    calls = []
+    async def test(base_url):
+        api = wb.RunPodAPI("key", "pod-1", "http://unused", rest_url=f"{base_url}/v1")
+        return await api.start_pod(attempts=3)
+    assert serve(wb, runpod_routes(calls, shortage=100), test) == wb.RunPodAPI.NO_GPUS
+    assert calls == ["pod-1"] * 3
+
+def test_start_pod_retries_until_gpus_are_free(wb):
+    calls = []
+    async def test(base_url):
+        api = wb.RunPodAPI("key", "pod-1", "http://unused", rest_url=f"{base_url}/v1")
+        return await api.start_pod(attempts=5), await api.get_pod_status()
+    assert serve(wb, runpod_routes(calls, shortage=2), test) == ("RUNNING", "RUNNING")
+    assert len(calls) == 3
+
+class FakeWhisperX:
+    """
+    The WhisperX server's upload, submission and status endpoints. The first full_finalizes
+    finalize calls answer 429, and drop_at lists the PUT calls (counted from 1) that drop
+    the connection, after storing half of the chunk if it was at the expected offset.
+    """
+    def __init__(self, full_finalizes=0, drop_at=(), chunked=True):
+        self.full_finalizes = full_finalizes
+        self.drop_at = set(drop_at)
+        self.chunked = chunked
+        self.data = bytearray()
+        self.size = None
+        self.puts = 0
+        self.offset_checks = 0
+        self.finalizes = []
+        self.multipart = None
+    def routes(self):
+        return [
+            web.post("/uploads", self.create),
+            web.put("/uploads/{upload_id}", self.put),
+            web.get("/uploads/{upload_id}", self.offset),
+            web.post("/uploads/{upload_id}/finalize", self.finalize),
+            web.post("/run_whisperx", self.run_whisperx),
+            web.get("/job_status/{job_id}", self.job_status),
+        ]
+    async def create(self, request):
+        if not self.chunked:
+            return web.Response(status=404)
+        self.size = (await request.json())["size"]
+        return web.json_response({"upload_id": "u1"}, status=201)
+    async def put(self, request):
+        self.puts += 1
+        offset = int(request.query["offset"])
+        body = await request.read()
+        if self.puts in self.drop_at:
+            if offset == len(self.data):
+                self.data += body[:len(body) // 2]
+            return drop_connection(request)
+        if offset != len(self.data):
+            return web.json_response({"offset": len(self.data)}, status=409)
+        self.data += body
+        return web.json_response({"offset": len(self.data)})
+    async def offset(self, request):
+        self.offset_checks += 1
+        return web.json_response({"offset": len(self.data), "size": self.size})
+    async def finalize(self, request):
+        form = await request.post()
+        self.finalizes.append(dict(form))
+        if len(self.finalizes) <= self.full_finalizes:
+            return web.json_response({"error": "queue full"}, status=429, headers={"Retry-After": "7"})
+        return web.json_response({"job_id": "j1"}, status=202)
+    async def run_whisperx(self, request):
+        form = await request.post()
+        self.multipart = {name: value.file.read() if hasattr(value, "file") else value for name, value in form.items()}
+        return web.json_response({"job_id": "j1"}, status=202)
+    async def job_status(self, request):
+        return web.json_response({"status": "done", "job_id": request.match_info["job_id"]})
+
+@pytest.fixture
+def audio_file(tmp_path):
+    path = tmp_path / "audio.ogg"
+    path.write_bytes(os.urandom(5000))
+    return path
+
+@pytest.fixture
+def small_chunks(wb, monkeypatch):
+    monkeypatch.setattr(wb, "UPLOAD_CHUNK_SIZE", 1024)
+
+def test_chunked_upload_resumes_from_server_offset(wb, audio_file, small_chunks):
+    # aiohttp resends a request once on its own when a reused connection drops, so the
+    # upload only sees the failure, and asks for the offset, when the resend drops too.
+    server = FakeWhisperX(drop_at=(2, 3))
+    async def test(base_url):
+        return await wb.upload_chunked(base_url, str(audio_file))
+    assert serve(wb, server.routes(), test) == "u1"
+    assert bytes(server.data) == audio_file.read_bytes()
+    assert server.offset_checks == 1
+
+def test_create_upload_full_queue_raises(wb):
+    async def create(request):
+        return web.json_response({"error": "queue full"}, status=429, headers={"Retry-After": "12"})
+    async def test(base_url):
+        return await wb.create_upload(base_url, "audio.ogg", 10)
+    with pytest.raises(wb.QueueFullError) as e:
+        serve(wb, [web.post("/uploads", create)], test)
+    assert e.value.retry_after == 12
+
+def test_full_queue_at_finalize_keeps_the_upload(wb, audio_file, small_chunks):
+    server = FakeWhisperX(full_finalizes=1)
+    fields = {"language": "en", "min_speakers": "2"}
+    async def test(base_url):
+        upload = {}
+        with pytest.raises(wb.QueueFullError) as e:
+            await wb.submit_whisperx_job(base_url, str(audio_file), fields, upload)
+        assert e.value.retry_after == 7
+        puts = server.puts
+        response = await wb.submit_whisperx_job(base_url, str(audio_file), fields, upload)
+        assert server.puts == puts
+        return upload, response
+    upload, response = serve(wb, server.routes(), test)
+    assert response.status == 202 and response.json() == {"job_id": "j1"}
+    assert upload["upload_id"] == "u1"
+    assert len(server.finalizes) == 2
+    assert all(form == dict(fields, sha256=upload["sha256"]) for form in server.finalizes)
+
+def test_submit_does_not_wait_on_full_queue_when_told_not_to(wb, audio_file, small_chunks):
+    server = FakeWhisperX(full_finalizes=100)
+    async def test(base_url):
+        return await wb.submit_with_retry(None, None, base_url, str(audio_file), {"language": "en"}, wait_when_full=False)
+    with pytest.raises(wb.QueueFullError) as e:
+        serve(wb, server.routes(), test)
+    assert e.value.retry_after == 7
+    assert len(server.finalizes) == 1
+
+def test_submit_falls_back_to_multipart_without_chunked_uploads(wb, audio_file):
+    server = FakeWhisperX(chunked=False)
+    async def test(base_url):
+        return await wb.submit_whisperx_job(base_url, str(audio_file), {"language": "en"})
+    assert serve(wb, server.routes(), test).status == 202
+    assert server.multipart == {"language": "en", "audio": audio_file.read_bytes()}
+
+def test_poll_job_status_retries_gateway_errors(wb):
+    calls = []
+    async def job_status(request):
+        calls.append(request.match_info["job_id"])
+        if len(calls) == 1:
+            return web.Response(status=502)
+        return web.json_response({"status": "done", "result_path": "/get_transcript/j1"})
+    async def on_update(event_type, data):
+        raise AssertionError("no update expected for a finished job")
+    async def test(base_url):
+        return await wb.poll_job_status(base_url, "j1", on_update)
+    assert serve(wb, [web.get("/job_status/{job_id}", job_status)], test)["status"] == "done"
+    assert calls == ["j1", "j1"]
+
+def test_get_transcript_lines_retry_and_decompress(wb):
+    segments = [{"start": i, "end": i + 1, "text": f"line {i}", "speaker": "SPEAKER_00"} for i in range(50)]
+    body = "".join(json.dumps(s) + "\n" for s in segments).encode()
+    calls = []
+    async def get_transcript(request):
+        calls.append(request.match_info["job_id"])
+        if len(calls) == 1:
+            return web.Response(status=504)
+        return web.Response(body=gzip.compress(body), headers={"Content-Encoding": "gzip", "Content-Type": "application/x-ndjson"})
+    async def test(base_url):
+        return await wb.http.get_lines(f"{base_url}/get_transcript/j1", json.loads)
+    response, lines = serve(wb, [web.get("/get_transcript/{job_id}", get_transcript)], test)
+    assert response.status == 200
+    assert lines == segments
+    assert len(calls) == 2
+
+def test_metrics_server_gives_way_to_a_taken_port(wb, monkeypatch):
+    with socket.socket() as taken:
+        taken.bind(("127.0.0.1", 0))
+        taken.listen()
+        monkeypatch.setattr(wb, "METRICS_HOST", "127.0.0.1")
+        monkeypatch.setattr(wb, "METRICS_PORT", taken.getsockname()[1])
+        assert asyncio.run(wb.start_metrics_server()) is None
+
+def test_jobs_on_an_endpoint_share_one_health_monitor(wb, monkeypatch, tmp_path):
+    monkeypatch.setattr(wb, "POD_PROBE_INTERVAL", 0.02)
+    probes = []
+    async def healthz(request):
+        probes.append(time.monotonic())
+        if len(probes) > 10:
+            return web.Response(status=503)
+        return web.json_response({"ready": True, "queued": 0, "running": 5, "workers": 1})
+    async def test(base_url):
+        api = wb.RunPodAPI("key", None, base_url)
+        endpoint = wb.PodLifecycle(api, 0, 60, str(tmp_path / "pod_metrics.jsonl"))
+        watchers = [asyncio.create_task(endpoint.watch()) for _ in range(5)]
+        done, _ = await asyncio.wait(watchers, timeout=5)
+        assert len(done) == 5
+        assert endpoint.monitor_task is None and endpoint.watchers == 0
+    serve(wb, [web.get("/healthz", healthz)], test)
+    # Ten healthy probes, then POOL_FAILED_PROBES failing ones for all five jobs together.
+    assert len(probes) == 10 + wb.POOL_FAILED_PROBES
+
+def test_health_monitor_stops_when_the_last_job_leaves(wb, monkeypatch, tmp_path):
+    monkeypatch.setattr(wb, "POD_PROBE_INTERVAL", 0.02)
+    probes = []
+    async def healthz(request):
+        probes.append(time.monotonic())
+        return web.json_response({"ready": True})
+    async def test(base_url):
+        endpoint = wb.PodLifecycle(wb.RunPodAPI("key", None, base_url), 0, 60, str(tmp_path / "pod_metrics.jsonl"))
+        watchers = [asyncio.create_task(endpoint.watch()) for _ in range(3)]
+        await asyncio.sleep(0.1)
+        watchers[0].cancel()
+        await asyncio.sleep(0.05)
+        assert endpoint.monitor_task is not None and endpoint.watchers == 2
+        for watcher in watchers[1:]:
+            watcher.cancel()
+        await asyncio.gather(*watchers, return_exceptions=True)
+        assert endpoint.monitor_task is None
+        count = len(probes)
+        await asyncio.sleep(0.1)
+        return count
+    count = serve(wb, [web.get("/healthz", healthz)], test)
+    assert len(probes) == count
@@ -0,0 +1,40 @@
+"""Job bookkeeping: finished jobs keep only their final event and are forgotten once past their retention, and batching keeps tokens apart."""
+import time
+
+def start_job(server, job_id, progress_events):
+    server.jobs[job_id] = {"status": "running", "submitted_at": time.time(), "events": []}
+    for i in range(progress_events):
+        server.report_progress(job_id, "transcribing", i / progress_events)
+
+def test_finished_job_keeps_only_its_final_event(server):
+    start_job(server, "events-1", 50)
+    server.finish_job("events-1", "done", transcript_path=None)
+    job = server.jobs["events-1"]
+    assert [e["type"] for e in job["events"]] == ["done"]
+    assert job["events_base"] == 50
+    client = server.app.test_client()
+    for headers in ({}, {"Last-Event-ID": "10"}, {"Last-Event-ID": "49"}):
+        body = client.get("/job_events/events-1", headers=headers).get_data(as_text=True)
+        assert body.startswith("id: 50\nevent: done\n")
+
+def test_prune_jobs_forgets_old_finished_jobs(server):
+    start_job(server, "old", 1)
+    server.finish_job("old", "done", transcript_path=None)
+    server.jobs["old"]["finished_at"] -= 7200
+    start_job(server, "recent", 1)
+    server.finish_job("recent", "error", "failed")
+    start_job(server, "running", 1)
+    server.prune_jobs(3600)
+    assert "old" not in server.jobs
+    assert "recent" in server.jobs and "running" in server.jobs
+    assert "old" not in server.job_store.load(3600)
+    client = server.app.test_client()
+    assert client.get("/job_status/old").status_code == 404
+    assert client.get("/job_status/recent").status_code == 200
+
+def test_jobs_with_different_tokens_are_not_batched_together(server):
+    def job(token):
+        profile = {"model": "large-v3-turbo", "compute_type": "int8"}
+        return {"duration": 10, "profile": profile, "args": ["a.pcm", "a.jsonl", 1, 2, "en", token]}
+    assert server.batch_key(job("hf_a")) == server.batch_key(job("hf_a"))
+    assert server.batch_key(job("hf_a")) != server.batch_key(job("hf_b"))
@@ -0,0 +1,40 @@
+"""ModelSlot's model caches free an evicted model before asking the runtime to release memory."""
+import weakref
+
+class Model:
+    def __init__(self, name):
+        self.name = name
+
+class Runtime:
+    """Loads weakly tracked models and records which of them were still alive at each release_memory()."""
+    def __init__(self):
+        self.loaded = []
+        self.alive_at_release = []
+    def load_asr(self, device, model_name, compute_type):
+        model = Model(model_name)
+        self.loaded.append(weakref.ref(model))
+        return model
+    def load_align(self, language, device):
+        model = Model(language)
+        self.loaded.append(weakref.ref(model))
+        return model
+    def release_memory(self):
+        self.alive_at_release.append([ref().name for ref in self.loaded if ref() is not None])
+
+def test_evicted_asr_model_is_unreferenced_when_memory_is_released(server, monkeypatch):
+    monkeypatch.setattr(server, "ASR_CACHE_SIZE", 1)
+    runtime = Runtime()
+    slot = server.ModelSlot(runtime, "cpu:0")
+    for name in ("a", "b", "c"):
+        slot.load(hf_token="", profile={"model": name, "compute_type": "int8", "diarize": False})
+    assert list(slot.asr_models) == [("c", "int8")]
+    assert runtime.alive_at_release == [["b"], ["c"]]
+
+def test_evicted_align_model_is_unreferenced_when_memory_is_released(server, monkeypatch):
+    monkeypatch.setattr(server, "ALIGN_CACHE_SIZE", 1)
+    runtime = Runtime()
+    slot = server.ModelSlot(runtime, "cpu:0")
+    for language in ("en", "de", "fr"):
+        slot.get_align_model(language, {})
+    assert list(slot.align_models) == ["fr"]
+    assert runtime.alive_at_release == [["de"], ["fr"]]
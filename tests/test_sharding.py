@@ -0,0 +1,72 @@
+"""
+Sharded transcription against the unsharded run of the same recording, on the server's
+CPU-only stub backend with three devices and 60 s shards. Synthetic speakers each talk
+at their own level, which the stub tells apart, so both runs must agree on every
+segment's timestamps and speaker. The stub also splits speakers to meet min_speakers,
+as a real diarizer does.
+"""
+import numpy as np
+import pytest
+
+SAMPLE_RATE = 16000
+# Stub segments start and end on 100 ms frames, and shards are cut in the middle of one.
+FRAME_SECONDS = 0.1
+
+def synthesize(turns):
+    """s16le PCM of (speaker, seconds) turns, each followed by a second of silence. Speaker k talks at level k + 2."""
+    pieces = []
+    for speaker, seconds in turns:
+        samples = int(seconds * SAMPLE_RATE)
+        pieces.append(np.where(np.arange(samples) % 2, 1, -1) * (speaker + 2) / 20)
+        pieces.append(np.zeros(SAMPLE_RATE))
+    return (np.concatenate(pieces) * 32767).astype(np.int16).tobytes()
+
+def transcribe(server, tmp_path, pcm, max_speakers, sharded, min_speakers=1):
+    """Run a job through run_on_pool; with sharded false, on one device only."""
+    path = tmp_path / "audio.pcm"
+    path.write_bytes(pcm)
+    job_id = f"test-{'sharded' if sharded else 'single'}"
+    server.jobs[job_id] = {}
+    profile = server.choose_profile(len(pcm) / 2 / SAMPLE_RATE, max_speakers, "en")
+    slots = server.model_pool.acquire_idle(1 if sharded else len(server.model_pool.slots))
+    try:
+        result, timings = server.run_on_pool(job_id, slots[0], profile, str(path), min_speakers, max_speakers, "en", "token")
+    finally:
+        server.model_pool.release(slots)
+    return result["segments"], timings
+
+def assert_same_segments(sharded, single):
+    assert len(sharded) == len(single)
+    for a, b in zip(sharded, single):
+        assert a["start"] == pytest.approx(b["start"], abs=FRAME_SECONDS)
+        assert a["end"] == pytest.approx(b["end"], abs=FRAME_SECONDS)
+        assert a["speaker"] == b["speaker"]
+        assert {w["speaker"] for w in a["words"]} == {a["speaker"]}
+
+def test_sharded_matches_unsharded(server, tmp_path):
+    turns = [(i % 3, 3 + i % 5) for i in range(60)]
+    pcm = synthesize(turns)
+    sharded, timings = transcribe(server, tmp_path, pcm, 3, sharded=True)
+    single, _ = transcribe(server, tmp_path, pcm, 3, sharded=False)
+    assert timings["shards"] > 3
+    assert len(single) == len(turns)
+    assert_same_segments(sharded, single)
+    assert [s["speaker"] for s in single] == [f"SPEAKER_{speaker:02d}" for speaker, _ in turns]
+
+# min_speakers == max_speakers is what the bot sends for "add N": a shard missing a
+# speaker must still not be forced into that many clusters.
+@pytest.mark.parametrize("min_speakers", [1, 4])
+def test_speaker_missing_from_a_shard(server, tmp_path, min_speakers):
+    # The only pauses near 60 s and 120 s are at those marks, so the three shards are the
+    # three minutes. Speaker 2 is silent for the whole second minute and speaker 3 only
+    # talks in the last one, so shards see different speakers under the same local labels.
+    first = [(0, 4), (1, 4), (2, 4)] * 3 + [(1, 3), (2, 10)]
+    second = [(0, 11)] + [(1, 4), (0, 4)] * 3 + [(1, 4), (1, 12)]
+    third = [(3, 11)] + [(2, 4), (0, 4), (3, 4), (1, 4)] * 2
+    turns = first + second + third
+    pcm = synthesize(turns)
+    sharded, timings = transcribe(server, tmp_path, pcm, 4, sharded=True, min_speakers=min_speakers)
+    single, _ = transcribe(server, tmp_path, pcm, 4, sharded=False, min_speakers=min_speakers)
+    assert timings["shards"] == 3
+    assert_same_segments(sharded, single)
+    assert [s["speaker"] for s in sharded] == [f"SPEAKER_{speaker:02d}" for speaker, _ in turns]
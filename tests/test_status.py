@@ -0,0 +1,77 @@
+"""Throttled job status edits: bursts of events collapse into few edits, and flood waits are waited out."""
+import asyncio
+import json
+
+import pytest
+from aiohttp import web
+from aiohttp.test_utils import TestServer
+from telethon.errors import FloodWaitError
+
+class FakeMessage:
+    def __init__(self, flood_waits=0):
+        self.edits = []
+        self.flood_waits = flood_waits
+    async def edit(self, text):
+        if self.flood_waits:
+            self.flood_waits -= 1
+            raise FloodWaitError(request=None, capture=0)
+        self.edits.append(text)
+
+@pytest.fixture
+def fast_edits(wb, monkeypatch):
+    monkeypatch.setattr(wb, "PARTIAL_EDIT_INTERVAL", 0.05)
+
+def test_burst_of_statuses_costs_one_delayed_edit(wb, fast_edits):
+    message = FakeMessage()
+    async def test():
+        status = wb.StatusMessage(message)
+        await status.set("queued 3")
+        for position in (2, 1):
+            await status.set(f"queued {position}")
+        await status.set("running")
+        assert message.edits == ["queued 3"]
+        await asyncio.sleep(0.1)
+        await status.set("running")
+    asyncio.run(test())
+    assert message.edits == ["queued 3", "running"]
+
+def test_flood_wait_is_waited_out(wb, fast_edits):
+    message = FakeMessage(flood_waits=2)
+    asyncio.run(wb.StatusMessage(message).set("running"))
+    assert message.edits == ["running"]
+
+def test_cancel_drops_pending_edit(wb, fast_edits):
+    message = FakeMessage()
+    async def test():
+        status = wb.StatusMessage(message)
+        await status.set("queued 1")
+        await status.set("running")
+        status.cancel()
+        await asyncio.sleep(0.1)
+    asyncio.run(test())
+    assert message.edits == ["queued 1"]
+
+def test_wait_for_job_throttles_progress_events(wb, monkeypatch):
+    # The edit held back for the interval is dropped once the job is done.
+    monkeypatch.setattr(wb, "PARTIAL_EDIT_INTERVAL", 60)
+    message = FakeMessage()
+    async def job_events(request):
+        resp = web.StreamResponse(headers={"Content-Type": "text/event-stream"})
+        await resp.prepare(request)
+        for i in range(100):
+            await resp.write(f"id: {i}\nevent: progress\ndata: {json.dumps({'stage': 'transcribing', 'progress': i / 100})}\n\n".encode())
+        await resp.write(b"id: 100\nevent: done\ndata: {}\n\n")
+        return resp
+    async def test():
+        app = web.Application()
+        app.router.add_get("/job_events/{job_id}", job_events)
+        server = TestServer(app, host="127.0.0.1")
+        await server.start_server()
+        wb.http = wb.HttpClient()
+        try:
+            return await wb.wait_for_job(f"http://127.0.0.1:{server.port}", "j1", message)
+        finally:
+            await wb.http.close()
+            await server.close()
+    assert asyncio.run(test())["status"] == "done"
+    assert message.edits == ["⏳ WhisperX: transcribing (0%)…"]
@@ -0,0 +1,62 @@
+"""/get_transcript: rendered formats, and bodies streamed from disk with incremental compression."""
+import gzip
+import json
+
+import pytest
+
+def add_job(server, tmp_path, segments):
+    path = tmp_path / "transcript.jsonl"
+    server.write_transcript_jsonl({"segments": segments}, str(path))
+    job_id = f"test-{len(segments)}"
+    server.jobs[job_id] = {"status": "done", "transcript_path": str(path)}
+    return job_id, path
+
+def make_segments(count):
+    return [{"start": i * 2.5, "end": i * 2.5 + 2, "text": f" line {i}", "speaker": f"SPEAKER_{i % 3:02d}",
+             "words": [{"word": "line", "start": i * 2.5, "end": i * 2.5 + 1, "score": 0.9}]} for i in range(count)]
+
+def test_formats(server, tmp_path):
+    segments = make_segments(2)
+    del segments[1]["speaker"]
+    job_id, path = add_job(server, tmp_path, segments)
+    client = server.app.test_client()
+    def get(fmt):
+        resp = client.get(f"/get_transcript/{job_id}?format={fmt}")
+        assert resp.status_code == 200 and "Content-Encoding" not in resp.headers
+        return resp.get_data(as_text=True)
+    assert get("txt") == "[SPEAKER_00]: line 0\nline 1\n"
+    assert get("srt") == "1\n00:00:00,000 --> 00:00:02,000\n[SPEAKER_00]: line 0\n\n2\n00:00:02,500 --> 00:00:04,500\nline 1\n\n"
+    assert get("vtt") == "WEBVTT\n\n00:00:00.000 --> 00:00:02.000\n<v SPEAKER_00>line 0\n\n00:00:02.500 --> 00:00:04.500\nline 1\n\n"
+    assert get("jsonl") == path.read_text()
+    assert json.loads(get("jsonl").splitlines()[0])["words"] == [["line", 0.0, 1.0, 0.9]]
+
+@pytest.mark.parametrize("fmt", ["txt", "srt", "vtt", "jsonl"])
+def test_large_transcript_is_streamed_and_compressed(server, tmp_path, fmt):
+    job_id, path = add_job(server, tmp_path, make_segments(5000))
+    assert path.stat().st_size > 4 * server.TRANSCRIPT_STREAM_CHUNK
+    client = server.app.test_client()
+    plain = client.get(f"/get_transcript/{job_id}?format={fmt}")
+    compressed = client.get(f"/get_transcript/{job_id}?format={fmt}", headers={"Accept-Encoding": "gzip"})
+    assert plain.is_streamed and compressed.is_streamed
+    assert compressed.headers["Content-Encoding"] == "gzip"
+    assert gzip.decompress(compressed.data) == plain.data
+    assert len(compressed.data) < len(plain.data) / 4
+    if fmt == "jsonl":
+        assert plain.data == path.read_bytes()
+    else:
+        assert plain.data.decode().count("line 4999") == 1
+
+def test_zstd(server, tmp_path):
+    zstandard = pytest.importorskip("zstandard")
+    job_id, _ = add_job(server, tmp_path, make_segments(5000))
+    client = server.app.test_client()
+    plain = client.get(f"/get_transcript/{job_id}")
+    compressed = client.get(f"/get_transcript/{job_id}", headers={"Accept-Encoding": "zstd, gzip"})
+    assert compressed.headers["Content-Encoding"] == "zstd"
+    assert zstandard.ZstdDecompressor().decompressobj().decompress(compressed.data) == plain.data
+
+def test_small_transcript_is_not_compressed(server, tmp_path):
+    job_id, _ = add_job(server, tmp_path, make_segments(1))
+    resp = server.app.test_client().get(f"/get_transcript/{job_id}", headers={"Accept-Encoding": "gzip"})
+    assert "Content-Encoding" not in resp.headers
+    assert resp.get_data(as_text=True) == "[SPEAKER_00]: line 0\n"
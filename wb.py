@@ -1,111 +1,1153 @@
 import os
 import asyncio
-import requests  
+import aiohttp
+import bisect
+import hashlib
+import json
+import random
+import re
+import shutil
+import sqlite3
+import subprocess
+import threading
+from aiohttp import web
+from collections import OrderedDict
+from concurrent.futures import ThreadPoolExecutor
+from contextlib import contextmanager, nullcontext
 from datetime import datetime
 from telethon import TelegramClient, events
+from telethon.errors import FloodWaitError
+import numpy as np
 import whisper  
 import uuid
 import time
 
+import config
 from config import (
     API_ID,
     API_HASH,
     SESSION_NAME,
     HF_TOKEN,
     RUNPOD_API_KEY,
-    RUNPOD_POD_ID,
-    RUNPOD_ENDPOINT_URL,
     BOT_PASSWORD,
 )
 FILES_DIR = os.path.abspath("files")
 os.makedirs(FILES_DIR, exist_ok=True)
 
 defaultdict = dict 
-user_states = {} 
-user_tasks = {} 
-latest_session_id = {} 
-active_jobs_lock = None  
-ACTIVE_JOBS_FILE = os.path.join(FILES_DIR, "active_jobs.txt")
+STATE_DB = os.path.join(FILES_DIR, "state.db")
 USERS_FILE = os.path.join(FILES_DIR, "users.txt")
+# Sessions waiting this long for a file expire; at most MAX_SESSIONS are open at once.
+SESSION_TTL = getattr(config, "SESSION_TTL", 3600)
+MAX_SESSIONS = getattr(config, "MAX_SESSIONS", 1000)
+# Files in FILES_DIR of closed sessions are removed, oldest first, above this total.
+SESSION_FILES_MAX_BYTES = getattr(config, "SESSION_FILES_MAX_BYTES", 2 * 1024 * 1024 * 1024)
+SESSION_SWEEP_INTERVAL = 60
+LANGUAGE_REPLY_TIMEOUT = 60
+
+# Detected languages at or above this probability are used without asking the user.
+LANGUAGE_CONFIDENCE = getattr(config, "LANGUAGE_CONFIDENCE", 0.8)
+LANGUAGE_WINDOW_SECONDS = 30
+LANGUAGE_SAMPLE_WINDOWS = getattr(config, "LANGUAGE_SAMPLE_WINDOWS", 3)
+# Execution profiles users can name at the end of the add command, e.g. "add 1 en fast";
+# they must exist on the WhisperX servers. Without one the server picks a profile.
+TRANSCRIPTION_PROFILES = getattr(config, "TRANSCRIPTION_PROFILES", ("fast", "balanced", "accurate"))
+language_model = None
+language_model_lock = threading.Lock()
+language_executor = ThreadPoolExecutor(max_workers=1, thread_name_prefix="language")
+# Audio is re-encoded as 16 kHz mono "opus" or "flac" before upload; None uploads it as received.
+AUDIO_PREPROCESS = getattr(config, "AUDIO_PREPROCESS", "opus")
+AUDIO_OPUS_BITRATE = getattr(config, "AUDIO_OPUS_BITRATE", "32k")
+AUDIO_PREPROCESS_WORKERS = getattr(config, "AUDIO_PREPROCESS_WORKERS", 2)
+# Created on first use, inside the running event loop.
+preprocess_slots = None
+# Relay the Telegram download chunk by chunk into an upload to an already ready endpoint,
+# with hashing and language detection reading the same chunks, instead of downloading,
+# detecting and uploading one after another. Without RELAY_STAGE_TO_DISK no copy is kept
+# in FILES_DIR, so a job cannot move to another endpoint or survive a bot restart.
+RELAY_UPLOAD = getattr(config, "RELAY_UPLOAD", False)
+RELAY_STAGE_TO_DISK = getattr(config, "RELAY_STAGE_TO_DISK", True)
+# Download chunks each consumer may fall behind before the download waits for it.
+RELAY_BUFFER_CHUNKS = 16
+HTTP_POOL_SIZE = getattr(config, "HTTP_POOL_SIZE", 20)
+HTTP_RETRIES = getattr(config, "HTTP_RETRIES", 4)
+POD_START_ATTEMPTS = getattr(config, "POD_START_ATTEMPTS", 10)
+RUNPOD_REST_URL = getattr(config, "RUNPOD_REST_URL", "https://rest.runpod.io/v1")
+# Each endpoint is {"url": ..., "pod_id": ..., "name": ...}; one without a pod_id is a
+# server that is always on and is never started or paused by the bot.
+WHISPERX_ENDPOINTS = getattr(config, "WHISPERX_ENDPOINTS", None) or [
+    {"url": getattr(config, "RUNPOD_ENDPOINT_URL", None), "pod_id": getattr(config, "RUNPOD_POD_ID", None)}
+]
+# Load (queued and running jobs per worker) of the best endpoint at which another pod is started.
+POOL_SCALE_UP_LOAD = getattr(config, "POOL_SCALE_UP_LOAD", 1.0)
+# Seconds a pod that failed to start is tried only after every other endpoint.
+POOL_FAILURE_COOLDOWN = 300
+# Failed health checks in a row after which a running job is moved to another endpoint.
+POOL_FAILED_PROBES = 3
+UPLOAD_CHUNK_SIZE = getattr(config, "UPLOAD_CHUNK_SIZE", 8 * 1024 * 1024)
+# The server sends a keepalive every 15 s, so a silent stream for this long is dead.
+EVENTS_READ_TIMEOUT = 60
+JOB_TIMEOUT = 7200
+# Minimum seconds between edits of a live draft or job status message, to stay clear of flood limits.
+PARTIAL_EDIT_INTERVAL = getattr(config, "PARTIAL_EDIT_INTERVAL", 3.0)
+TELEGRAM_MESSAGE_LIMIT = 4000
+CACHE_DIR = os.path.join(FILES_DIR, "cache")
+CACHE_MAX_BYTES = getattr(config, "CACHE_MAX_BYTES", 500 * 1024 * 1024)
+CACHE_MAX_AGE_DAYS = getattr(config, "CACHE_MAX_AGE_DAYS", 30)
+# Seconds the pod stays up after the last job, so a follow-up upload skips the cold start.
+POD_IDLE_GRACE = getattr(config, "POD_IDLE_GRACE", 300)
+POD_READY_TIMEOUT = getattr(config, "POD_READY_TIMEOUT", 600)
+POD_PREWARM = getattr(config, "POD_PREWARM", True)
+POD_PROBE_INTERVAL = 3
+POD_METRICS_FILE = os.path.join(FILES_DIR, "pod_metrics.jsonl")
+# Prometheus-style /metrics for the bot; 0 turns the endpoint off.
+METRICS_HOST = getattr(config, "METRICS_HOST", "127.0.0.1")
+METRICS_PORT = getattr(config, "METRICS_PORT", 9101)
 
 def log(msg):
     print(f"[{datetime.now().strftime('%Y-%m-%d %H:%M:%S')}] {msg}")
 
+class Metrics:
+    """
+    Counters and histograms in the Prometheus text format, served by the bot's /metrics.
+    Values registered with a function are read when the endpoint is scraped; a function
+    may return {label dict items: value} for a labelled series.
+    """
+    BUCKETS = (0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30, 60, 120, 300, 600, 1800, 3600)
+    def __init__(self):
+        self.types = {}
+        self.help = {}
+        self.values = {}
+        self.functions = {}
+    def _register(self, name, kind, help_text, fn=None):
+        self.types[name] = kind
+        self.help[name] = help_text
+        self.values[name] = {}
+        if fn is not None:
+            self.functions[name] = fn
+    def counter(self, name, help_text, fn=None):
+        self._register(name, "counter", help_text, fn)
+    def gauge(self, name, help_text, fn):
+        self._register(name, "gauge", help_text, fn)
+    def histogram(self, name, help_text):
+        self._register(name, "histogram", help_text)
+    def inc(self, name, value=1, **labels):
+        key = tuple(sorted(labels.items()))
+        series = self.values[name]
+        series[key] = series.get(key, 0) + value
+    def observe(self, name, value, **labels):
+        # One count per bucket plus +Inf, then the sum and the total count.
+        h = self.values[name].setdefault(tuple(sorted(labels.items())), [0] * (len(self.BUCKETS) + 1) + [0.0, 0])
+        h[bisect.bisect_left(self.BUCKETS, value)] += 1
+        h[-2] += value
+        h[-1] += 1
+    @staticmethod
+    def _labels(key, extra=()):
+        pairs = list(key) + list(extra)
+        return "{" + ",".join(f'{k}="{v}"' for k, v in pairs) + "}" if pairs else ""
+    def render(self):
+        lines = []
+        for name, kind in self.types.items():
+            lines.append(f"# HELP {name} {self.help[name]}")
+            lines.append(f"# TYPE {name} {kind}")
+            if name in self.functions:
+                value = self.functions[name]()
+                if isinstance(value, dict):
+                    lines.extend(f"{name}{self._labels(key)} {v}" for key, v in value.items())
+                else:
+                    lines.append(f"{name} {value}")
+                continue
+            for key, value in self.values[name].items():
+                if kind != "histogram":
+                    lines.append(f"{name}{self._labels(key)} {value}")
+                    continue
+                cumulative = 0
+                for bound, count in zip(self.BUCKETS + ("+Inf",), value):
+                    cumulative += count
+                    lines.append(f"{name}_bucket{self._labels(key, [('le', bound)])} {cumulative}")
+                lines.append(f"{name}_sum{self._labels(key)} {value[-2]}")
+                lines.append(f"{name}_count{self._labels(key)} {value[-1]}")
+        return "\n".join(lines) + "\n"
+
+metrics = Metrics()
+metrics.histogram("whisper_bot_stage_seconds", "Seconds spent in each stage of a transcription, as seen by the bot.")
+metrics.histogram("whisper_bot_job_seconds", "Seconds from receiving the audio to sending the transcript.")
+metrics.counter("whisper_bot_jobs_total", "Transcriptions finished, by outcome.")
+metrics.counter("whisper_bot_upload_bytes_total", "Audio bytes uploaded to the WhisperX server.")
+metrics.counter("whisper_bot_preprocess_saved_bytes_total", "Upload bytes saved by re-encoding audio before upload.")
+metrics.counter("whisper_bot_download_bytes_total", "Bytes downloaded, by source.")
+metrics.counter("whisper_bot_pod_starts_total", "Pod readiness checks that had to start the pod (cold) or found it running (warm).")
+metrics.gauge("whisper_bot_active_jobs", "Jobs currently running on each WhisperX endpoint.",
+              lambda: {(("endpoint", e.name),): e.active for e in pod_pool.endpoints})
+metrics.gauge("whisper_bot_endpoint_load", "Queued and running jobs per worker of each WhisperX endpoint, as last probed.",
+              lambda: {(("endpoint", e.name),): round(e.load(), 3) for e in pod_pool.endpoints})
+metrics.counter("whisper_bot_failovers_total", "Jobs moved off a WhisperX endpoint that failed them.")
+metrics.counter("whisper_bot_relay_saved_seconds_total", "Seconds saved by relaying downloads instead of downloading, detecting and uploading in turn.")
+metrics.gauge("whisper_bot_sessions", "Open user sessions.", lambda: len(sessions))
+metrics.counter("whisper_bot_sessions_expired_total", "Sessions awaiting a file dropped for being idle past SESSION_TTL or over MAX_SESSIONS.")
+metrics.counter("whisper_bot_session_files_removed_bytes_total", "Bytes of closed sessions' files removed to stay under SESSION_FILES_MAX_BYTES.")
+metrics.counter("whisper_bot_cache_hits_total", "Local transcript cache hits.", lambda: transcript_cache.hits)
+metrics.counter("whisper_bot_cache_misses_total", "Local transcript cache misses.", lambda: transcript_cache.misses)
+
+class Trace:
+    """
+    Timed spans of one transcription under a trace id that is also sent to the server.
+    Spans feed whisper_bot_stage_seconds; the server's own stage timings are only logged.
+    """
+    def __init__(self, trace_id=None):
+        self.trace_id = trace_id or uuid.uuid4().hex[:16]
+        self.started = time.monotonic()
+        self.spans = []
+        self.notes = {}
+    @contextmanager
+    def span(self, stage):
+        started = time.monotonic()
+        try:
+            yield
+        finally:
+            seconds = time.monotonic() - started
+            self.spans.append((stage, seconds))
+            metrics.observe("whisper_bot_stage_seconds", seconds, stage=stage)
+    def add_remote(self, timings):
+        for stage, seconds in (timings or {}).items():
+            if stage not in ("inference", "shards", "batch"):
+                self.spans.append((f"server.{stage}", seconds))
+    def note(self, **values):
+        """Extra facts, like bytes saved, for the final log line."""
+        self.notes.update(values)
+    def finish(self, outcome):
+        elapsed = time.monotonic() - self.started
+        metrics.observe("whisper_bot_job_seconds", elapsed)
+        metrics.inc("whisper_bot_jobs_total", outcome=outcome)
+        spans = " ".join([f"{stage}={seconds:.2f}s" for stage, seconds in self.spans] + [f"{k}={v}" for k, v in self.notes.items()])
+        log(f"[trace {self.trace_id}] {outcome} in {elapsed:.2f}s: {spans}")
+
+async def start_metrics_server():
+    """
+    Serve /metrics on METRICS_HOST:METRICS_PORT. Returns the runner, or None if disabled
+    or the port cannot be bound, e.g. by a second bot on the same host; the bot runs on
+    without metrics then.
+    """
+    if not METRICS_PORT:
+        return None
+    async def handle(request):
+        return web.Response(text=metrics.render(), content_type="text/plain", charset="utf-8")
+    app = web.Application()
+    app.router.add_get("/metrics", handle)
+    runner = web.AppRunner(app)
+    await runner.setup()
+    try:
+        await web.TCPSite(runner, METRICS_HOST, METRICS_PORT).start()
+    except OSError as e:
+        log(f"Could not serve metrics on {METRICS_HOST}:{METRICS_PORT}, continuing without them: {e}")
+        await runner.cleanup()
+        return None
+    log(f"Metrics served on http://{METRICS_HOST}:{METRICS_PORT}/metrics")
+    return runner
+
+def get_language_model():
+    global language_model
+    with language_model_lock:
+        if language_model is None:
+            started = time.monotonic()
+            language_model = whisper.load_model("tiny")
+            log(f"[language] Whisper tiny model loaded in {time.monotonic() - started:.2f}s")
+    return language_model
+
+def probe_duration(audio_path):
+    try:
+        out = subprocess.run(
+            ["ffprobe", "-v", "error", "-show_entries", "format=duration", "-of", "default=noprint_wrappers=1:nokey=1", audio_path],
+            capture_output=True, text=True, timeout=30,
+        )
+        return float(out.stdout.strip())
+    except Exception:
+        return None
+
+def load_audio_window(audio_path, offset, duration):
+    """
+    Decode only [offset, offset + duration) of the file as 16 kHz mono float32.
+    """
+    cmd = [
+        "ffmpeg", "-nostdin", "-v", "error",
+        "-ss", f"{offset:.2f}", "-t", f"{duration:.2f}", "-i", audio_path,
+        "-f", "s16le", "-ac", "1", "-ar", str(whisper.audio.SAMPLE_RATE), "-",
+    ]
+    out = subprocess.run(cmd, capture_output=True, check=True).stdout
+    return np.frombuffer(out, np.int16).flatten().astype(np.float32) / 32768.0
+
 def detect_language(audio_path):
     """
     Detect language of an audio file using OpenAI Whisper.
+    Only a few 30-second windows spread over the file are decoded; returns
+    language probabilities averaged over those windows, most likely first.
     """
-    model = whisper.load_model("tiny")  
-    result = model.transcribe(audio_path, task="transcribe", language=None, fp16=False)
-    return result.get("language", "unknown")
+    started = time.monotonic()
+    model = get_language_model()
+    duration = probe_duration(audio_path)
+    if not duration or duration <= LANGUAGE_WINDOW_SECONDS:
+        offsets = [0.0]
+    else:
+        windows = min(LANGUAGE_SAMPLE_WINDOWS, int(duration // LANGUAGE_WINDOW_SECONDS))
+        step = duration / windows
+        offsets = [max(step * (i + 0.5) - LANGUAGE_WINDOW_SECONDS / 2, 0.0) for i in range(windows)]
+    ranked = rank_languages(model, [load_audio_window(audio_path, offset, LANGUAGE_WINDOW_SECONDS) for offset in offsets])
+    log(f"[language] Detected over {len(offsets)} window(s) in {time.monotonic() - started:.2f}s: {list(ranked.items())[:3]}")
+    return ranked
+
+def rank_languages(model, windows):
+    """Language probabilities averaged over decoded audio windows, most likely first."""
+    totals = {}
+    for window in windows:
+        audio = whisper.pad_or_trim(window)
+        mel = whisper.log_mel_spectrogram(audio, n_mels=getattr(model.dims, "n_mels", 80)).to(model.device)
+        _, probs = model.detect_language(mel)
+        for language, p in probs.items():
+            totals[language] = totals.get(language, 0.0) + p / len(windows)
+    return dict(sorted(totals.items(), key=lambda item: item[1], reverse=True))
+
+def detect_language_pcm(pcm):
+    """Detect the language of the start of a recording, given as 16 kHz s16le PCM bytes."""
+    started = time.monotonic()
+    model = get_language_model()
+    audio = np.frombuffer(pcm[:len(pcm) // 2 * 2], np.int16).astype(np.float32) / 32768.0
+    window = LANGUAGE_WINDOW_SECONDS * whisper.audio.SAMPLE_RATE
+    windows = [audio[i:i + window] for i in range(0, max(len(audio), 1), window)][:LANGUAGE_SAMPLE_WINDOWS]
+    # A short tail is mostly padding; it only counts when it is all there is.
+    windows = [w for w in windows if len(w) == window] or windows[:1]
+    ranked = rank_languages(model, windows)
+    log(f"[language] Detected over the first {len(windows)} window(s) of a stream in {time.monotonic() - started:.2f}s: {list(ranked.items())[:3]}")
+    return ranked
+
+def preprocess_command(file_path, out_path):
+    codec = {
+        "opus": ["-c:a", "libopus", "-b:a", AUDIO_OPUS_BITRATE, "-f", "ogg"],
+        "flac": ["-c:a", "flac", "-sample_fmt", "s16", "-f", "flac"],
+    }[AUDIO_PREPROCESS]
+    return [
+        "ffmpeg", "-nostdin", "-v", "error", "-y", "-i", file_path,
+        "-map", "0:a:0", "-ac", "1", "-ar", str(whisper.audio.SAMPLE_RATE), *codec,
+        "-progress", "pipe:1", "-nostats", out_path,
+    ]
+
+async def preprocess_audio(file_path, trace=None):
+    """
+    Extract the audio track of file_path as 16 kHz mono AUDIO_PREPROCESS, which is all
+    WhisperX uses, so the upload is a fraction of a WAV or video container. Returns
+    (path to upload, duration in seconds or None). The original file is returned when
+    preprocessing is off, ffmpeg fails or the result is not smaller.
+    """
+    global preprocess_slots
+    if not AUDIO_PREPROCESS:
+        return file_path, None
+    if preprocess_slots is None:
+        preprocess_slots = asyncio.Semaphore(AUDIO_PREPROCESS_WORKERS)
+    out_path = file_path.rsplit(".audio", 1)[0] + f".{AUDIO_PREPROCESS}.audio"
+    async with preprocess_slots:
+        started = time.monotonic()
+        try:
+            proc = await asyncio.create_subprocess_exec(*preprocess_command(file_path, out_path),
+                                                        stdout=asyncio.subprocess.PIPE, stderr=asyncio.subprocess.PIPE)
+        except OSError as e:
+            log(f"[preprocess] Could not run ffmpeg, uploading {file_path} as is: {e}")
+            return file_path, None
+        try:
+            stdout, stderr = await proc.communicate()
+        except asyncio.CancelledError:
+            proc.kill()
+            raise
+        elapsed = time.monotonic() - started
+    if proc.returncode != 0:
+        log(f"[preprocess] ffmpeg failed for {file_path}, uploading it as is: {stderr.decode(errors='replace').strip()}")
+        if os.path.exists(out_path):
+            os.remove(out_path)
+        return file_path, None
+    # -progress reports the encoded length as out_time_us; the last report is the total.
+    duration = None
+    for line in stdout.decode().splitlines():
+        key, _, value = line.partition("=")
+        if key == "out_time_us" and value.strip().isdigit():
+            duration = int(value) / 1e6
+    original = os.path.getsize(file_path)
+    compressed = os.path.getsize(out_path)
+    if compressed >= original:
+        log(f"[preprocess] {AUDIO_PREPROCESS} would not shrink {file_path} ({original} -> {compressed} bytes), uploading it as is.")
+        os.remove(out_path)
+        return file_path, duration
+    metrics.inc("whisper_bot_preprocess_saved_bytes_total", original - compressed)
+    if trace is not None:
+        trace.note(upload_bytes=compressed, saved_bytes=original - compressed)
+    log(f"[preprocess] {file_path}: {original} -> {compressed} bytes ({1 - compressed / original:.0%} smaller) in {elapsed:.1f}s")
+    return out_path, duration
+
+async def detect_language_async(audio_path):
+    loop = asyncio.get_running_loop()
+    return await loop.run_in_executor(language_executor, detect_language, audio_path)
+
+class HttpResponse:
+    def __init__(self, status, headers, body):
+        self.status = status
+        self.headers = headers
+        self.body = body
+    @property
+    def text(self):
+        return self.body.decode("utf-8", errors="replace")
+    def json(self):
+        return json.loads(self.body)
+
+class HttpClient:
+    """
+    Shared aiohttp session with a keep-alive connection pool. Requests are retried with
+    exponential backoff on connection errors, timeouts and gateway errors.
+    """
+    RETRY_STATUSES = (502, 503, 504)
+    def __init__(self, pool_size=HTTP_POOL_SIZE, retries=HTTP_RETRIES, backoff=1.0, max_backoff=30.0):
+        self.pool_size = pool_size
+        self.retries = retries
+        self.backoff = backoff
+        self.max_backoff = max_backoff
+        self.session = None
+    def get_session(self):
+        if self.session is None or self.session.closed:
+            connector = aiohttp.TCPConnector(limit=self.pool_size, keepalive_timeout=60)
+            self.session = aiohttp.ClientSession(connector=connector)
+        return self.session
+    def backoff_delay(self, attempt):
+        return min(self.backoff * 2 ** attempt, self.max_backoff) * random.uniform(0.5, 1.0)
+    async def request(self, method, url, *, timeout=30, retries=None, **kwargs):
+        retries = self.retries if retries is None else retries
+        for attempt in range(retries + 1):
+            try:
+                async with self.get_session().request(method, url, timeout=aiohttp.ClientTimeout(total=timeout), **kwargs) as resp:
+                    response = HttpResponse(resp.status, resp.headers, await resp.read())
+                if response.status not in self.RETRY_STATUSES or attempt == retries:
+                    return response
+                log(f"[http] {method} {url} returned {response.status}, retrying (attempt {attempt + 1})")
+            except (aiohttp.ClientError, asyncio.TimeoutError) as e:
+                if attempt == retries:
+                    raise
+                log(f"[http] {method} {url} failed: {e!r}, retrying (attempt {attempt + 1})")
+            await asyncio.sleep(self.backoff_delay(attempt))
+    async def get_lines(self, url, parse=lambda line: line, *, timeout=600, retries=None):
+        """
+        GET a line-oriented body, such as JSON Lines, and parse each non-empty line as it
+        arrives. aiohttp advertises and decodes the compressed encodings it supports.
+        A dropped connection restarts the request. Returns the response and the parsed
+        lines, which are None unless the status is 200.
+        """
+        retries = self.retries if retries is None else retries
+        for attempt in range(retries + 1):
+            try:
+                async with self.get_session().get(url, timeout=aiohttp.ClientTimeout(total=timeout)) as resp:
+                    if resp.status == 200:
+                        lines = []
+                        async for line in resp.content:
+                            line = line.decode("utf-8", errors="replace").rstrip("\r\n")
+                            if line:
+                                lines.append(parse(line))
+                        return HttpResponse(200, resp.headers, b""), lines
+                    response = HttpResponse(resp.status, resp.headers, await resp.read())
+                if response.status not in self.RETRY_STATUSES or attempt == retries:
+                    return response, None
+                log(f"[http] GET {url} returned {response.status}, retrying (attempt {attempt + 1})")
+            except (aiohttp.ClientError, asyncio.TimeoutError) as e:
+                if attempt == retries:
+                    raise
+                log(f"[http] Download of {url} failed: {e!r}, retrying (attempt {attempt + 1})")
+            await asyncio.sleep(self.backoff_delay(attempt))
+    async def close(self):
+        if self.session is not None:
+            await self.session.close()
+
+http = HttpClient()
 
 class RunPodAPI:
-    def __init__(self, api_key, pod_id, endpoint_url):
+    # start_pod result when RunPod had no free GPUs for any of the attempts.
+    NO_GPUS = "NO_GPUS"
+    def __init__(self, api_key, pod_id, endpoint_url, rest_url="https://rest.runpod.io/v1"):
         self.api_key = api_key
         self.pod_id = pod_id
         self.endpoint_url = endpoint_url
-        self.base_url = "https://api.runpod.io/graphql"
-        self.headers = {
-            "Authorization": f"Bearer {self.api_key}",
-            "Content-Type": "application/json",
-        }
+        self.rest_url = rest_url.rstrip("/")
+        self.headers = {"Authorization": f"Bearer {self.api_key}"}
+    def get_base_url(self):
+        return self.endpoint_url.rstrip("/")
     def get_server_url(self):
-        return self.endpoint_url.rstrip("/") + "/run_whisperx"
-    def get_pod_status(self):
-        url = f"https://rest.runpod.io/v1/pods/{self.pod_id}"
-        headers = {"Authorization": f"Bearer {self.api_key}"}
-        resp = requests.get(url, headers=headers)
-        if resp.status_code == 200:
+        return self.get_base_url() + "/run_whisperx"
+    async def get_pod_status(self):
+        if not self.pod_id:
+            return "RUNNING"
+        resp = await http.request("GET", f"{self.rest_url}/pods/{self.pod_id}", headers=self.headers)
+        if resp.status == 200:
             data = resp.json()
             return data.get("desiredStatus", None)
         return None
-    def start_pod(self):
-        url = f"https://rest.runpod.io/v1/pods/{self.pod_id}/start"
-        headers = {"Authorization": f"Bearer {self.api_key}"}
-        resp = requests.post(url, headers=headers)
-        print(f"Starting pod {self.pod_id}, response: {resp.status_code} {resp.text}")
-        if resp.status_code == 500:
-            data = resp.json()
-            if "error" in data and "not enough free GPUs" in data["error"]:
-                log("Pod start error: not enough free GPUs available.")
-                time.sleep(5)
-                log("Retrying pod start...")
-                return self.start_pod()
-            return data.get("status", None)
-        if resp.status_code == 200:
+    async def start_pod(self, attempts=POD_START_ATTEMPTS):
+        url = f"{self.rest_url}/pods/{self.pod_id}/start"
+        for attempt in range(attempts):
+            resp = await http.request("POST", url, headers=self.headers)
+            log(f"Starting pod {self.pod_id}, response: {resp.status} {resp.text}")
+            if resp.status == 500:
+                try:
+                    data = resp.json()
+                except ValueError:
+                    return None
+                if "error" in data and "not enough free GPUs" in data["error"]:
+                    if attempt == attempts - 1:
+                        break
+                    delay = http.backoff_delay(attempt)
+                    log(f"Pod start error: not enough free GPUs available. Retrying in {delay:.1f}s...")
+                    await asyncio.sleep(delay)
+                    continue
+                return data.get("status", None)
+            if resp.status == 200:
+                data = resp.json()
+                return data.get("status", None)
+            return None
+        log(f"Pod {self.pod_id} could not be started after {attempts} attempts.")
+        return self.NO_GPUS
+    async def pause_pod(self):
+        if not self.pod_id:
+            return None
+        resp = await http.request("POST", f"{self.rest_url}/pods/{self.pod_id}/stop", headers=self.headers)
+        if resp.status == 200:
             data = resp.json()
             return data.get("status", None)
         return None
-    def pause_pod(self):
-        url = f"https://rest.runpod.io/v1/pods/{self.pod_id}/stop"
-        headers = {"Authorization": f"Bearer {self.api_key}"}
-        resp = requests.post(url, headers=headers)
-        if resp.status_code == 200:
-            data = resp.json()
-            return data.get("status", None)
+
+class TranscriptCache:
+    """
+    Finished transcripts keyed by a hash of the audio (or its Telegram file id) and the
+    job parameters. Entries have a JSON index; entries older than max_age are dropped and
+    the least recently used ones are evicted once the total size exceeds max_bytes.
+    """
+    def __init__(self, directory, max_bytes, max_age):
+        self.directory = directory
+        self.max_bytes = max_bytes
+        self.max_age = max_age
+        self.index_path = os.path.join(directory, "index.json")
+        self.hits = 0
+        self.misses = 0
+        os.makedirs(directory, exist_ok=True)
+        try:
+            with open(self.index_path) as f:
+                self.index = json.load(f)
+        except (OSError, ValueError):
+            self.index = {}
+    @staticmethod
+    def make_key(*parts):
+        return hashlib.sha256("|".join(str(p) for p in parts).encode()).hexdigest()
+    def _save_index(self):
+        tmp_path = self.index_path + ".tmp"
+        with open(tmp_path, "w") as f:
+            json.dump(self.index, f)
+        os.replace(tmp_path, self.index_path)
+    def _remove(self, key):
+        entry = self.index.pop(key)
+        if not any(e["file"] == entry["file"] for e in self.index.values()):
+            try:
+                os.remove(os.path.join(self.directory, entry["file"]))
+            except FileNotFoundError:
+                pass
+    def get(self, key):
+        entry = self.index.get(key)
+        if entry is None or time.time() - entry["created"] > self.max_age:
+            self.misses += 1
+            log(f"[cache] Miss {key[:12]} (hits={self.hits}, misses={self.misses})")
+            return None
+        entry["last_used"] = time.time()
+        self._save_index()
+        self.hits += 1
+        log(f"[cache] Hit {key[:12]} (hits={self.hits}, misses={self.misses})")
+        return os.path.join(self.directory, entry["file"])
+    def put(self, keys, transcript_path):
+        """Store one transcript under several keys; they share a single file."""
+        name = f"{keys[0]}.txt"
+        shutil.copyfile(transcript_path, os.path.join(self.directory, name))
+        now = time.time()
+        for key in keys:
+            if key in self.index and self.index[key]["file"] != name:
+                self._remove(key)
+            self.index[key] = {"file": name, "size": os.path.getsize(transcript_path), "created": now, "last_used": now}
+        self._evict()
+        self._save_index()
+    def _evict(self):
+        now = time.time()
+        for key in [k for k, e in self.index.items() if now - e["created"] > self.max_age]:
+            self._remove(key)
+        sizes = {e["file"]: e["size"] for e in self.index.values()}
+        total = sum(sizes.values())
+        for key in sorted(self.index, key=lambda k: self.index[k]["last_used"]):
+            if total <= self.max_bytes:
+                break
+            name = self.index[key]["file"]
+            self._remove(key)
+            if name in sizes and not any(e["file"] == name for e in self.index.values()):
+                total -= sizes.pop(name)
+
+transcript_cache = TranscriptCache(CACHE_DIR, CACHE_MAX_BYTES, CACHE_MAX_AGE_DAYS * 86400)
+
+def telegram_file_key(media):
+    """Stable id of a Telegram document, shared by every forward of the same file."""
+    document = getattr(media, "document", None)
+    if document is None:
         return None
+    return f"tg:{document.id}"
 
-runpod_api = RunPodAPI(RUNPOD_API_KEY, RUNPOD_POD_ID, RUNPOD_ENDPOINT_URL)
+class Store:
+    """
+    Bot state that has to survive a restart, in SQLite (WAL mode): named counters with
+    atomic increments, user sessions, and the remote jobs those sessions submitted.
+    """
+    def __init__(self, path):
+        self.conn = sqlite3.connect(path, isolation_level=None)
+        self.conn.execute("PRAGMA journal_mode=WAL")
+        self.conn.execute("PRAGMA synchronous=NORMAL")
+        self.conn.execute("CREATE TABLE IF NOT EXISTS counters (name TEXT PRIMARY KEY, value INTEGER NOT NULL)")
+        self.conn.execute(
+            "CREATE TABLE IF NOT EXISTS sessions (user_id INTEGER NOT NULL, session_id TEXT NOT NULL, state TEXT NOT NULL,"
+            " updated_at REAL NOT NULL, PRIMARY KEY (user_id, session_id))"
+        )
+        self.conn.execute(
+            "CREATE TABLE IF NOT EXISTS jobs (job_id TEXT PRIMARY KEY, user_id INTEGER NOT NULL, session_id TEXT,"
+            " base_url TEXT NOT NULL, status TEXT NOT NULL, submitted_at REAL NOT NULL, finished_at REAL)"
+        )
+        self.conn.execute("CREATE INDEX IF NOT EXISTS jobs_session ON jobs (user_id, session_id, status)")
+    def incr(self, name, delta=1):
+        """Add delta to a counter, never going below zero, and return the new value."""
+        self.conn.execute("BEGIN IMMEDIATE")
+        try:
+            self.conn.execute(
+                "INSERT INTO counters (name, value) VALUES (?, max(?, 0)) ON CONFLICT (name) DO UPDATE SET value = max(value + ?, 0)",
+                (name, delta, delta),
+            )
+            value = self.conn.execute("SELECT value FROM counters WHERE name = ?", (name,)).fetchone()[0]
+            self.conn.execute("COMMIT")
+        except Exception:
+            self.conn.execute("ROLLBACK")
+            raise
+        return value
+    def set_counter(self, name, value):
+        self.conn.execute("INSERT OR REPLACE INTO counters (name, value) VALUES (?, ?)", (name, value))
+    def save_session(self, user_id, session_id, state):
+        self.conn.execute(
+            "INSERT OR REPLACE INTO sessions (user_id, session_id, state, updated_at) VALUES (?, ?, ?, ?)",
+            (user_id, session_id, json.dumps(state), time.time()),
+        )
+    def delete_session(self, user_id, session_id):
+        self.conn.execute("DELETE FROM sessions WHERE user_id = ? AND session_id = ?", (user_id, session_id))
+    def load_sessions(self):
+        """All stored sessions as {(user_id, session_id): state}, oldest first."""
+        rows = self.conn.execute("SELECT user_id, session_id, state FROM sessions ORDER BY updated_at").fetchall()
+        return {(user_id, session_id): json.loads(state) for user_id, session_id, state in rows}
+    def add_job(self, job_id, user_id, session_id, base_url):
+        self.conn.execute(
+            "INSERT OR REPLACE INTO jobs (job_id, user_id, session_id, base_url, status, submitted_at) VALUES (?, ?, ?, ?, 'running', ?)",
+            (job_id, user_id, session_id, base_url, time.time()),
+        )
+    def finish_job(self, job_id, status):
+        self.conn.execute("UPDATE jobs SET status = ?, finished_at = ? WHERE job_id = ?", (status, time.time(), job_id))
+    def running_job(self, user_id, session_id):
+        """(job_id, base_url) of the job a session is still waiting for, or None."""
+        return self.conn.execute(
+            "SELECT job_id, base_url FROM jobs WHERE user_id = ? AND session_id = ? AND status = 'running' ORDER BY submitted_at DESC LIMIT 1",
+            (user_id, session_id),
+        ).fetchone()
 
-def read_active_jobs() -> int:
-    try:
-        with open(ACTIVE_JOBS_FILE, "r") as f:
-            return int(f.read().strip())
-    except Exception:
-        return 0
+store = Store(STATE_DB)
 
-def write_active_jobs(value: int):
-    try:
-        with open(ACTIVE_JOBS_FILE, "w") as f:
-            f.write(str(value))
-    except Exception as e:
-        log(f"[active_jobs] File write error: {e}")
+# Steps of a session and the steps each may move to. Only await_file waits on the user
+# with no task running; the others belong to the task handling the session.
+SESSION_STEPS = {
+    "await_file": ("downloading",),
+    "downloading": ("confirm_language", "processing"),
+    "confirm_language": ("processing",),
+    "processing": (),
+}
+# Session files are named <user_id>_<session_id>_<timestamp>.<ext>.
+SESSION_FILE_PATTERN = re.compile(r"^(\d+)_([0-9a-f-]{36})_")
+
+class SessionEngine:
+    """
+    Open user sessions as a state machine over SESSION_STEPS, mirrored to the store so
+    they survive a restart. Sessions are ordered by last activity, and each user's
+    session awaiting a file and sessions awaiting a language reply are indexed by user
+    id, so an incoming message is routed in O(1). A session awaiting a file expires
+    after ttl without activity, and the least recently active one makes room once
+    max_sessions are open. Files of closed sessions stay until session files take more
+    than max_bytes, then go oldest first.
+    """
+    def __init__(self, store, ttl, max_sessions, max_bytes):
+        self.store = store
+        self.ttl = ttl
+        self.max_sessions = max_sessions
+        self.max_bytes = max_bytes
+        self.states = OrderedDict()
+        self.active = {}
+        self.awaiting_file = {}
+        self.replies = {}
+        # Strong references, so running handlers are not garbage collected.
+        self.tasks = set()
+    def __len__(self):
+        return len(self.states)
+    def get(self, user_id, session_id):
+        return self.states.get((user_id, session_id))
+    def save(self, user_id, session_id):
+        key = (user_id, session_id)
+        self.states.move_to_end(key)
+        self.active[key] = time.monotonic()
+        self.store.save_session(user_id, session_id, self.states[key])
+    def update(self, user_id, session_id, **fields):
+        self.states[(user_id, session_id)].update(fields)
+        self.save(user_id, session_id)
+    def advance(self, user_id, session_id, step, **fields):
+        """Move a session to step, updating fields; raises ValueError if SESSION_STEPS does not allow it."""
+        state = self.states[(user_id, session_id)]
+        if step not in SESSION_STEPS[state["step"]]:
+            raise ValueError(f"Session {session_id} cannot go from {state['step']} to {step}")
+        state.update(fields, step=step)
+        self.save(user_id, session_id)
+        if step == "confirm_language":
+            # Registered before the user is asked, so a quick reply is not missed.
+            self.replies.setdefault(user_id, OrderedDict())[session_id] = asyncio.get_running_loop().create_future()
+    def open(self, user_id, state):
+        """
+        Start a session awaiting a file, replacing the user's previous one if its file
+        never came. Returns the session id, or None if max_sessions are open and busy.
+        """
+        previous = self.awaiting_file.get(user_id)
+        if previous is not None:
+            log(f"[sessions] Session {previous} of user {user_id} replaced before its file arrived.")
+            self.drop(user_id, previous)
+        if len(self.states) >= self.max_sessions and not self.evict():
+            return None
+        session_id = str(uuid.uuid4())
+        self.states[(user_id, session_id)] = dict(state, step="await_file")
+        self.awaiting_file[user_id] = session_id
+        self.save(user_id, session_id)
+        return session_id
+    def restore(self, user_id, session_id, state):
+        """Reopen a session loaded from the store; a download cut short by the restart waits for the file again."""
+        if state["step"] == "downloading":
+            state["step"] = "await_file"
+        if state["step"] == "await_file" and user_id in self.awaiting_file:
+            self.drop(user_id, self.awaiting_file[user_id])
+        self.states[(user_id, session_id)] = state
+        if state["step"] == "await_file":
+            self.awaiting_file[user_id] = session_id
+        self.save(user_id, session_id)
+    def claim_file(self, user_id, message):
+        """The session of user_id awaiting a file, now downloading the one in message, or None."""
+        session_id = self.awaiting_file.pop(user_id, None)
+        if session_id is not None:
+            self.advance(user_id, session_id, "downloading", chat_id=message.chat_id, message_id=message.id)
+        return session_id
+    def drop(self, user_id, session_id):
+        """Close a session. Its files stay until sweep_files needs the space."""
+        key = (user_id, session_id)
+        self.states.pop(key, None)
+        self.active.pop(key, None)
+        if self.awaiting_file.get(user_id) == session_id:
+            del self.awaiting_file[user_id]
+        pending = self.replies.get(user_id)
+        if pending is not None:
+            pending.pop(session_id, None)
+            if not pending:
+                del self.replies[user_id]
+        self.store.delete_session(user_id, session_id)
+    def spawn(self, coro):
+        task = asyncio.create_task(coro)
+        self.tasks.add(task)
+        task.add_done_callback(self.tasks.discard)
+        return task
+    async def wait_reply(self, user_id, session_id, timeout):
+        """The user's text message routed by route_reply since the session began awaiting it; raises asyncio.TimeoutError."""
+        pending = self.replies.setdefault(user_id, OrderedDict())
+        future = pending.setdefault(session_id, asyncio.get_running_loop().create_future())
+        try:
+            return await asyncio.wait_for(future, timeout)
+        finally:
+            pending.pop(session_id, None)
+            if not pending and self.replies.get(user_id) is pending:
+                del self.replies[user_id]
+    def route_reply(self, user_id, message):
+        """Hand message to the user's oldest session awaiting a reply. Returns whether one took it."""
+        for future in self.replies.get(user_id, {}).values():
+            if not future.done():
+                future.set_result(message)
+                return True
+        return False
+    def expire(self, user_id, session_id, reason):
+        log(f"[sessions] Session {session_id} of user {user_id} expired ({reason}).")
+        metrics.inc("whisper_bot_sessions_expired_total", reason=reason)
+        self.drop(user_id, session_id)
+    def evict(self):
+        """Expire the least recently active session awaiting a file. Returns whether there was one."""
+        key = next((key for key, state in self.states.items() if state["step"] == "await_file"), None)
+        if key is None:
+            return False
+        self.expire(*key, "max_sessions")
+        return True
+    def expire_idle(self):
+        deadline = time.monotonic() - self.ttl
+        idle = []
+        for key, state in self.states.items():
+            if self.active[key] > deadline:
+                break
+            if state["step"] == "await_file":
+                idle.append(key)
+        for key in idle:
+            self.expire(*key, "ttl")
+    async def sweep_files(self):
+        """Remove files of closed sessions, oldest first, until session files take at most max_bytes."""
+        def scan():
+            files = []
+            for entry in os.scandir(FILES_DIR):
+                match = SESSION_FILE_PATTERN.match(entry.name)
+                if match and entry.is_file():
+                    stat = entry.stat()
+                    files.append((stat.st_mtime, entry.path, stat.st_size, (int(match[1]), match[2])))
+            return sorted(files)
+        files = await asyncio.to_thread(scan)
+        total = sum(size for _, _, size, _ in files)
+        removable = []
+        for _, path, size, key in files:
+            if total <= self.max_bytes:
+                break
+            if key not in self.states:
+                removable.append(path)
+                total -= size
+        if not removable:
+            if total > self.max_bytes:
+                log(f"[sessions] Open sessions hold {total} bytes of files, over SESSION_FILES_MAX_BYTES={self.max_bytes}.")
+            return
+        def remove():
+            freed = 0
+            for path in removable:
+                try:
+                    size = os.path.getsize(path)
+                    os.remove(path)
+                    freed += size
+                except FileNotFoundError:
+                    pass
+            return freed
+        freed = await asyncio.to_thread(remove)
+        metrics.inc("whisper_bot_session_files_removed_bytes_total", freed)
+        log(f"[sessions] Removed {len(removable)} files of closed sessions ({freed} bytes).")
+    async def run(self):
+        """Expire idle sessions and keep session files within quota, every SESSION_SWEEP_INTERVAL seconds."""
+        while True:
+            self.expire_idle()
+            try:
+                await self.sweep_files()
+            except OSError as e:
+                log(f"[sessions] Could not sweep {FILES_DIR}: {e}")
+            await asyncio.sleep(SESSION_SWEEP_INTERVAL)
+
+sessions = SessionEngine(store, SESSION_TTL, MAX_SESSIONS, SESSION_FILES_MAX_BYTES)
+
+class PodLifecycle:
+    """
+    Starts one endpoint's pod on demand and keeps it warm between jobs. Jobs and pre-warm
+    requests share one start attempt, and the pod counts as ready once the server's
+    /healthz reports its models loaded; the same probe reports the server's queue. When
+    the last job finishes the pod is paused only if no new job arrives within idle_grace.
+    Cold starts and idle time go to metrics_path.
+    """
+    def __init__(self, api, idle_grace, ready_timeout, metrics_path, name=None, start_attempts=POD_START_ATTEMPTS):
+        self.api = api
+        self.idle_grace = idle_grace
+        self.ready_timeout = ready_timeout
+        self.metrics_path = metrics_path
+        self.name = name or api.pod_id or api.get_base_url()
+        self.start_attempts = start_attempts
+        self.counter = f"active_jobs:{self.name}"
+        self.active = 0
+        self.ready = False
+        self.start_task = None
+        self.pause_task = None
+        self.idle_since = None
+        self.failed_at = None
+        # Jobs waiting for this pod to become ready.
+        self.waiting = 0
+        # Last queue state reported by /healthz.
+        self.queued = 0
+        self.running = 0
+        self.workers = 1
+        self.max_queue = None
+        # Set by the EndpointPool this endpoint belongs to.
+        self.pool = None
+        # One health check loop shared by every job running here, and how many jobs watch it.
+        self.monitor_task = None
+        self.watchers = 0
+    @property
+    def always_on(self):
+        return not self.api.pod_id
+    @property
+    def starting(self):
+        return self.start_task is not None and not self.start_task.done()
+    def load(self):
+        """Queued and running jobs per worker, counting jobs this bot sent that the server has not reported yet."""
+        return max(self.queued + self.running, self.active) / max(self.workers, 1)
+    def has_room(self):
+        return self.max_queue is None or self.queued < self.max_queue
+    def record(self, event, **data):
+        data = {"time": datetime.now().isoformat(timespec="seconds"), "event": event, "endpoint": self.name, **data}
+        try:
+            with open(self.metrics_path, "a") as f:
+                f.write(json.dumps(data) + "\n")
+        except OSError as e:
+            log(f"[pod {self.name}] Metrics write error: {e}")
+    async def probe(self):
+        """True once the WhisperX server answers /healthz with its models loaded."""
+        try:
+            resp = await http.request("GET", self.api.get_base_url() + "/healthz", timeout=10, retries=0)
+        except (aiohttp.ClientError, asyncio.TimeoutError):
+            return False
+        if resp.status == 404:
+            # Server predates /healthz; answering at all is the best signal it gives.
+            return True
+        try:
+            data = resp.json()
+        except ValueError:
+            return False
+        self.queued = data.get("queued", 0)
+        self.running = data.get("running", 0)
+        self.workers = data.get("workers", 1)
+        self.max_queue = data.get("max_queue")
+        return resp.status == 200 and bool(data.get("ready"))
+    async def _start(self, reason):
+        started = time.monotonic()
+        status = await self.api.get_pod_status()
+        cold = status != "RUNNING"
+        if cold:
+            log(f"[pod {self.name}] Pod not running (status={status}), resuming ({reason})...")
+            if await self.api.start_pod(self.start_attempts) == RunPodAPI.NO_GPUS:
+                status = RunPodAPI.NO_GPUS
+            else:
+                for _ in range(60):
+                    await asyncio.sleep(5)
+                    status = await self.api.get_pod_status()
+                    if status == "RUNNING":
+                        break
+            if status != "RUNNING":
+                log(f"[pod {self.name}] Pod did not start in time or not enough GPUs.")
+                self.failed(reason, started)
+                return False
+        while not await self.probe():
+            if time.monotonic() - started >= self.ready_timeout:
+                log(f"[pod {self.name}] Pod is running but the WhisperX server did not become ready in time.")
+                self.failed(reason, started)
+                return False
+            await asyncio.sleep(POD_PROBE_INTERVAL)
+        elapsed = time.monotonic() - started
+        self.ready = True
+        self.failed_at = None
+        log(f"[pod {self.name}] WhisperX server ready after {elapsed:.1f}s ({'cold' if cold else 'warm'} start, {reason})")
+        metrics.inc("whisper_bot_pod_starts_total", kind="cold" if cold else "warm")
+        self.record("cold_start" if cold else "warm_start", reason=reason, seconds=round(elapsed, 1))
+        return True
+    async def _monitor(self):
+        failures = 0
+        while failures < POOL_FAILED_PROBES:
+            await asyncio.sleep(POD_PROBE_INTERVAL)
+            failures = 0 if await self.probe() else failures + 1
+    async def watch(self):
+        """
+        Return once the endpoint has failed POOL_FAILED_PROBES health checks in a row. All
+        jobs watching the endpoint share one probe loop, which stops when the last leaves.
+        """
+        if self.monitor_task is None or self.monitor_task.done():
+            self.monitor_task = asyncio.create_task(self._monitor())
+        monitor = self.monitor_task
+        self.watchers += 1
+        try:
+            await asyncio.shield(monitor)
+        finally:
+            self.watchers -= 1
+            if self.watchers == 0 and monitor is self.monitor_task:
+                monitor.cancel()
+                self.monitor_task = None
+    def failed(self, reason, started):
+        self.failed_at = time.monotonic()
+        self.record("start_failed", reason=reason, seconds=round(time.monotonic() - started, 1))
+    def recently_failed(self):
+        return self.failed_at is not None and time.monotonic() - self.failed_at < POOL_FAILURE_COOLDOWN
+    def mark_failed(self):
+        """The server failed a job; it has to pass a fresh start check before it gets another."""
+        self.ready = False
+        self.failed_at = time.monotonic()
+    async def ensure_ready(self, reason="job"):
+        if self.ready and await self.probe():
+            return True
+        self.ready = False
+        if not self.starting:
+            self.start_task = asyncio.create_task(self._start(reason))
+        return await asyncio.shield(self.start_task)
+    def prewarm(self, reason="prewarm"):
+        """Start the pod in the background, e.g. while the user is still uploading."""
+        asyncio.create_task(self._prewarm(reason))
+    async def _prewarm(self, reason):
+        self.cancel_pause()
+        if await self.ensure_ready(reason) and self.active == 0:
+            self.schedule_pause()
+    def job_started(self):
+        self.active = store.incr(self.counter)
+        log(f"[active_jobs] {self.name} incremented: {self.active}")
+        self.cancel_pause()
+        if self.idle_since is not None:
+            self.record("reused", idle_seconds=round(time.monotonic() - self.idle_since, 1))
+            self.idle_since = None
+    def job_finished(self):
+        self.active = store.incr(self.counter, -1)
+        log(f"[active_jobs] {self.name} decremented: {self.active}")
+        if self.active == 0:
+            self.schedule_pause()
+    def cancel_pause(self):
+        if self.pause_task is not None:
+            self.pause_task.cancel()
+            self.pause_task = None
+    def schedule_pause(self):
+        self.cancel_pause()
+        if self.always_on:
+            return
+        if self.idle_since is None:
+            self.idle_since = time.monotonic()
+        log(f"[pod {self.name}] No active jobs, pausing pod in {self.idle_grace}s unless a new job arrives.")
+        self.pause_task = asyncio.create_task(self._pause_after(self.idle_grace))
+    async def _pause_after(self, delay):
+        await asyncio.sleep(delay)
+        if self.active > 0:
+            return
+        if self.pool is not None and self.pool.waiting():
+            # A job stuck on another pod's start may still move here.
+            self.pause_task = None
+            self.schedule_pause()
+            return
+        # Detach first so a job arriving mid-request cannot cancel the stop call.
+        self.pause_task = None
+        await self.pause()
+    async def pause(self):
+        idle = time.monotonic() - self.idle_since if self.idle_since is not None else 0.0
+        self.idle_since = None
+        self.ready = False
+        log(f"[pod {self.name}] Pausing pod after {idle:.0f}s idle.")
+        self.record("paused", idle_seconds=round(idle, 1))
+        await self.api.pause_pod()
+    async def shutdown(self):
+        """Pause now instead of leaving the pod running through a grace period nobody will end."""
+        if self.pause_task is not None:
+            self.cancel_pause()
+            await self.pause()
+
+class EndpointPool:
+    """
+    The WhisperX endpoints jobs can run on, each with its own PodLifecycle. A job goes to
+    the ready endpoint with the lowest load and room in its queue; stopped pods are only
+    started when no ready endpoint has room, and another pod is pre-warmed in the
+    background once the chosen endpoint is at scale_up_load. Pods pause independently.
+    """
+    def __init__(self, endpoints, scale_up_load):
+        self.endpoints = endpoints
+        self.scale_up_load = scale_up_load
+        for endpoint in endpoints:
+            endpoint.pool = self
+    @property
+    def active(self):
+        return sum(e.active for e in self.endpoints)
+    def waiting(self):
+        """Jobs waiting for a pod of the pool to start."""
+        return sum(e.waiting for e in self.endpoints)
+    async def refresh(self, endpoints):
+        """Probe endpoints for their readiness and current queue figures."""
+        for endpoint, ok in zip(endpoints, await asyncio.gather(*(e.probe() for e in endpoints))):
+            if endpoint.ready and not ok:
+                log(f"[pool] Endpoint {endpoint.name} stopped answering its health check.")
+                endpoint.mark_failed()
+            endpoint.ready = ok
+    def get(self, base_url):
+        return next((e for e in self.endpoints if e.api.get_base_url() == base_url.rstrip("/")), None)
+    def ready_endpoint(self):
+        """The least loaded endpoint last seen ready with room, without probing or starting any."""
+        ready = sorted((e for e in self.endpoints if e.ready and e.has_room()), key=lambda e: e.load())
+        return ready[0] if ready else None
+    def has_alternative(self, tried):
+        return any(e not in tried for e in self.endpoints)
+    def reset_counters(self):
+        for endpoint in self.endpoints:
+            store.set_counter(endpoint.counter, 0)
+    async def acquire(self, tried=()):
+        """The endpoint the next job should use, starting a pod if needed, or None if none can take it."""
+        candidates = [e for e in self.endpoints if e not in tried]
+        running = [e for e in candidates if e.ready or e.always_on]
+        await self.refresh(running)
+        ready = sorted((e for e in running if e.ready), key=lambda e: e.load())
+        with_room = [e for e in ready if e.has_room()]
+        if with_room:
+            if with_room[0].load() >= self.scale_up_load:
+                self.scale_up(tried)
+            return with_room[0]
+        # A burst is spread over starting pods: one more is started once each has scale_up_load
+        # jobs per worker waiting. Pods that failed recently, and then always-on servers that are
+        # down, come last.
+        def start_order(e):
+            busy = e.waiting / max(e.workers, 1) >= self.scale_up_load
+            return (e.always_on, e.recently_failed(), busy, not e.starting, e.waiting)
+        stopped = [e for e in candidates if not e.ready]
+        while stopped:
+            endpoint = min(stopped, key=start_order)
+            endpoint.waiting += 1
+            start = asyncio.ensure_future(endpoint.ensure_ready())
+            try:
+                while not start.done():
+                    await asyncio.wait({start}, timeout=POD_PROBE_INTERVAL)
+                    # Any other endpoint that is up with room beats waiting out a slow or broken
+                    # start. Probed again, as its queue figures may predate jobs finishing there.
+                    others = [e for e in candidates if e is not endpoint and e.ready]
+                    if start.done() or not others:
+                        continue
+                    await self.refresh(others)
+                    other = min((e for e in others if e.ready and e.has_room()), key=lambda e: e.load(), default=None)
+                    if not start.done() and other is not None:
+                        log(f"[pool] {endpoint.name} is still not ready, moving a waiting job to {other.name}.")
+                        metrics.inc("whisper_bot_failovers_total", endpoint=endpoint.name)
+                        start.cancel()
+                        return other
+                if start.result():
+                    return endpoint
+            finally:
+                endpoint.waiting -= 1
+            stopped.remove(endpoint)
+        # Every queue is full; submitting waits for room on the least loaded one.
+        return ready[0] if ready else None
+    def scale_up(self, tried=()):
+        if any(e.starting for e in self.endpoints):
+            return
+        endpoint = next((e for e in self.endpoints if e not in tried and not e.ready and not e.always_on and not e.recently_failed()), None)
+        if endpoint is not None:
+            log(f"[pool] All ready endpoints are busy, starting {endpoint.name}.")
+            endpoint.prewarm("scale_up")
+    def prewarm(self):
+        """Make sure some endpoint will be ready for an upload that is about to arrive."""
+        if not POD_PREWARM:
+            return
+        ready = sorted((e for e in self.endpoints if e.ready or e.starting), key=lambda e: e.load())
+        endpoint = ready[0] if ready else next((e for e in self.endpoints if not e.recently_failed()), self.endpoints[0])
+        endpoint.prewarm()
+    async def shutdown(self):
+        await asyncio.gather(*(e.shutdown() for e in self.endpoints))
+
+def make_endpoint_pool():
+    multiple = len(WHISPERX_ENDPOINTS) > 1
+    endpoints = []
+    for spec in WHISPERX_ENDPOINTS:
+        api = RunPodAPI(RUNPOD_API_KEY, spec.get("pod_id"), spec["url"], RUNPOD_REST_URL)
+        # With other endpoints to fall back on, a pod without free GPUs is not worth waiting for.
+        attempts = 1 if multiple else POD_START_ATTEMPTS
+        endpoints.append(PodLifecycle(api, POD_IDLE_GRACE, POD_READY_TIMEOUT, POD_METRICS_FILE, spec.get("name"), attempts))
+    return EndpointPool(endpoints, POOL_SCALE_UP_LOAD)
 
-try:
-    with open(ACTIVE_JOBS_FILE, "w") as f:
-        f.write("0")
-except Exception:
-    pass
+pod_pool = make_endpoint_pool()
 
 def is_user_authenticated(user_id: int) -> bool:
     try:
@@ -124,9 +1166,847 @@ def add_authenticated_user(user_id: int):
     except Exception as e:
         log(f"[users.txt] File write error: {e}")
 
+class QueueFullError(Exception):
+    def __init__(self, retry_after):
+        super().__init__(f"Server queue is full, retry after {retry_after}s")
+        self.retry_after = retry_after
+
+class EndpointUnavailable(RuntimeError):
+    """The endpoint cannot take or finish a job, so another endpoint should get it."""
+
+def file_sha256(path):
+    digest = hashlib.sha256()
+    with open(path, "rb") as f:
+        for chunk in iter(lambda: f.read(UPLOAD_CHUNK_SIZE), b""):
+            digest.update(chunk)
+    return digest.hexdigest()
+
+async def create_upload(base_url, filename, size):
+    """Start a chunked upload. Returns its id, or None if the server has no chunked upload support."""
+    resp = await http.request("POST", f"{base_url}/uploads", json={"filename": filename, "size": size})
+    if resp.status == 404:
+        return None
+    if resp.status == 429:
+        raise QueueFullError(int(resp.headers.get("Retry-After", "30")))
+    if resp.status != 201:
+        raise EndpointUnavailable(f"Upload init failed: {resp.status} {resp.text}")
+    return resp.json()["upload_id"]
+
+async def upload_chunked(base_url, file_path):
+    """
+    Upload file_path in UPLOAD_CHUNK_SIZE pieces, resuming from the server's offset after a
+    failure. Returns the upload id, or None if the server has no chunked upload support.
+    Raises EndpointUnavailable on any other failure.
+    """
+    size = os.path.getsize(file_path)
+    upload_id = await create_upload(base_url, os.path.basename(file_path), size)
+    if upload_id is None:
+        return None
+    chunk_url = f"{base_url}/uploads/{upload_id}"
+    offset = 0
+    failures = 0
+    started = time.monotonic()
+    with open(file_path, "rb") as f:
+        while offset < size:
+            f.seek(offset)
+            chunk = f.read(UPLOAD_CHUNK_SIZE)
+            try:
+                resp = await http.request("PUT", chunk_url, params={"offset": offset}, data=chunk, timeout=600, retries=0,
+                                          headers={"Content-Type": "application/octet-stream"})
+                metrics.inc("whisper_bot_upload_bytes_total", len(chunk))
+                if resp.status not in (200, 409):
+                    raise EndpointUnavailable(f"Chunk upload failed: {resp.status} {resp.text}")
+                offset = resp.json()["offset"]
+                failures = 0
+            except (aiohttp.ClientError, asyncio.TimeoutError) as e:
+                failures += 1
+                if failures > HTTP_RETRIES:
+                    raise
+                log(f"[upload] Chunk at offset {offset} failed: {e!r}, resuming (attempt {failures})")
+                await asyncio.sleep(http.backoff_delay(failures))
+                resp = await http.request("GET", chunk_url)
+                if resp.status != 200:
+                    raise EndpointUnavailable(f"Upload {upload_id} lost on server: {resp.status} {resp.text}")
+                offset = resp.json()["offset"]
+    log(f"[upload] {file_path} uploaded as {upload_id}: {size} bytes in {time.monotonic() - started:.1f}s")
+    return upload_id
+
+async def submit_whisperx_job(base_url, file_path, fields, upload=None):
+    """
+    Submit file_path with the given form fields. Uses the resumable chunked upload when the
+    server supports it and falls back to a single multipart POST otherwise. upload, a dict,
+    records the finished chunked upload as upload_id and sha256; one already recorded
+    there, e.g. by relay_download, is finalized instead of uploading again. A full queue
+    at finalize raises QueueFullError, so waiting for room does not repeat the upload.
+    """
+    upload = {} if upload is None else upload
+    if upload:
+        upload_id, sha256 = upload["upload_id"], upload["sha256"]
+    else:
+        upload_id = await upload_chunked(base_url, file_path)
+        if upload_id is None:
+            with open(file_path, "rb") as f:
+                form = aiohttp.FormData()
+                for name, value in fields.items():
+                    form.add_field(name, value)
+                form.add_field("audio", f, filename=os.path.basename(file_path), content_type="application/octet-stream")
+                metrics.inc("whisper_bot_upload_bytes_total", os.path.getsize(file_path))
+                return await http.request("POST", f"{base_url}/run_whisperx", data=form, timeout=3000, retries=0)
+        sha256 = await asyncio.to_thread(file_sha256, file_path)
+        upload.update(upload_id=upload_id, sha256=sha256)
+    # Retrying is safe: the server answers a repeated finalize with the job it already queued.
+    response = await http.request("POST", f"{base_url}/uploads/{upload_id}/finalize", data=dict(fields, sha256=sha256), timeout=600)
+    if response.status == 404:
+        raise EndpointUnavailable(f"Upload {upload_id} is gone from the server")
+    if response.status == 429:
+        raise QueueFullError(int(response.headers.get("Retry-After", "30")))
+    return response
+
+class DownloadRelay:
+    """
+    One pass over a Telegram download shared by several consumers. Every chunk is hashed
+    and, when staging, written to disk, then queued for each attached consumer. Queues are
+    bounded, so the download runs at most RELAY_BUFFER_CHUNKS ahead of the slowest
+    consumer; one that finishes early or fails is detached and stops holding it back.
+    The start and end of every stage, and the time consumers spent waiting for chunks,
+    feed the overlap report.
+    """
+    def __init__(self):
+        self.queues = {}
+        self.spans = {}
+        self.waits = {}
+        self.sha256 = hashlib.sha256()
+        self.size = 0
+    def attach(self, name):
+        """Register consumer name; returns an async iterator over the chunks as they arrive."""
+        queue = asyncio.Queue(RELAY_BUFFER_CHUNKS)
+        self.queues[name] = queue
+        self.waits[name] = 0.0
+        async def chunks():
+            while True:
+                started = time.monotonic()
+                chunk = await queue.get()
+                self.waits[name] += time.monotonic() - started
+                if chunk is None:
+                    return
+                yield chunk
+        return chunks()
+    def detach(self, name):
+        queue = self.queues.pop(name, None)
+        # Emptied so a download blocked on this full queue moves on.
+        while queue is not None and not queue.empty():
+            queue.get_nowait()
+    async def stage(self, name, coro):
+        """Run consumer name to completion. A failure detaches it and returns None."""
+        started = time.monotonic()
+        try:
+            return await coro
+        except (aiohttp.ClientError, asyncio.TimeoutError, OSError, ValueError, QueueFullError, EndpointUnavailable) as e:
+            log(f"[relay] {name} failed, continuing without it: {e!r}")
+            return None
+        finally:
+            self.spans[name] = (started, time.monotonic())
+            self.detach(name)
+    async def download(self, chunks, path=None):
+        started = time.monotonic()
+        with open(path, "wb") if path else nullcontext() as out:
+            async for chunk in chunks:
+                self.sha256.update(chunk)
+                self.size += len(chunk)
+                if out is not None:
+                    out.write(chunk)
+                for queue in list(self.queues.values()):
+                    await queue.put(chunk)
+        for queue in list(self.queues.values()):
+            await queue.put(None)
+        self.spans["download"] = (started, time.monotonic())
+    def report(self, trace):
+        """
+        Note how long each stage was busy, how much of its run overlapped the download,
+        and the time saved over running the stages one after another as the staged path
+        does. A consumer is busy for its run less the time it waited for chunks.
+        """
+        start = min(s for s, _ in self.spans.values())
+        end = max(e for _, e in self.spans.values())
+        download_start, download_end = self.spans["download"]
+        busy = {name: e - s - self.waits.get(name, 0.0) for name, (s, e) in self.spans.items()}
+        saved = max(sum(busy.values()) - (end - start), 0.0)
+        notes = {}
+        for name, (s, e) in self.spans.items():
+            notes[f"relay_{name}"] = f"{busy[name]:.2f}s"
+            if name != "download":
+                notes[f"relay_{name}_overlap"] = f"{max(min(e, download_end) - max(s, download_start), 0.0):.2f}s"
+        notes["relay_saved"] = f"{saved:.2f}s"
+        trace.note(**notes)
+        metrics.inc("whisper_bot_relay_saved_seconds_total", saved)
+        log(f"[relay] {self.size} bytes relayed in {end - start:.2f}s: {' '.join(f'{k}={v}' for k, v in notes.items())}")
+
+async def relay_upload(base_url, chunks, filename, size):
+    """
+    Upload chunks through the chunked upload API as they arrive, without finalizing.
+    Returns the upload id, or None if the server has no chunked upload support. A failed
+    PUT is resent from the server's offset while those bytes are still in hand.
+    """
+    upload_id = await create_upload(base_url, filename, size)
+    if upload_id is None:
+        return None
+    chunk_url = f"{base_url}/uploads/{upload_id}"
+    offset = 0
+    pending = bytearray()
+    async def flush():
+        nonlocal offset
+        failures = 0
+        while pending:
+            try:
+                resp = await http.request("PUT", chunk_url, params={"offset": offset}, data=bytes(pending), timeout=600, retries=0,
+                                          headers={"Content-Type": "application/octet-stream"})
+                if resp.status not in (200, 409):
+                    raise EndpointUnavailable(f"Chunk upload failed: {resp.status} {resp.text}")
+            except (aiohttp.ClientError, asyncio.TimeoutError) as e:
+                failures += 1
+                if failures > HTTP_RETRIES:
+                    raise
+                log(f"[relay] Chunk at offset {offset} failed: {e!r}, resuming (attempt {failures})")
+                await asyncio.sleep(http.backoff_delay(failures))
+                resp = await http.request("GET", chunk_url)
+                if resp.status != 200:
+                    raise EndpointUnavailable(f"Upload {upload_id} lost on server: {resp.status} {resp.text}")
+            server_offset = resp.json()["offset"]
+            if not offset <= server_offset <= offset + len(pending):
+                raise EndpointUnavailable(f"Upload {upload_id} is at offset {server_offset}, outside the bytes still in hand")
+            metrics.inc("whisper_bot_upload_bytes_total", server_offset - offset)
+            del pending[:server_offset - offset]
+            offset = server_offset
+    async for chunk in chunks:
+        pending += chunk
+        if len(pending) >= UPLOAD_CHUNK_SIZE:
+            await flush()
+    await flush()
+    log(f"[relay] Relayed {offset} bytes to {base_url} as upload {upload_id}")
+    return upload_id
+
+async def relay_language(chunks, detach):
+    """
+    Decode the start of the stream with ffmpeg, fed chunk by chunk, and detect the
+    language in its first LANGUAGE_SAMPLE_WINDOWS windows. detach() is called as soon
+    as ffmpeg is done, so the download does not wait on this consumer during detection.
+    Returns probabilities like detect_language, or None if ffmpeg cannot decode the
+    stream as it arrives, e.g. an MP4 with its index at the end.
+    """
+    proc = await asyncio.create_subprocess_exec(
+        "ffmpeg", "-v", "error", "-i", "pipe:0", "-t", str(LANGUAGE_WINDOW_SECONDS * LANGUAGE_SAMPLE_WINDOWS),
+        "-f", "s16le", "-ac", "1", "-ar", str(whisper.audio.SAMPLE_RATE), "pipe:1",
+        stdin=asyncio.subprocess.PIPE, stdout=asyncio.subprocess.PIPE, stderr=asyncio.subprocess.PIPE)
+    async def feed():
+        try:
+            async for chunk in chunks:
+                proc.stdin.write(chunk)
+                await proc.stdin.drain()
+            proc.stdin.close()
+        except (BrokenPipeError, ConnectionResetError):
+            # ffmpeg decoded all it needs and exited.
+            pass
+    feeder = asyncio.create_task(feed())
+    try:
+        pcm, stderr = await asyncio.gather(proc.stdout.read(), proc.stderr.read())
+        await proc.wait()
+    finally:
+        feeder.cancel()
+        detach()
+        if proc.returncode is None:
+            proc.kill()
+    if not pcm:
+        log(f"[relay] ffmpeg could not decode the stream for language detection: {stderr.decode(errors='replace').strip()}")
+        return None
+    loop = asyncio.get_running_loop()
+    return await loop.run_in_executor(language_executor, detect_language_pcm, pcm)
+
+async def relay_download(client, message, file_path, trace, detect=False):
+    """
+    Download message's media in one pass shared by hashing, staging to file_path (with
+    RELAY_STAGE_TO_DISK, or when no endpoint is ready to take the upload), an upload to
+    an endpoint that is ready right now and, if detect, language detection. Returns (sha256, size, [base_url, upload_id] of
+    the relayed upload or None, language probabilities or None).
+    """
+    relay = DownloadRelay()
+    tasks = {}
+    endpoint = pod_pool.ready_endpoint()
+    if endpoint is not None:
+        # Counted as a job, so the pod is not paused under the upload.
+        endpoint.job_started()
+        base_url = endpoint.api.get_base_url()
+        size = getattr(getattr(message, "file", None), "size", None)
+        tasks["upload"] = asyncio.create_task(relay.stage("upload", relay_upload(base_url, relay.attach("upload"), os.path.basename(file_path), size)))
+    if detect:
+        tasks["language"] = asyncio.create_task(relay.stage("language", relay_language(relay.attach("language"), lambda: relay.detach("language"))))
+    try:
+        try:
+            await relay.download(client.iter_download(message.media), file_path if RELAY_STAGE_TO_DISK or endpoint is None else None)
+        except BaseException:
+            for task in tasks.values():
+                task.cancel()
+            raise
+        results = dict(zip(tasks, await asyncio.gather(*tasks.values())))
+    finally:
+        if endpoint is not None:
+            endpoint.job_finished()
+    relay.report(trace)
+    upload_id = results.get("upload")
+    return relay.sha256.hexdigest(), relay.size, [base_url, upload_id] if upload_id else None, results.get("language")
+
+def job_status_text(data):
+    position = data.get("queue_position")
+    if position:
+        minutes = int(data.get("estimated_start_in", 0) // 60)
+        return f"⏳ Queued for WhisperX: position {position}, starting in ~{minutes} min…"
+    if data.get("stage"):
+        return f"⏳ WhisperX: {data['stage']} ({data.get('progress') or 0:.0%})…"
+    return "⏳ Running WhisperX, please wait…"
+
+async def iter_sse(resp):
+    """Yield (event id, event type, data) from a Server-Sent Events response."""
+    buffer = b""
+    event_id, event_type, data_lines = None, "message", []
+    async for chunk in resp.content.iter_any():
+        buffer += chunk
+        while b"\n" in buffer:
+            raw, buffer = buffer.split(b"\n", 1)
+            line = raw.decode("utf-8").rstrip("\r")
+            if not line:
+                if data_lines:
+                    yield event_id, event_type, json.loads("\n".join(data_lines))
+                event_id, event_type, data_lines = None, "message", []
+                continue
+            if line.startswith(":"):
+                continue
+            field, _, value = line.partition(":")
+            value = value[1:] if value.startswith(" ") else value
+            if field == "id":
+                event_id = value
+            elif field == "event":
+                event_type = value
+            elif field == "data":
+                data_lines.append(value)
+
+async def follow_job_events(base_url, job_id, on_update):
+    """
+    Follow /job_events/<job_id> until the job finishes and return the final status dict.
+    Returns None if the server has no event stream or it keeps failing, so the caller can
+    fall back to polling.
+    """
+    url = f"{base_url}/job_events/{job_id}"
+    last_id = None
+    failures = 0
+    while failures <= HTTP_RETRIES:
+        headers = {"Accept": "text/event-stream"}
+        if last_id is not None:
+            headers["Last-Event-ID"] = last_id
+        try:
+            timeout = aiohttp.ClientTimeout(total=JOB_TIMEOUT, sock_read=EVENTS_READ_TIMEOUT)
+            async with http.get_session().get(url, headers=headers, timeout=timeout) as resp:
+                if resp.status == 404:
+                    return None
+                if resp.status == 200:
+                    async for event_id, event_type, data in iter_sse(resp):
+                        if event_id is not None:
+                            last_id = event_id
+                        if event_type in ("done", "error"):
+                            return dict(data, status=event_type)
+                        await on_update(event_type, data)
+                        failures = 0
+                log(f"[events] Stream for job {job_id} ended early (status {resp.status}), reconnecting")
+        except (aiohttp.ClientError, asyncio.TimeoutError) as e:
+            log(f"[events] Stream for job {job_id} failed: {e!r}, reconnecting")
+        failures += 1
+        await asyncio.sleep(http.backoff_delay(failures))
+    return None
+
+async def poll_job_status(base_url, job_id, on_update):
+    status_url = f"{base_url}/job_status/{job_id}"
+    for poll_count in range(JOB_TIMEOUT // 10):
+        status_resp = await http.request("GET", status_url, timeout=10)
+        if status_resp.status == 404:
+            return {"status": "lost"}
+        if status_resp.status == 200:
+            status_data = status_resp.json()
+            if status_data.get("status") in ("done", "error"):
+                return status_data
+            await on_update("status", status_data)
+        await asyncio.sleep(10)
+    return {"status": "timeout"}
+
+async def send_with_flood_wait(send, text, what):
+    """Call send(text), waiting out Telegram flood limits. Returns what send returns."""
+    while True:
+        try:
+            return await send(text)
+        except FloodWaitError as e:
+            log(f"[telegram] Flood wait of {e.seconds}s while {what}")
+            await asyncio.sleep(e.seconds)
+
+class StatusMessage:
+    """
+    Keeps a status message at the latest job status, edited at most once per
+    PARTIAL_EDIT_INTERVAL. Statuses that arrive in between replace each other, so a burst
+    of queue and progress events costs one edit.
+    """
+    def __init__(self, message):
+        self.message = message
+        self.shown = None
+        self.pending = None
+        self.last_edit = 0.0
+        self.edit_task = None
+        self.lock = asyncio.Lock()
+    async def set(self, text):
+        self.pending = text
+        delay = self.last_edit + PARTIAL_EDIT_INTERVAL - time.monotonic()
+        if delay <= 0:
+            await self.flush()
+        elif self.edit_task is None:
+            self.edit_task = asyncio.create_task(self._flush_later(delay))
+    async def _flush_later(self, delay):
+        await asyncio.sleep(delay)
+        self.edit_task = None
+        await self.flush()
+    async def flush(self):
+        async with self.lock:
+            text, self.pending = self.pending, None
+            if text is None or text == self.shown:
+                return
+            await send_with_flood_wait(self.message.edit, text, "updating job status")
+            self.shown = text
+            self.last_edit = time.monotonic()
+    def cancel(self):
+        """Drop a pending edit, so it cannot overwrite what the caller shows next."""
+        task, self.edit_task = self.edit_task, None
+        if task is not None:
+            task.cancel()
+
+def format_timestamp(seconds):
+    seconds = int(seconds)
+    return f"{seconds // 3600:02d}:{seconds // 60 % 60:02d}:{seconds % 60:02d}"
+
+class LiveTranscript:
+    """
+    Mirrors partial segments into Telegram while a job runs. The newest message is edited
+    in place, at most once per PARTIAL_EDIT_INTERVAL, and a new one is started when it
+    would exceed the message limit.
+    """
+    HEADER = "✍️ Live draft, speaker labels follow with the final transcript:"
+    def __init__(self, event_copy):
+        self.event = event_copy
+        self.message = None
+        self.text = ""
+        self.pending = []
+        self.last_flush = 0.0
+        self.flush_task = None
+        self.lock = asyncio.Lock()
+    async def add(self, segments):
+        if self.message is None and not self.text and not self.pending:
+            self.pending.append(self.HEADER)
+        self.pending.extend(f"[{format_timestamp(s['start'])}] {s['text']}" for s in segments)
+        delay = self.last_flush + PARTIAL_EDIT_INTERVAL - time.monotonic()
+        if delay <= 0:
+            await self.flush()
+        elif self.flush_task is None:
+            self.flush_task = asyncio.create_task(self._flush_later(delay))
+    async def _flush_later(self, delay):
+        await asyncio.sleep(delay)
+        self.flush_task = None
+        await self.flush()
+    async def flush(self):
+        async with self.lock:
+            while self.pending:
+                text = self.text
+                while self.pending:
+                    line = self.pending[0][:TELEGRAM_MESSAGE_LIMIT]
+                    if text and len(text) + len(line) + 1 > TELEGRAM_MESSAGE_LIMIT:
+                        break
+                    text = f"{text}\n{line}" if text else line
+                    self.pending.pop(0)
+                await self._send(text)
+                self.text = text
+                if self.pending:
+                    self.message, self.text = None, ""
+            self.last_flush = time.monotonic()
+    async def _send(self, text):
+        if self.message is None:
+            self.message = await send_with_flood_wait(self.event.reply, text, "sending draft")
+        else:
+            await send_with_flood_wait(self.message.edit, text, "sending draft")
+    async def close(self):
+        task, self.flush_task = self.flush_task, None
+        if task is not None:
+            task.cancel()
+        await self.flush()
+
+async def wait_for_job(base_url, job_id, status_msg, live=None):
+    """Wait for a job to finish, preferring the pushed event stream over polling."""
+    progress = {}
+    status = StatusMessage(status_msg)
+    async def on_update(event_type, data):
+        if event_type == "segments":
+            if live is not None:
+                await live.add(data["segments"])
+            return
+        if event_type in ("running", "progress"):
+            progress.pop("queue_position", None)
+        progress.update(data)
+        await status.set(job_status_text(progress))
+    try:
+        result = await follow_job_events(base_url, job_id, on_update)
+        if result is None:
+            log(f"[events] No event stream for job {job_id}, polling /job_status instead")
+            result = await poll_job_status(base_url, job_id, on_update)
+    finally:
+        status.cancel()
+    if live is not None:
+        await live.close()
+    return result
+
+async def wait_for_job_on(endpoint, job_id, status_msg, live=None):
+    """wait_for_job, giving up with EndpointUnavailable as soon as the endpoint stops answering health checks."""
+    job = asyncio.create_task(wait_for_job(endpoint.api.get_base_url(), job_id, status_msg, live))
+    watchdog = asyncio.create_task(endpoint.watch())
+    try:
+        await asyncio.wait({job, watchdog}, return_when=asyncio.FIRST_COMPLETED)
+        if not job.done():
+            raise EndpointUnavailable(f"{endpoint.name} stopped answering health checks")
+        return job.result()
+    finally:
+        job.cancel()
+        watchdog.cancel()
+
+async def submit_with_retry(event_copy, status_msg, base_url, file_path, fields, wait_when_full=True, relayed_upload=None):
+    """
+    Submit a job, waiting out a full queue unless wait_when_full is false, in which case
+    QueueFullError is raised. Returns (job_id, None) or (None, error lines); raises
+    EndpointUnavailable if the server fails the submission. A chunked upload, or the
+    (upload_id, sha256) of relayed_upload, is finalized again after a wait, not resent.
+    """
+    upload = dict(zip(("upload_id", "sha256"), relayed_upload)) if relayed_upload else {}
+    for attempt in range(30):
+        try:
+            response = await submit_whisperx_job(base_url, file_path, fields, upload)
+        except QueueFullError as e:
+            retry_after = e.retry_after
+        else:
+            if response.status != 429:
+                break
+            retry_after = int(response.headers.get("Retry-After", "30"))
+        if not wait_when_full:
+            raise QueueFullError(retry_after)
+        log(f"Remote WhisperX queue is full, retrying in {retry_after}s (attempt {attempt + 1}).")
+        if attempt == 0:
+            await status_msg.edit("⏳ Server is busy, your file will be submitted as soon as there is room…")
+        await asyncio.sleep(retry_after)
+    else:
+        log("Remote WhisperX queue stayed full, giving up.")
+        await event_copy.reply("❌ Remote error: Server is busy. Please try again later.")
+        return None, ["Remote error: Server is busy."]
+    if response.status >= 500:
+        raise EndpointUnavailable(f"Submission failed: {response.status} {response.text}")
+    if response.status not in (200, 202):
+        log(f"Remote WhisperX error: {response.text}")
+        await event_copy.reply(f"❌ Remote error: {response.text}")
+        return None, [f"Remote error: {response.text}"]
+    job_id = response.json().get("job_id")
+    if not job_id:
+        log(f"Remote WhisperX error: No job_id in response: {response.text}")
+        await event_copy.reply(f"❌ Remote error: No job_id in response: {response.text}")
+        return None, [f"Remote error: No job_id in response: {response.text}"]
+    log(f"Job submitted, job_id={job_id}")
+    return job_id, None
+
+async def run_whisperx_and_monitor(event_copy, status_msg, user_id, file_path, min_speakers, max_speakers, language, session_id=None, trace=None,
+                                   upload_path=None, duration=None, profile=None, relayed=None):
+    """
+    Run the job on the least loaded endpoint of the pool, moving it to another endpoint
+    when one cannot be started, rejects the upload or fails while the job runs.
+    upload_path, if given, is the preprocessed audio sent instead of file_path, and
+    profile the execution profile the user asked for. relayed, a (base_url, upload_id,
+    sha256) upload left by relay_download, makes that endpoint the first choice.
+    """
+    trace = trace or Trace()
+    attached = store.running_job(user_id, session_id) if session_id else None
+    preferred = relayed[0] if relayed else None
+    tried = set()
+    full = set()
+    while True:
+        endpoint = pod_pool.get(attached[1]) if attached else None
+        if endpoint is None and preferred:
+            endpoint = pod_pool.get(preferred)
+            preferred = None
+        with trace.span("pod_ready"):
+            if endpoint is None or not await endpoint.ensure_ready():
+                if endpoint is not None:
+                    tried.add(endpoint)
+                endpoint = await pod_pool.acquire(tried)
+        if endpoint is None and full:
+            # Nothing else could take it, so wait for room on the least loaded full endpoint.
+            endpoint = min(full, key=lambda e: e.load())
+            full.discard(endpoint)
+        if endpoint is None:
+            await event_copy.reply("❌ Remote error: No WhisperX server could be started (pods did not start in time or not enough GPUs). Please try again later.")
+            return ["Remote error: No WhisperX server could be started."]
+        job_id = None
+        if attached:
+            if attached[1] == endpoint.api.get_base_url():
+                job_id = attached[0]
+                log(f"Re-attaching to job {job_id} on {endpoint.name} submitted before a restart (session {session_id}).")
+            else:
+                store.finish_job(attached[0], "abandoned")
+            attached = None
+        relayed_upload = relayed[1:] if relayed and relayed[0] == endpoint.api.get_base_url() else None
+        if job_id is None and relayed_upload is None and not os.path.exists(upload_path or file_path):
+            log(f"Relayed upload of user {user_id} cannot go to {endpoint.name} and no copy was staged (session {session_id}).")
+            await event_copy.reply("❌ Remote error: The WhisperX server holding your audio failed and no copy was kept. Please send the file again.")
+            return ["Remote error: Relayed audio lost."]
+        endpoint.job_started()
+        try:
+            wait_when_full = not pod_pool.has_alternative(tried | {endpoint})
+            return await run_on_endpoint(endpoint, event_copy, status_msg, user_id, file_path, min_speakers, max_speakers, language, session_id, trace, job_id, wait_when_full,
+                                         upload_path, duration, profile, relayed_upload)
+        except QueueFullError:
+            log(f"[pool] Queue of {endpoint.name} is full, trying another endpoint.")
+            tried.add(endpoint)
+            full.add(endpoint)
+        except (EndpointUnavailable, aiohttp.ClientError, asyncio.TimeoutError) as e:
+            log(f"[pool] Endpoint {endpoint.name} failed the job of user {user_id}: {e!r}")
+            metrics.inc("whisper_bot_failovers_total", endpoint=endpoint.name)
+            endpoint.mark_failed()
+            tried.add(endpoint)
+            if not pod_pool.has_alternative(tried):
+                await event_copy.reply(f"❌ Remote error: {e}. Please send the file again.")
+                return [f"Remote error: {e}"]
+            await status_msg.edit("⚠️ The WhisperX server failed, moving your file to another one…")
+        finally:
+            endpoint.job_finished()
+
+async def run_on_endpoint(endpoint, event_copy, status_msg, user_id, file_path, min_speakers, max_speakers, language, session_id, trace, job_id=None, wait_when_full=True,
+                          upload_path=None, duration=None, profile=None, relayed_upload=None):
+    """
+    Submit the job to endpoint, finalizing relayed_upload if it was relayed there, or
+    follow job_id already running there, and fetch the transcript.
+    """
+    base_url = endpoint.api.get_base_url()
+    log(f"Using remote WhisperX server {endpoint.name} at: {endpoint.api.get_server_url()}")
+    if job_id is None:
+        fields = {
+            "min_speakers": str(min_speakers),
+            "max_speakers": str(max_speakers),
+            "language": language,
+            "HF_TOKEN": HF_TOKEN,
+            "user_id": str(user_id),
+            "trace_id": trace.trace_id,
+        }
+        if duration:
+            # Spares the server an ffprobe of the upload for its queue estimates.
+            fields["duration"] = f"{duration:.2f}"
+        if profile:
+            fields["profile"] = profile
+        with trace.span("upload"):
+            job_id, error_lines = await submit_with_retry(event_copy, status_msg, base_url, upload_path or file_path, fields, wait_when_full, relayed_upload)
+        if job_id is None:
+            return error_lines
+        store.add_job(job_id, user_id, session_id, base_url)
+    transcript_path = file_path.rsplit(".audio", 1)[0] + ".txt"
+    try:
+        with trace.span("remote_job"):
+            status_data = await wait_for_job_on(endpoint, job_id, status_msg, LiveTranscript(event_copy))
+        status = status_data.get("status")
+        if status == "lost":
+            raise EndpointUnavailable("The server lost this job")
+        if status == "done":
+            log(f"Job {job_id} done, downloading transcript...")
+            with trace.span("transcript_download"):
+                transcript_resp, segments = await http.get_lines(f"{base_url}/get_transcript/{job_id}?format=jsonl", parse_transcript_line, timeout=600)
+    except Exception:
+        store.finish_job(job_id, "abandoned")
+        raise
+    trace.add_remote(status_data.get("timings"))
+    if status_data.get("profile"):
+        remote_profile = status_data["profile"]
+        trace.note(profile=remote_profile["name"], model=f"{remote_profile['model']}/{remote_profile['compute_type']}", batch_size=remote_profile["batch_size"])
+    if status != "done":
+        store.finish_job(job_id, status or "timeout")
+    if status == "error":
+        error_msg = status_data.get("error")
+        log(f"Job {job_id} error: {error_msg}")
+        await event_copy.reply(f"❌ WhisperX error: {error_msg}")
+        return [f"Remote error: {error_msg}"]
+    elif status != "done":
+        log(f"Job {job_id} timed out.")
+        await event_copy.reply("❌ Remote error: Job timed out.")
+        return ["Remote error: Job timed out."]
+    if transcript_resp.status == 200:
+        lines = [transcript_line(segment) for segment in segments]
+        # Written once, for the file reply and the cache; messages are built from lines.
+        with open(transcript_path, "w") as f:
+            f.write("".join(f"{line}\n" for line in lines))
+        log(f"Transcript of {len(segments)} segments downloaded from remote pod: {transcript_path}")
+        metrics.inc("whisper_bot_download_bytes_total", int(transcript_resp.headers.get("Content-Length") or os.path.getsize(transcript_path)), source="transcript")
+        store.finish_job(job_id, "done")
+        return lines
+    else:
+        log(f"Remote WhisperX error: {transcript_resp.text}")
+        store.finish_job(job_id, "error")
+        await event_copy.reply(f"❌ WhisperX error: {transcript_resp.text}")
+        return [f"Remote error: {transcript_resp.text}"]
+
+def parse_transcript_line(line):
+    """A JSON Lines segment; plain text lines, as older servers send, become text-only segments."""
+    try:
+        segment = json.loads(line)
+    except ValueError:
+        return {"text": line}
+    return segment if isinstance(segment, dict) else {"text": line}
+
+def transcript_line(segment):
+    speaker = segment.get("speaker")
+    return f"[{speaker}]: {segment['text']}" if speaker is not None else segment["text"]
+
+def transcript_messages(lines, limit=4000):
+    """Pack transcript lines into messages of at most limit characters, splitting only overlong lines."""
+    message = ""
+    for line in lines:
+        if message and len(message) + 1 + len(line) > limit:
+            yield message
+            message = ""
+        while len(line) > limit:
+            yield line[:limit]
+            line = line[limit:]
+        message = f"{message}\n{line}" if message else line
+    if message:
+        yield message
+
+async def send_transcript(event_copy, user_id, transcript_path, lines=None):
+    """Send the transcript as messages and as a file. lines, if given, spares reading the file."""
+    if lines is None:
+        with open(transcript_path, "r") as f:
+            lines = f.read().splitlines()
+        log(f"Transcript loaded from: {transcript_path}")
+    for index, message in enumerate(transcript_messages(lines), 1):
+        await event_copy.reply(message)
+        log(f"Transcript chunk {index} sent to user {user_id}, length: {len(message)}")
+    await event_copy.reply(file=transcript_path, message="📝 Transcript file")
+    log(f"Transcript file sent to user {user_id}: {transcript_path}")
+    await event_copy.reply("✅ Transcript sent as text and file. Ready for a new task! Start by entering number of speakers and language (e.g. 'add 2 en').")
+
+async def send_cached_transcript(event_copy, user_id, cached_path, transcript_path):
+    shutil.copyfile(cached_path, transcript_path)
+    await event_copy.reply("♻️ This file was already transcribed with the same settings, sending the saved transcript.")
+    await send_transcript(event_copy, user_id, transcript_path)
+
+def session_cache_key(source, state, language):
+    """Local cache key of a session's transcript; a profile is part of it only if the user named one."""
+    parts = [source, state["min_speakers"], state["max_speakers"], language]
+    if state.get("profile"):
+        parts.append(state["profile"])
+    return TranscriptCache.make_key(*parts)
+
+async def transcribe_session(event_copy, user_id, session_id, trace=None, preprocessing=None):
+    """
+    Transcribe a session whose audio is downloaded and language settled, and send the
+    result. preprocessing is a preprocess_audio task already started for the audio.
+    """
+    state = sessions.get(user_id, session_id)
+    trace = trace or Trace(state.get("trace_id"))
+    min_speakers = state["min_speakers"]
+    max_speakers = state["max_speakers"]
+    language = state["language"]
+    file_path = state["file_path"]
+    transcript_path = state["transcript_path"]
+    telegram_key = state.get("telegram_key")
+    with trace.span("hash"):
+        audio_sha256 = state.get("audio_sha256") or await asyncio.to_thread(file_sha256, file_path)
+    cache_keys = [session_cache_key(audio_sha256, state, language)]
+    if telegram_key:
+        cache_keys.append(session_cache_key(telegram_key, state, state["requested_language"]))
+        cache_keys.append(session_cache_key(telegram_key, state, language))
+    cached = transcript_cache.get(cache_keys[0])
+    if cached:
+        if preprocessing is not None:
+            preprocessing.cancel()
+        with trace.span("delivery"):
+            await send_cached_transcript(event_copy, user_id, cached, transcript_path)
+        trace.finish("cached")
+        sessions.drop(user_id, session_id)
+        return
+    if state.get("relay_upload"):
+        # Already on a server as received, so there is nothing to re-encode.
+        upload_path, duration = None, None
+    elif state.get("upload_path") and os.path.exists(state["upload_path"]):
+        upload_path, duration = state["upload_path"], state.get("duration")
+    else:
+        with trace.span("preprocess"):
+            upload_path, duration = await (preprocessing or preprocess_audio(file_path, trace))
+        sessions.update(user_id, session_id, upload_path=upload_path, duration=duration)
+    status_msg = await event_copy.reply("⏳ Running WhisperX, please wait…")
+    output_lines = await run_whisperx_and_monitor(event_copy, status_msg, user_id, file_path, min_speakers, max_speakers, language, session_id, trace,
+                                                  upload_path, duration, state.get("profile"),
+                                                  (*state["relay_upload"], audio_sha256) if state.get("relay_upload") else None)
+    log(f"WhisperX process finished for user {user_id}. Checking for transcript file.")
+    
+    if os.path.exists(transcript_path):
+        transcript_cache.put(cache_keys, transcript_path)
+        outcome = "done"
+    else:
+        output_lines = output_lines or ["No transcript found."]
+        with open(transcript_path, "w") as f:
+            f.write("\n".join(output_lines))
+        log(f"Transcript written to: {transcript_path}")
+        outcome = "error"
+    with trace.span("delivery"):
+        await send_transcript(event_copy, user_id, transcript_path, output_lines)
+    trace.finish(outcome)
+    log(f"All done for user {user_id}. State reset for next session.")
+    
+    sessions.drop(user_id, session_id)
+
+async def resume_session(message, user_id, session_id):
+    try:
+        await transcribe_session(message, user_id, session_id)
+    except Exception as exc:
+        import traceback
+        err_str = ''.join(traceback.format_exception(type(exc), exc, exc.__traceback__))
+        await message.reply("❌ Internal error occurred, check logs for details.")
+        log(f"Exception resuming session {session_id} of user {user_id}:\n{err_str}")
+        sessions.drop(user_id, session_id)
+
+async def resume_sessions(client):
+    """
+    Restore sessions saved before a restart. Sessions waiting for a file, or still
+    downloading it, wait again; sessions that already had their audio continue,
+    re-attaching to their remote job if one was submitted, so finished work is fetched
+    instead of recomputed.
+    """
+    # No task of the previous process survives; resumed jobs count themselves again.
+    pod_pool.reset_counters()
+    for (user_id, session_id), state in store.load_sessions().items():
+        if state.get("step") == "downloading":
+            message = await client.get_messages(state["chat_id"], ids=state["message_id"])
+            if message is not None:
+                await message.reply("🔄 The bot restarted while downloading your file, please send it again.")
+        sessions.restore(user_id, session_id, state)
+        if state["step"] == "await_file":
+            continue
+        if not state.get("file_path") or not (os.path.exists(state["file_path"]) or state.get("relay_upload")):
+            sessions.drop(user_id, session_id)
+            continue
+        message = await client.get_messages(state["chat_id"], ids=state["message_id"])
+        if message is None:
+            sessions.drop(user_id, session_id)
+            continue
+        if state["step"] == "confirm_language":
+            sessions.advance(user_id, session_id, "processing")
+            await message.reply(f"🔄 The bot restarted while waiting for your language reply, continuing with {state['language']}.")
+        else:
+            await message.reply("🔄 The bot restarted, resuming your transcription…")
+        log(f"Resuming session {session_id} of user {user_id} at step {state['step']}.")
+        sessions.spawn(resume_session(message, user_id, session_id))
+
 async def main():
-    global active_jobs_lock
-    active_jobs_lock = asyncio.Lock()
     client = TelegramClient(SESSION_NAME, API_ID, API_HASH)
     @client.on(events.NewMessage())
     async def handler(event):
@@ -142,32 +2022,28 @@ async def main():
             else:
                 await event.reply("🔒 Please enter the password to use this bot.")
                 return
-        if user_id not in user_tasks:
-            user_tasks[user_id] = []
-        
-        session_id = None
         
         if event.text and event.text.strip().lower().startswith("add"):
-            session_id = str(uuid.uuid4())
-            latest_session_id[user_id] = session_id
-        
-        elif event.media and user_id in latest_session_id:
-            session_id = latest_session_id[user_id]
-            del latest_session_id[user_id]  
+            # Opened once the command parses.
+            session_id = None
+        elif event.media:
+            session_id = sessions.claim_file(user_id, event)
+        elif sessions.route_reply(user_id, event):
+            return
         else:
-            
-            session_id = str(uuid.uuid4())
+            session_id = sessions.awaiting_file.get(user_id)
         async def process_task(event_copy, session_id):
             try:
                 log("=" * 60)
                 log(f"Current working directory: {os.getcwd()}")
                 log(f"Received message from user {user_id}. Message ID: {event.id}, Text: {event.text!r}, Media: {bool(event.media)}")
-                log(f"Current state for user {user_id}, session {session_id}: {user_states.get((user_id, session_id), {})}")
-                state = user_states.get((user_id, session_id), {})
+                state = sessions.get(user_id, session_id) or {}
+                log(f"Current state for user {user_id}, session {session_id}: {state}")
                 
-                if not state and not event_copy.media:
+                if not state:
                     
                     parts = event_copy.text.strip().split()
+                    profile = parts.pop().lower() if len(parts) > 2 and parts[-1].lower() in TRANSCRIPTION_PROFILES else None
                     if len(parts) >= 2 and parts[0].lower() == "add":
                         try:
                             min_speakers = int(parts[1])
@@ -177,224 +2053,172 @@ async def main():
                             else:
                                 max_speakers = min_speakers
                                 language = parts[2].lower() if len(parts) > 2 else None
-                            user_states[(user_id, session_id)] = {
-                                "step": "await_file",
+                            session_id = sessions.open(user_id, {
                                 "min_speakers": min_speakers,
                                 "max_speakers": max_speakers,
                                 "language": language,
-                            }
+                                "profile": profile,
+                            })
+                            if session_id is None:
+                                await event_copy.reply("❌ Too many transcriptions are in progress. Please try again later.")
+                                log(f"No room for a new session of user {user_id}: {len(sessions)} open.")
+                                return
+                            pod_pool.prewarm()
+                            profile_line = f"\nProfile: {profile}" if profile else ""
                             if language:
                                 await event_copy.reply(
-                                    f"Now upload your audio file.\nSpeakers: {min_speakers}-{max_speakers}\nLanguage: {language}"
+                                    f"Now upload your audio file.\nSpeakers: {min_speakers}-{max_speakers}\nLanguage: {language}{profile_line}"
                                 )
-                                log(f"User {user_id} set min_speakers={min_speakers}, max_speakers={max_speakers}, language={language} (session {session_id})")
+                                log(f"User {user_id} set min_speakers={min_speakers}, max_speakers={max_speakers}, language={language}, profile={profile or 'auto'} (session {session_id})")
                             else:
                                 await event_copy.reply(
-                                    f"Now upload your audio file.\nSpeakers: {min_speakers}-{max_speakers}\nLanguage will be auto-detected."
+                                    f"Now upload your audio file.\nSpeakers: {min_speakers}-{max_speakers}\nLanguage will be auto-detected.{profile_line}"
                                 )
-                                log(f"User {user_id} set min_speakers={min_speakers}, max_speakers={max_speakers}, language=auto (session {session_id})")
+                                log(f"User {user_id} set min_speakers={min_speakers}, max_speakers={max_speakers}, language=auto, profile={profile or 'auto'} (session {session_id})")
                             return
                         except Exception as e:
                             await event_copy.reply(
-                                "Please use: add <min speakers> <max speakers (optional)> <language code (optional)>, e.g. 'add 2 3 en', 'add 2 en', or 'add 2'."
+                                f"Please use: add <min speakers> <max speakers (optional)> <language code (optional)> <profile (optional): {', '.join(TRANSCRIPTION_PROFILES)}>, e.g. 'add 2 3 en', 'add 2 en', 'add 1 en fast', or 'add 2'."
                             )
                             log(f"Error parsing input for user {user_id}, session {session_id}: {e}")
                             return
                     else:
                         await event_copy.reply(
-                            "Please start with: add <min speakers> <max speakers (optional)> <language code (optional)>, e.g. 'add 2 3 en', 'add 2 en', or 'add 2'."
+                            f"Please start with: add <min speakers> <max speakers (optional)> <language code (optional)> <profile (optional): {', '.join(TRANSCRIPTION_PROFILES)}>, e.g. 'add 2 3 en', 'add 2 en', 'add 1 en fast', or 'add 2'."
                         )
                         log(f"Asked user {user_id} for 'add <min> <max> <language>' (session {session_id}).")
                         return
                 
                 if state.get("step") == "await_file":
-                    if not event_copy.media:
-                        await event_copy.reply("Please upload your audio file.")
-                        log(f"User {user_id} sent non-media when awaiting file (session {session_id}).")
-                        return
-                    await event_copy.reply("📥 Downloading audio file, please wait…")
+                    await event_copy.reply("Please upload your audio file.")
+                    log(f"User {user_id} sent non-media when awaiting file (session {session_id}).")
+                    return
+                
+                if state.get("step") == "downloading":
+                    trace = Trace()
+                    log(f"[trace {trace.trace_id}] Audio received from user {user_id} (session {session_id})")
                     fname = f"{user_id}_{session_id}_{int(datetime.now().timestamp())}.audio"
                     file_path = os.path.join(FILES_DIR, fname)
-                    await event_copy.download_media(file_path)
+                    transcript_path = os.path.join(FILES_DIR, fname.rsplit(".audio", 1)[0] + ".txt")
+                    telegram_key = telegram_file_key(event_copy.media)
+                    requested_language = state.get("language") or "auto"
+                    if telegram_key:
+                        cached = transcript_cache.get(session_cache_key(telegram_key, state, requested_language))
+                        if cached:
+                            with trace.span("delivery"):
+                                await send_cached_transcript(event_copy, user_id, cached, transcript_path)
+                            trace.finish("cached")
+                            sessions.drop(user_id, session_id)
+                            return
+                    await event_copy.reply("📥 Downloading audio file, please wait…")
+                    audio_sha256, relayed, probs = None, None, None
+                    with trace.span("telegram_download"):
+                        if RELAY_UPLOAD:
+                            audio_sha256, size, relayed, probs = await relay_download(client, event_copy, file_path, trace, detect=not state.get("language"))
+                        else:
+                            await event_copy.download_media(file_path)
                     log(f"Downloaded file for user {user_id}, session {session_id} to: {file_path}")
-                    if not os.path.exists(file_path):
+                    if RELAY_UPLOAD and not RELAY_STAGE_TO_DISK and relayed:
+                        state.update({
+                            "file_path": file_path,
+                            "transcript_path": transcript_path,
+                            "telegram_key": telegram_key,
+                            "requested_language": requested_language,
+                            "trace_id": trace.trace_id,
+                            "audio_sha256": audio_sha256,
+                            "relay_upload": relayed,
+                        })
+                        metrics.inc("whisper_bot_download_bytes_total", size, source="telegram")
+                        sessions.save(user_id, session_id)
+                        log(f"Audio relayed to {relayed[0]} as upload {relayed[1]}, size={size} bytes, not staged (session {session_id})")
+                    elif RELAY_UPLOAD and not os.path.exists(file_path):
+                        log(f"Relaying the audio of user {user_id} failed and no copy was staged (session {session_id}).")
+                        await event_copy.reply("❌ Could not pass your audio on to a WhisperX server. Please send the file again.")
+                        sessions.drop(user_id, session_id)
+                        return
+                    elif not os.path.exists(file_path):
                         log(f"FATAL: Audio file not found at {file_path} before WhisperX runs (session {session_id}).")
                         await event_copy.reply(f"❌ FATAL: Audio file not found at {file_path}")
-                        user_states[(user_id, session_id)] = {}
+                        sessions.drop(user_id, session_id)
                         return
                     else:
-                        user_states[(user_id, session_id)]["file_path"] = file_path
+                        state.update({
+                            "file_path": file_path,
+                            "transcript_path": transcript_path,
+                            "telegram_key": telegram_key,
+                            "requested_language": requested_language,
+                            "trace_id": trace.trace_id,
+                            "audio_sha256": audio_sha256,
+                            "relay_upload": relayed,
+                        })
+                        metrics.inc("whisper_bot_download_bytes_total", os.path.getsize(file_path), source="telegram")
+                        sessions.save(user_id, session_id)
                         log(f"Audio file saved at {file_path}, size={os.path.getsize(file_path)} bytes (session {session_id})")
+                    # Re-encode for upload while the language is detected and confirmed.
+                    preprocessing = None if relayed else asyncio.create_task(preprocess_audio(file_path, trace))
                     
                     if not state.get("language"):
-                        await event_copy.reply("🔎 Detecting language, please wait…")
-                        detected_lang = detect_language(file_path)
-                        user_states[(user_id, session_id)]["language"] = detected_lang
-                        user_states[(user_id, session_id)]["file_path"] = file_path
-                        user_states[(user_id, session_id)]["step"] = "confirm_language"
-                        await event_copy.reply(
-                            f"🌐 Detected language: {detected_lang}\nIf this is correct, reply 'yes'. Otherwise, type the correct language code (e.g. 'en', 'ru')."
-                        )
-                        log(f"Detected language for user {user_id}, session {session_id}: {detected_lang}")
-                        
-                        state = user_states.get((user_id, session_id), {})
+                        if probs is None:
+                            await event_copy.reply("🔎 Detecting language, please wait…")
+                            with trace.span("language_detection"):
+                                # Without a staged copy the user is asked to confirm a language instead.
+                                probs = await detect_language_async(file_path) if os.path.exists(file_path) else {}
+                        detected_lang, confidence = next(iter(probs.items()), ("unknown", 0.0))
+                        if confidence >= LANGUAGE_CONFIDENCE:
+                            sessions.advance(user_id, session_id, "processing", language=detected_lang)
+                            await event_copy.reply(
+                                f"🌐 Detected language: {detected_lang} ({confidence:.0%})\nSpeakers: {state['min_speakers']}-{state['max_speakers']}\nStarting transcription now…"
+                            )
+                        else:
+                            sessions.advance(user_id, session_id, "confirm_language", language=detected_lang)
+                            alternatives = ", ".join(f"{lang} ({p:.0%})" for lang, p in list(probs.items())[:3])
+                            await event_copy.reply(
+                                f"🌐 Detected language: {detected_lang}\nTop guesses: {alternatives}\nIf this is correct, reply 'yes'. Otherwise, type the correct language code (e.g. 'en', 'ru')."
+                            )
+                        log(f"Detected language for user {user_id}, session {session_id}: {detected_lang} ({confidence:.2f})")
+                    else:
+                        sessions.advance(user_id, session_id, "processing")
                         
                     if state.get("step") == "confirm_language":
                         lang = None
                         try:
                             
-                            reply_event = await client.wait_event(
-                                events.NewMessage(from_users=user_id), timeout=60
-                            )
+                            with trace.span("language_confirmation"):
+                                reply_event = await sessions.wait_reply(user_id, session_id, LANGUAGE_REPLY_TIMEOUT)
                             lang = reply_event.text.strip().lower()
                         except asyncio.TimeoutError:
                             
                             lang = "yes"
                             await event_copy.reply("⏳ No language reply in 1 minute, continuing with detected language.")
-                        if lang == "yes":
-                            language = user_states[(user_id, session_id)]["language"]
-                        else:
-                            language = lang
-                            user_states[(user_id, session_id)]["language"] = language
-                        user_states[(user_id, session_id)]["step"] = "processing"
+                        language = state["language"] if lang == "yes" else lang
+                        sessions.advance(user_id, session_id, "processing", language=language)
                         await event_copy.reply(
-                            f"👍 Got it!\nSpeakers: {user_states[(user_id, session_id)]['min_speakers']}-{user_states[(user_id, session_id)]['max_speakers']}\nLanguage: {language}\nStarting transcription now…"
+                            f"👍 Got it!\nSpeakers: {state['min_speakers']}-{state['max_speakers']}\nLanguage: {language}\nStarting transcription now…"
                         )
                         log(f"User {user_id} confirmed/overrode language: {language} (session {session_id}).")
-                    status_msg = await event_copy.reply("⏳ Running WhisperX, please wait…")
-                    min_speakers = user_states[(user_id, session_id)]["min_speakers"]
-                    max_speakers = user_states[(user_id, session_id)]["max_speakers"]
-                    language = user_states[(user_id, session_id)]["language"]
-                    file_path = user_states[(user_id, session_id)]["file_path"]
-                    async def run_whisperx_and_monitor():
-                        async with active_jobs_lock:
-                            count = read_active_jobs()
-                            count += 1
-                            write_active_jobs(count)
-                            log(f"[active_jobs] Incremented: {count}")
-                        try:
-                            
-                            status = runpod_api.get_pod_status()
-                            if status != "RUNNING":
-                                log(f"Pod not running (status={status}), resuming...")
-                                runpod_api.start_pod()
-                                for _ in range(60):
-                                    time.sleep(5)
-                                    status = runpod_api.get_pod_status()
-                                    if status == "RUNNING":
-                                        break
-                                if status != "RUNNING":
-                                    log("Pod did not start in time or not enough GPUs.")
-                                    await event_copy.reply("❌ Remote error: Pod did not start in time or not enough GPUs available. Please try again later.")
-                                    return ["Remote error: Pod did not start in time or not enough GPUs."]
-                            log(f"Pod is running (status={status})")
-                            await asyncio.sleep(50)
-                            remote_url = runpod_api.get_server_url()
-                            log(f"Using remote WhisperX server at: {remote_url}")
-                            with open(file_path, "rb") as f:
-                                files = {"audio": (os.path.basename(file_path), f, "application/octet-stream")}
-                                data = {
-                                    "min_speakers": str(min_speakers),
-                                    "max_speakers": str(max_speakers),
-                                    "language": language,
-                                    "HF_TOKEN": HF_TOKEN,
-                                }
-                                response = requests.post(remote_url, files=files, data=data, timeout=3000)
-                            if response.status_code not in (200, 202):
-                                log(f"Remote WhisperX error: {response.text}")
-                                await event_copy.reply(f"❌ Remote error: {response.text}")
-                                return [f"Remote error: {response.text}"]
-                            job_id = response.json().get("job_id")
-                            if not job_id:
-                                log(f"Remote WhisperX error: No job_id in response: {response.text}")
-                                await event_copy.reply(f"❌ Remote error: No job_id in response: {response.text}")
-                                return [f"Remote error: No job_id in response: {response.text}"]
-                            log(f"Job submitted, job_id={job_id}")
-                            status_url = remote_url.replace("/run_whisperx", f"/job_status/{job_id}")
-                            transcript_url = remote_url.replace("/run_whisperx", f"/get_transcript/{job_id}")
-                            for poll_count in range(720):
-                                status_resp = requests.get(status_url, timeout=10)
-                                if status_resp.status_code != 200:
-                                    await asyncio.sleep(10)
-                                    continue
-                                status_data = status_resp.json()
-                                if status_data.get("status") == "done":
-                                    log(f"Job {job_id} done, downloading transcript...")
-                                    break
-                                elif status_data.get("status") == "error":
-                                    error_msg = status_data.get("error")
-                                    log(f"Job {job_id} error: {error_msg}")
-                                    await event_copy.reply(f"❌ WhisperX error: {error_msg}")
-                                    return [f"Remote error: {error_msg}"]
-                                await asyncio.sleep(10)
-                            else:
-                                log(f"Job {job_id} timed out after polling.")
-                                await event_copy.reply("❌ Remote error: Job timed out.")
-                                return ["Remote error: Job timed out."]
-                            transcript_resp = requests.get(transcript_url, timeout=600)
-                            if transcript_resp.status_code == 200:
-                                transcript_path = file_path.rsplit(".audio", 1)[0] + ".txt"
-                                with open(transcript_path, "wb") as out:
-                                    out.write(transcript_resp.content)
-                                log(f"Transcript downloaded from remote pod: {transcript_path}")
-                                with open(transcript_path, "r") as f:
-                                    lines = f.readlines()
-                                return [line.strip() for line in lines]
-                            else:
-                                log(f"Remote WhisperX error: {transcript_resp.text}")
-                                await event_copy.reply(f"❌ WhisperX error: {transcript_resp.text}")
-                                return [f"Remote error: {transcript_resp.text}"]
-                        finally:
-                            async with active_jobs_lock:
-                                count = read_active_jobs()
-                                count = max(count - 1, 0)
-                                write_active_jobs(count)
-                                log(f"[active_jobs] Decremented: {count}")
-                                if count <= 0:
-                                    log(f"All jobs for user {user_id} finished. Pausing pod.")
-                                    runpod_api.pause_pod()
-                    output_lines = await run_whisperx_and_monitor()
-                    log(f"WhisperX process finished for user {user_id}. Checking for transcript file.")
-                    
-                    transcript = ""
-                    folder = FILES_DIR
-                    transcript_filename = fname.rsplit(".audio", 1)[0] + ".txt"
-                    transcript_path = os.path.join(folder, transcript_filename)
-                    
-                    if os.path.exists(transcript_path):
-                        with open(transcript_path, "r") as f:
-                            transcript = f.read()
-                        log(f"Transcript loaded from: {transcript_path}")
-                    else:
-                        transcript = "\n".join(output_lines) or "No transcript found."
-                        with open(transcript_path, "w") as f:
-                            f.write(transcript)
-                        log(f"Transcript written to: {transcript_path}")
-                    
-                    for i in range(0, len(transcript), 4000):
-                        await event_copy.reply(transcript[i:i+4000])
-                        log(f"Transcript chunk {i//4000+1} sent to user {user_id}, length: {len(transcript[i:i+4000])}")
-                    
-                    if transcript_path and os.path.exists(transcript_path):
-                        await event_copy.reply(file=transcript_path, message="📝 Transcript file")
-                        log(f"Transcript file sent to user {user_id}: {transcript_path}")
-                    await event_copy.reply("✅ Transcript sent as text and file. Ready for a new task! Start by entering number of speakers and language (e.g. 'add 2 en').")
-                    log(f"All done for user {user_id}. State reset for next session.")
-                    
-                    user_states.pop((user_id, session_id), None)
+                    await transcribe_session(event_copy, user_id, session_id, trace, preprocessing)
             except Exception as exc:
                 import traceback
                 err_str = ''.join(traceback.format_exception(type(exc), exc, exc.__traceback__))
                 await event_copy.reply("❌ Internal error occurred, check logs for details.")
                 log(f"Exception for user {user_id}, session {session_id}:\n{err_str}")
-            finally:
-                user_tasks[user_id] = [t for t in user_tasks[user_id] if not t.done()]
+                if session_id:
+                    sessions.drop(user_id, session_id)
         
-        task = asyncio.create_task(process_task(event, session_id))
-        user_tasks[user_id].append(task)
+        sessions.spawn(process_task(event, session_id))
     log("Telethon bot running. To start: type 'add <speakers> <language>' or just 'add <speakers>', then upload audio.")
     await client.start()
-    await client.run_until_disconnected()
+    metrics_runner = await start_metrics_server()
+    await resume_sessions(client)
+    sweeper = asyncio.create_task(sessions.run())
+    try:
+        await client.run_until_disconnected()
+    finally:
+        sweeper.cancel()
+        if metrics_runner is not None:
+            await metrics_runner.cleanup()
+        await pod_pool.shutdown()
+        await http.close()
 
 if __name__ == "__main__":
     asyncio.run(main())
\ No newline at end of file